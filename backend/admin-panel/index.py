@@ -19,6 +19,55 @@ def log_activity(cursor, event_type: str, message: str, data: Dict = None):
         VALUES (%s, %s, %s, NOW())
     """, (event_type, message, json.dumps(data) if data else None))
 
+ACTIVITY_FEED_MAX_LIMIT = 500
+
+def fetch_activity_feed(cursor, query_params: Dict[str, Any], default_limit: int = 50) -> tuple:
+    """
+    Страница ленты activity_log с keyset-пагинацией по (created_at, id).
+    Параметры: limit, before (next_cursor предыдущей страницы), event_type, courier_id (из data)
+    """
+    try:
+        limit = min(max(int(query_params.get('limit') or default_limit), 1), ACTIVITY_FEED_MAX_LIMIT)
+    except ValueError:
+        raise ValueError('Неверный limit')
+    
+    conditions = []
+    params = []
+    
+    before = query_params.get('before')
+    if before:
+        try:
+            before_ts, before_id = before.rsplit('_', 1)
+            params.extend([datetime.fromisoformat(before_ts), int(before_id)])
+        except ValueError:
+            raise ValueError('Неверный курсор')
+        conditions.append('(created_at, id) < (%s, %s)')
+    
+    if query_params.get('event_type'):
+        conditions.append('event_type = %s')
+        params.append(query_params['event_type'])
+    
+    if query_params.get('courier_id'):
+        conditions.append("data ? 'courier_id' AND data->>'courier_id' = %s")
+        params.append(str(query_params['courier_id']))
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cursor.execute(f"""
+        SELECT id, event_type, message, data, created_at
+        FROM t_p25272970_courier_button_site.activity_log
+        {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+    """, params + [limit + 1])
+    
+    rows = cursor.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1][4].isoformat()}_{rows[-1][0]}"
+    
+    return rows, next_cursor
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Админ API для просмотра заявок на выплаты и управления пользователями
@@ -74,13 +123,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         # Получение ленты активности
         if method == 'GET' and action == 'activity':
-            cursor.execute("""
-                SELECT id, event_type, message, data, created_at 
-                FROM t_p25272970_courier_button_site.activity_log 
-                ORDER BY created_at DESC 
-                LIMIT 50
-            """)
-            rows = cursor.fetchall()
+            try:
+                rows, next_cursor = fetch_activity_feed(cursor, query_params)
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': str(e)}),
+                    'isBase64Encoded': False
+                }
             activities = []
             for row in rows:
                 activities.append({
@@ -94,7 +145,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'activities': activities}),
+                'body': json.dumps({'success': True, 'activities': activities, 'next_cursor': next_cursor}),
                 'isBase64Encoded': False
             }
         
@@ -6,17 +6,29 @@ Returns: HTTP response
 '''
 
 import json
+import math
 import os
+import base64
+import csv
+import gzip
+import io
+import re
+from itertools import islice
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.extensions import connection as PgConnection, cursor as PgCursor, register_adapter, AsIs
 import bcrypt
 import jwt
 import hashlib
 import hmac
 from datetime import datetime, timedelta
 from typing import Dict, Any
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import total_ordering
 import requests
+import random
+import threading
+import time
 
 JWT_SECRET = os.environ['JWT_SECRET']
 JWT_ALGORITHM = 'HS256'
@@ -25,43 +37,501 @@ JWT_EXPIRATION_HOURS = 720
 login_attempts = {}
 # v1.2 - добавлено логирование загрузки музыки
 
+METRICS_LOG_SAMPLE_RATE = float(os.environ.get('METRICS_LOG_SAMPLE_RATE', '1'))
+SLOW_REQUEST_MS = 1000
+# Один и тот же запрос столько раз за запрос — кандидат в N+1, попадает в лог отдельно
+REPEATED_QUERY_THRESHOLD = 10
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_request_metrics = threading.local()
+_route_metrics = {}
+_route_metrics_lock = threading.Lock()
+_metrics_started_at = datetime.now()
+
+def query_fingerprint(query) -> str:
+    """SQL-шаблон до подстановки параметров без лишних пробелов — одинаков для всех вызовов одного запроса"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return ' '.join(str(query).split())[:300]
+
+class InstrumentedCursorMixin:
+    """Считает запросы, время в БД и возвращённые строки в метрики текущего запроса"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(query, time.perf_counter() - started, self.rowcount if self.description is not None else 0)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(query, time.perf_counter() - started, 0)
+
+_instrumented_cursor_classes = {}
+
+def instrumented_cursor_class(factory):
+    if factory not in _instrumented_cursor_classes:
+        _instrumented_cursor_classes[factory] = type(f'Instrumented{factory.__name__}', (InstrumentedCursorMixin, factory), {})
+    return _instrumented_cursor_classes[factory]
+
+def record_query(query, elapsed: float, rows: int):
+    metrics = getattr(_request_metrics, 'current', None)
+    if metrics is None:
+        return
+    metrics['queries'] += 1
+    metrics['db_ms'] += elapsed * 1000
+    metrics['rows'] += max(rows, 0)
+    fingerprint = query_fingerprint(query)
+    metrics['fingerprints'][fingerprint] = metrics['fingerprints'].get(fingerprint, 0) + 1
+
+def observe_route(key: str, wall_ms: float, metrics: Dict[str, Any], status: int, response_bytes: int):
+    with _route_metrics_lock:
+        route = _route_metrics.setdefault(key, {
+            'requests': 0, 'errors': 0, 'wall_ms_sum': 0.0, 'wall_ms_max': 0.0, 'db_ms_sum': 0.0,
+            'queries_sum': 0, 'queries_max': 0, 'rows_sum': 0, 'response_bytes_sum': 0,
+            'latency_histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        })
+        route['requests'] += 1
+        route['errors'] += int(status >= 500)
+        route['wall_ms_sum'] += wall_ms
+        route['wall_ms_max'] = max(route['wall_ms_max'], wall_ms)
+        route['db_ms_sum'] += metrics['db_ms']
+        route['queries_sum'] += metrics['queries']
+        route['queries_max'] = max(route['queries_max'], metrics['queries'])
+        route['rows_sum'] += metrics['rows']
+        route['response_bytes_sum'] += response_bytes
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if wall_ms <= bound), len(LATENCY_BUCKETS_MS))
+        route['latency_histogram'][bucket] += 1
+
+def instrumented_handler(func):
+    """
+    Декоратор обработчика: время, время в БД, число запросов, строки и размер ответа по route/action.
+    Одна JSON-строка в лог на запрос (с семплированием METRICS_LOG_SAMPLE_RATE, медленные пишутся всегда)
+    """
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        if event.get('httpMethod') == 'OPTIONS':
+            return func(event, context)
+        query_params = event.get('queryStringParameters') or {}
+        key = f"{query_params.get('route') or 'main'}:{query_params.get('action') or ''}"
+        metrics = {'queries': 0, 'db_ms': 0.0, 'rows': 0, 'fingerprints': {}}
+        _request_metrics.current = metrics
+        started = time.perf_counter()
+        result = None
+        try:
+            result = func(event, context)
+            return result
+        finally:
+            _request_metrics.current = None
+            wall_ms = (time.perf_counter() - started) * 1000
+            status = result.get('statusCode', 200) if isinstance(result, dict) else 500
+            response_bytes = len(result.get('body') or '') if isinstance(result, dict) else 0
+            observe_route(key, wall_ms, metrics, status, response_bytes)
+            if wall_ms >= SLOW_REQUEST_MS or random.random() < METRICS_LOG_SAMPLE_RATE:
+                print(json.dumps({
+                    'metric': 'request',
+                    'route': key,
+                    'method': event.get('httpMethod'),
+                    'status': status,
+                    'wall_ms': round(wall_ms, 1),
+                    'db_ms': round(metrics['db_ms'], 1),
+                    'queries': metrics['queries'],
+                    'rows': metrics['rows'],
+                    'response_bytes': response_bytes,
+                    'repeated_queries': [
+                        {'fingerprint': fingerprint, 'count': count}
+                        for fingerprint, count in metrics['fingerprints'].items()
+                        if count >= REPEATED_QUERY_THRESHOLD
+                    ]
+                }, ensure_ascii=False))
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+def get_route_metrics() -> Dict[str, Any]:
+    with _route_metrics_lock:
+        routes = {}
+        for key, route in _route_metrics.items():
+            requests_count = route['requests']
+            routes[key] = {
+                **route,
+                'latency_histogram': dict(zip([f'<={b}ms' for b in LATENCY_BUCKETS_MS] + ['inf'], route['latency_histogram'])),
+                'avg_wall_ms': round(route['wall_ms_sum'] / requests_count, 1),
+                'avg_db_ms': round(route['db_ms_sum'] / requests_count, 1),
+                'avg_queries': round(route['queries_sum'] / requests_count, 1)
+            }
+    return {'since': _metrics_started_at.isoformat(), 'routes': routes}
+
+ACTIVITY_LOG_INSERT = 'INSERT INTO t_p25272970_courier_button_site.activity_log (event_type, message, data) VALUES %s'
+
+class ActivityLogConnection(PgConnection):
+    """
+    Соединение API: буфер activity_log (события пишутся одним многострочным INSERT перед commit(), rollback() их отбрасывает)
+    и курсоры с учётом запросов в метриках запроса
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.activity_buffer = []
+
+    def flush_activity(self) -> int:
+        if not self.activity_buffer:
+            return 0
+        events, self.activity_buffer = self.activity_buffer, []
+        cur = self.cursor()
+        try:
+            execute_values(cur, ACTIVITY_LOG_INSERT, events, page_size=len(events))
+        finally:
+            cur.close()
+        return len(events)
+
+    def commit(self):
+        self.flush_activity()
+        super().commit()
+
+    def rollback(self):
+        self.activity_buffer = []
+        super().rollback()
+
+    def close(self):
+        self.activity_buffer = []
+        super().close()
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or PgCursor
+        kwargs['cursor_factory'] = instrumented_cursor_class(factory)
+        return super().cursor(*args, **kwargs)
+
+def get_db_connection(**kwargs):
+    return psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=ActivityLogConnection, **kwargs)
+
 def log_activity(conn, event_type: str, message: str, data: Dict = None):
-    """Логирование события в таблицу activity_log"""
+    """Логирование события в activity_log. Событие попадает в таблицу вместе с commit() транзакции"""
+    event = (event_type, message, json.dumps(data) if data else None)
+    if isinstance(conn, ActivityLogConnection):
+        conn.activity_buffer.append(event)
+        return
     cur = conn.cursor()
-    data_json = json.dumps(data) if data else None
-    cur.execute(
-        'INSERT INTO t_p25272970_courier_button_site.activity_log (event_type, message, data) VALUES (%s, %s, %s)',
-        (event_type, message, data_json)
-    )
+    execute_values(cur, ACTIVITY_LOG_INSERT, [event])
     cur.close()
 
-def send_telegram_notification(telegram_id: str, message: str) -> bool:
-    """Отправка уведомления в Telegram курьеру"""
-    try:
-        bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-        if not bot_token:
-            print('>>> WARNING: TELEGRAM_BOT_TOKEN не настроен, пропускаем отправку уведомления')
-            return False
-        
-        url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
-        payload = {
-            'chat_id': telegram_id,
-            'text': message,
-            'parse_mode': 'HTML'
-        }
-        
-        response = requests.post(url, json=payload, timeout=10)
-        
-        if response.status_code == 200:
-            print(f'>>> Telegram уведомление отправлено: chat_id={telegram_id}')
-            return True
-        else:
-            print(f'>>> Ошибка отправки Telegram уведомления: {response.status_code} - {response.text}')
-            return False
-            
-    except Exception as e:
-        print(f'>>> Исключение при отправке Telegram уведомления: {str(e)}')
-        return False
+def enqueue_telegram_notification(cur, telegram_id: str, message: str, event_type: str = None):
+    """Кладёт уведомление в notification_outbox в текущей транзакции. Отправляет функция notification-outbox"""
+    cur.execute("""
+        INSERT INTO t_p25272970_courier_button_site.notification_outbox (channel, recipient, message_text, event_type)
+        VALUES ('telegram', %s, %s, %s)
+    """, (str(telegram_id), message, event_type))
+
+@total_ordering
+class Money:
+    """
+    Сумма в целых копейках: сложение и распределение без дрейфа float. В БД уходит как NUMERIC,
+    в JSON — числом с двумя знаками (convert_decimals)
+    """
+    __slots__ = ('kopecks',)
+
+    def __init__(self, kopecks: int = 0):
+        self.kopecks = int(kopecks)
+
+    @classmethod
+    def of(cls, value) -> 'Money':
+        """Из рублей: str / Decimal / int / float (float через его десятичную запись), округление до копейки"""
+        if isinstance(value, Money):
+            return value
+        if value is None or value == '':
+            return cls(0)
+        rubles = value if isinstance(value, Decimal) else Decimal(str(value))
+        return cls(int((rubles * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP)))
+
+    def allocate(self, weights) -> list:
+        """
+        Делит сумму пропорционально весам методом наибольших остатков: доли всегда в сумме дают
+        ровно исходную сумму, каждая отличается от точной пропорции меньше чем на копейку
+        """
+        # Веса — рубли с копейками (расходы на рекламу) или проценты: считаем в целых сотых
+        weights = [weight * 100 if isinstance(weight, int) else Money.of(weight).kopecks for weight in weights]
+        total_weight = sum(weights)
+        if not weights or total_weight <= 0:
+            return [Money(0) for _ in weights]
+        
+        shares = []
+        remainders = []
+        for weight in weights:
+            share, remainder = divmod(self.kopecks * weight, total_weight)
+            shares.append(share)
+            remainders.append(remainder)
+        leftover = self.kopecks - sum(shares)
+        by_remainder = sorted(range(len(weights)), key=lambda i: (-remainders[i], i))
+        for i in by_remainder[:leftover]:
+            shares[i] += 1
+        return [Money(share) for share in shares]
+
+    def to_decimal(self) -> Decimal:
+        return Decimal(self.kopecks).scaleb(-2)
+
+    def __add__(self, other):
+        return Money(self.kopecks + Money.of(other).kopecks)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return Money(self.kopecks - Money.of(other).kopecks)
+
+    def __rsub__(self, other):
+        return Money(Money.of(other).kopecks - self.kopecks)
+
+    def __neg__(self):
+        return Money(-self.kopecks)
+
+    @staticmethod
+    def _rubles(other):
+        """
+        Точное число для сравнения в рублях. float — его точное двоичное значение, как при сравнении Decimal с float:
+        Money(10) != 0.1, зато равные значения всегда с равным hash
+        """
+        if isinstance(other, Money):
+            return other.to_decimal()
+        if isinstance(other, (int, float, Decimal)):
+            return Decimal(other)
+        return None
+
+    def __eq__(self, other):
+        rubles = Money._rubles(other)
+        return NotImplemented if rubles is None else self.to_decimal() == rubles
+
+    def __lt__(self, other):
+        rubles = Money._rubles(other)
+        return NotImplemented if rubles is None else self.to_decimal() < rubles
+
+    def __hash__(self):
+        # Как у равного Decimal/int/float: Money(100), 1 и 1.0 — один ключ словаря
+        return hash(self.to_decimal())
+
+    def __bool__(self):
+        return self.kopecks != 0
+
+    def __float__(self):
+        return self.kopecks / 100
+
+    def __format__(self, spec):
+        return format(self.to_decimal(), spec or 'f')
+
+    def __str__(self):
+        return str(self.to_decimal())
+
+    def __repr__(self):
+        return f'Money({self})'
+
+
+register_adapter(Money, lambda money: AsIs(str(money)))
+
+
+def check_money_allocation(samples: int = 10000, seed: int = 42) -> Dict[str, Any]:
+    """
+    Проверка свойств Money.allocate на случайных суммах и весах (как в распределении выплат: 60/40,
+    доли рекламных расходов, нулевые веса): сумма долей равна исходной, отклонение от точной доли < 1 копейки
+    """
+    rng = random.Random(seed)
+    failures = []
+    for _ in range(samples):
+        amount = Money(rng.randint(0, 10_000_000))
+        weights = rng.choice([
+            [60, 40],
+            [rng.randint(0, 1000) for _ in range(rng.randint(1, 8))],
+            [round(rng.uniform(0, 50000), 2) for _ in range(rng.randint(1, 5))]
+        ])
+        shares = amount.allocate(weights)
+        total_weight = sum(Decimal(str(weight)) for weight in weights)
+        if total_weight > 0:
+            exact_ok = all(
+                abs(Decimal(share.kopecks) - amount.kopecks * Decimal(str(weight)) / total_weight) < 1
+                for share, weight in zip(shares, weights)
+            )
+            if sum(share.kopecks for share in shares) != amount.kopecks or not exact_ok:
+                failures.append({'amount': str(amount), 'weights': weights, 'shares': [str(share) for share in shares]})
+    return {'samples': samples, 'failures': failures[:10], 'failed': len(failures)}
+
+
+def benchmark_money(splits: int = 100000) -> Dict[str, Any]:
+    """Распределений 60/40 и по трём админам в секунду: Money против прежней арифметики float"""
+    rng = random.Random(42)
+    amounts = [rng.randint(100, 1_000_000) / 100 for _ in range(splits)]
+    spends = [12000.5, 7300, 415.25]
+    
+    started = time.perf_counter()
+    float_drift = 0.0
+    for amount in amounts:
+        referrer = amount * 0.60
+        admins = [(spend / sum(spends)) * amount * 0.40 for spend in spends]
+        float_drift += abs(referrer + sum(admins) - amount)
+    float_ms = (time.perf_counter() - started) * 1000
+    
+    started = time.perf_counter()
+    for amount in amounts:
+        referrer, admin_total = Money.of(amount).allocate([60, 40])
+        admin_total.allocate(spends)
+    money_ms = (time.perf_counter() - started) * 1000
+    
+    return {
+        'splits': splits,
+        'float_splits_per_sec': int(splits / (float_ms / 1000)) if float_ms else None,
+        'money_splits_per_sec': int(splits / (money_ms / 1000)) if money_ms else None,
+        'float_total_drift': float_drift
+    }
+
+
+LEDGER_TABLE = 't_p25272970_courier_button_site.balance_ledger'
+CHECKPOINTS_TABLE = 't_p25272970_courier_button_site.balance_checkpoints'
+USERS_TABLE = 't_p25272970_courier_button_site.users'
+# Записи моложе этого в контрольную точку не попадают: транзакция с меньшим id могла ещё не закоммититься
+LEDGER_CHECKPOINT_LAG = '5 minutes'
+
+def post_balance_entries(cur, entries: list) -> int:
+    """
+    Проводит движения баланса: запись в balance_ledger и изменение users.balance одним запросом (курсор RealDictCursor).
+    entries — (user_id, amount Money со знаком, entry_type, source_table, source_id, description).
+    Уже проведённый источник (тот же source_table/source_id/entry_type) пропускается вместе с изменением баланса
+    """
+    if not entries:
+        return 0
+    rows = execute_values(cur, f"""
+        WITH entries AS (
+            INSERT INTO {LEDGER_TABLE} (user_id, amount, entry_type, source_table, source_id, description)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+            RETURNING user_id, amount
+        ), totals AS (
+            SELECT user_id, SUM(amount) AS amount, COUNT(*) AS posted FROM entries GROUP BY user_id
+        )
+        UPDATE {USERS_TABLE} u
+        SET balance = COALESCE(u.balance, 0) + totals.amount, updated_at = NOW()
+        FROM totals
+        WHERE u.id = totals.user_id
+        RETURNING totals.posted
+    """, entries, fetch=True)
+    return sum(row['posted'] for row in rows)
+
+def ledger_balances(cur, user_ids: list) -> Dict[int, Money]:
+    """Баланс по журналу: контрольная точка + записи после неё (по индексу user_id, id). Курсор RealDictCursor"""
+    cur.execute(f"""
+        SELECT u.id, COALESCE(c.balance, 0) + COALESCE((
+            SELECT SUM(l.amount) FROM {LEDGER_TABLE} l
+            WHERE l.user_id = u.id AND l.id > COALESCE(c.ledger_id, 0)
+        ), 0) AS balance
+        FROM unnest(%s::int[]) AS u(id)
+        LEFT JOIN {CHECKPOINTS_TABLE} c ON c.user_id = u.id
+    """, (list(user_ids),))
+    return {row['id']: Money.of(row['balance']) for row in cur.fetchall()}
+
+def checkpoint_balances(cur, ledger: str = LEDGER_TABLE, checkpoints: str = CHECKPOINTS_TABLE) -> int:
+    """Сдвигает контрольные точки всех курьеров с новыми записями журнала (старше LEDGER_CHECKPOINT_LAG)"""
+    cur.execute(f"""
+        INSERT INTO {checkpoints} (user_id, ledger_id, balance, entries)
+        SELECT l.user_id, MAX(l.id), COALESCE(c.balance, 0) + SUM(l.amount), COALESCE(c.entries, 0) + COUNT(*)
+        FROM {ledger} l
+        LEFT JOIN {checkpoints} c ON c.user_id = l.user_id
+        WHERE l.id > COALESCE(c.ledger_id, 0)
+        AND l.created_at < NOW() - INTERVAL '{LEDGER_CHECKPOINT_LAG}'
+        GROUP BY l.user_id, c.balance, c.entries
+        ON CONFLICT (user_id) DO UPDATE SET
+            ledger_id = EXCLUDED.ledger_id,
+            balance = EXCLUDED.balance,
+            entries = EXCLUDED.entries,
+            created_at = NOW()
+    """)
+    return cur.rowcount
+
+def reconcile_balances(conn, full: bool = False, limit: int = 100, ledger: str = LEDGER_TABLE,
+                       checkpoints: str = CHECKPOINTS_TABLE, users: str = USERS_TABLE) -> Dict[str, Any]:
+    """
+    Сверка users.balance с журналом одним проходом (агрегат по журналу + hash join с users).
+    full=True пересчитывает журнал целиком без контрольных точек — проверяет и сами точки.
+    Расхождения читаются серверным курсором, в ответе первые limit
+    """
+    started = time.perf_counter()
+    if full:
+        ledger_sums = f"SELECT user_id, SUM(amount) AS balance FROM {ledger} GROUP BY user_id"
+    else:
+        ledger_sums = f"""
+            SELECT COALESCE(c.user_id, t.user_id) AS user_id, COALESCE(c.balance, 0) + COALESCE(t.tail, 0) AS balance
+            FROM {checkpoints} c
+            FULL JOIN (
+                SELECT l.user_id, SUM(l.amount) AS tail
+                FROM {ledger} l
+                LEFT JOIN {checkpoints} c2 ON c2.user_id = l.user_id
+                WHERE l.id > COALESCE(c2.ledger_id, 0)
+                GROUP BY l.user_id
+            ) t ON t.user_id = c.user_id
+        """
+    
+    cur = conn.cursor(name='balance_reconcile')
+    cur.itersize = 5000
+    cur.execute(f"""
+        SELECT u.id, COALESCE(u.balance, 0) AS cached, COALESCE(s.balance, 0) AS ledger
+        FROM {users} u
+        LEFT JOIN ({ledger_sums}) s ON s.user_id = u.id
+        WHERE COALESCE(u.balance, 0) <> COALESCE(s.balance, 0)
+    """)
+    mismatches = []
+    total = 0
+    for user_id, cached, ledger_balance in cur:
+        total += 1
+        if len(mismatches) < limit:
+            mismatches.append({'user_id': user_id, 'balance': Money.of(cached), 'ledger': Money.of(ledger_balance),
+                               'difference': Money.of(cached) - Money.of(ledger_balance)})
+    cur.close()
+    
+    return {
+        'mode': 'full' if full else 'checkpoints',
+        'mismatches': total,
+        'items': mismatches,
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+
+def benchmark_ledger_reconcile(entries: int = 1000000, users: int = 50000) -> Dict[str, Any]:
+    """
+    Сверка на временных копиях журнала (entries записей по users курьерам) с контрольными точками и без.
+    Всё во временных таблицах одной транзакции, которая откатывается
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f'CREATE TEMP TABLE ledger_benchmark (LIKE {LEDGER_TABLE} INCLUDING DEFAULTS INCLUDING INDEXES) ON COMMIT DROP')
+    cur.execute(f'CREATE TEMP TABLE checkpoints_benchmark (LIKE {CHECKPOINTS_TABLE} INCLUDING DEFAULTS INCLUDING INDEXES) ON COMMIT DROP')
+    cur.execute('CREATE TEMP TABLE users_benchmark (id INTEGER PRIMARY KEY, balance DECIMAL(12,2)) ON COMMIT DROP')
+    cur.execute("""
+        INSERT INTO ledger_benchmark (id, user_id, amount, entry_type, created_at)
+        SELECT i, 1 + i %% %s, round((random() * 2000 - 500)::numeric, 2), 'benchmark', NOW() - INTERVAL '1 day'
+        FROM generate_series(1, %s) i
+    """, (users, entries))
+    cur.execute("""
+        INSERT INTO users_benchmark (id, balance)
+        SELECT user_id, SUM(amount) FROM ledger_benchmark GROUP BY user_id
+    """)
+    cur.execute('UPDATE users_benchmark SET balance = balance + 1 WHERE id % 1000 = 0')
+    cur.execute('ANALYZE ledger_benchmark')
+    cur.execute('ANALYZE users_benchmark')
+    tables = {'ledger': 'ledger_benchmark', 'checkpoints': 'checkpoints_benchmark', 'users': 'users_benchmark'}
+    
+    result = {'entries': entries, 'users': users}
+    result['full'] = reconcile_balances(conn, full=True, limit=0, **tables)
+    
+    started = time.perf_counter()
+    checkpoint_balances(cur, tables['ledger'], tables['checkpoints'])
+    result['checkpoint_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    cur.execute("""
+        INSERT INTO ledger_benchmark (id, user_id, amount, entry_type)
+        SELECT %s + i, 1 + i %% %s, 10, 'benchmark' FROM generate_series(1, %s) i
+    """, (entries, users, users))
+    cur.execute('UPDATE users_benchmark SET balance = balance + 10')
+    result['checkpoints'] = reconcile_balances(conn, limit=0, **tables)
+    
+    conn.rollback()
+    cur.close()
+    conn.close()
+    return result
 
 def convert_decimals(obj: Any) -> Any:
     if isinstance(obj, dict):
@@ -70,6 +540,8 @@ def convert_decimals(obj: Any) -> Any:
         return [convert_decimals(item) for item in obj]
     elif isinstance(obj, Decimal):
         return float(obj)
+    elif isinstance(obj, Money):
+        return float(obj)
     elif isinstance(obj, datetime):
         return obj.isoformat()
     return obj
@@ -98,15 +570,143 @@ def record_login_attempt(username: str):
         login_attempts[username] = []
     login_attempts[username].append(datetime.now())
 
-def log_activity(conn, event_type: str, message: str, data: Dict = None):
-    cur = conn.cursor()
-    data_json = json.dumps(data) if data else None
-    cur.execute(
-        'INSERT INTO activity_log (event_type, message, data) VALUES (%s, %s, %s)',
-        (event_type, message, data_json)
+class OutboundGuard:
+    """Защита исходящего вызова: дедлайн, single-flight для одинаковых запросов, circuit breaker и метрики"""
+
+    def __init__(self, name: str, timeout: float, failure_threshold: int = 3, reset_after: float = 30.0):
+        self.name = name
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.metrics = {
+            'calls': 0, 'successes': 0, 'failures': 0, 'short_circuited': 0,
+            'coalesced': 0, 'total_latency_ms': 0.0, 'max_latency_ms': 0.0
+        }
+
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return 'half_open'
+        return 'open'
+
+    def call(self, key: str, func, fallback):
+        """Выполняет func(timeout) или возвращает fallback, если зависимость деградировала.
+        Одинаковые по key запросы, пришедшие пока первый в полёте, получают его результат"""
+        leader = False
+        with self.lock:
+            state = self.state()
+            if state == 'open' or (state == 'half_open' and self.probe_in_flight):
+                self.metrics['short_circuited'] += 1
+                return fallback
+
+            flight = self.in_flight.get(key)
+            if flight:
+                self.metrics['coalesced'] += 1
+            else:
+                flight = {'event': threading.Event(), 'result': fallback}
+                self.in_flight[key] = flight
+                if state == 'half_open':
+                    self.probe_in_flight = True
+                leader = True
+        if not leader:
+            flight['event'].wait(self.timeout)
+            return flight['result']
+
+        started = time.monotonic()
+        ok = False
+        try:
+            flight['result'] = func(self.timeout)
+            ok = True
+        except Exception as e:
+            print(f'Outbound {self.name} error: {e}')
+        finally:
+            elapsed_ms = (time.monotonic() - started) * 1000
+            with self.lock:
+                self.metrics['calls'] += 1
+                self.metrics['total_latency_ms'] += elapsed_ms
+                self.metrics['max_latency_ms'] = max(self.metrics['max_latency_ms'], elapsed_ms)
+                self.probe_in_flight = False
+                if ok:
+                    self.metrics['successes'] += 1
+                    self.consecutive_failures = 0
+                    self.opened_at = None
+                else:
+                    self.metrics['failures'] += 1
+                    self.consecutive_failures += 1
+                    if self.consecutive_failures >= self.failure_threshold:
+                        self.opened_at = time.monotonic()
+                        print(f'Outbound {self.name}: circuit opened after {self.consecutive_failures} failures')
+                del self.in_flight[key]
+            flight['event'].set()
+
+        return flight['result']
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            calls = self.metrics['calls']
+            return {
+                **self.metrics,
+                'state': self.state(),
+                'consecutive_failures': self.consecutive_failures,
+                'avg_latency_ms': self.metrics['total_latency_ms'] / calls if calls else 0.0
+            }
+
+
+yandex_oauth_guard = OutboundGuard('yandex_oauth', timeout=5.0, failure_threshold=5, reset_after=30.0)
+
+
+def exchange_yandex_oauth_code(code: str, redirect_uri: str, timeout: float) -> Dict[str, Any]:
+    """Обмен code на токен и профиль Яндекса. Один повтор на сетевые ошибки и 5xx в пределах дедлайна"""
+    deadline = time.monotonic() + timeout
+    token_response = None
+    for attempt in range(2):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0.5:
+            break
+        try:
+            token_response = requests.post('https://oauth.yandex.ru/token', data={
+                'grant_type': 'authorization_code',
+                'code': code,
+                'client_id': '97aff4efd9cd4403854397576fed94d5',
+                'client_secret': os.environ.get('YANDEX_CLIENT_SECRET', ''),
+                'redirect_uri': redirect_uri
+            }, timeout=remaining)
+        except requests.RequestException as e:
+            print(f'>>> Yandex token attempt {attempt + 1} failed: {e}')
+            token_response = None
+            continue
+        if token_response.status_code < 500:
+            break
+    
+    if token_response is None or token_response.status_code >= 500:
+        raise RuntimeError('Yandex OAuth token endpoint unavailable')
+    
+    print(f'>>> Yandex token response: status={token_response.status_code}')
+    
+    if token_response.status_code != 200:
+        return {'error': f'Failed to exchange code for token: {token_response.text}'}
+    
+    access_token = token_response.json().get('access_token')
+    user_info_response = requests.get('https://login.yandex.ru/info',
+        headers={'Authorization': f'OAuth {access_token}'},
+        timeout=max(deadline - time.monotonic(), 0.5)
     )
-    cur.close()
+    
+    if user_info_response.status_code >= 500:
+        raise RuntimeError('Yandex user info endpoint unavailable')
+    if user_info_response.status_code != 200:
+        return {'error': 'Failed to get user info'}
+    
+    return {'user_info': user_info_response.json()}
+
 
+@instrumented_handler
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
@@ -171,10 +771,182 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return handle_bonus_users(event, headers)
     elif route == 'content':
         return handle_content(event, headers)
+    elif route == 'metrics':
+        return handle_metrics(event, headers)
+    elif route == 'duplicates':
+        return handle_duplicates(event, headers)
+    elif route == 'ledger':
+        return handle_ledger(event, headers)
     else:
         return handle_main(event, headers)
 
 
+def handle_ledger(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    '''
+    Журнал баланса (для админов): GET ?user_id= — баланс по журналу и последние записи,
+    GET action=reconcile [&full=1] — сверка users.balance с журналом, POST action=checkpoint — сдвинуть контрольные точки
+    '''
+    auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
+    if not auth_token or not verify_token(auth_token)['valid']:
+        return {
+            'statusCode': 401,
+            'headers': headers,
+            'body': json.dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+    
+    method = event.get('httpMethod', 'GET')
+    query_params = event.get('queryStringParameters') or {}
+    action = query_params.get('action', '')
+    conn = get_db_connection()
+    
+    try:
+        if method == 'POST' and action == 'checkpoint':
+            cur = conn.cursor()
+            updated = checkpoint_balances(cur)
+            conn.commit()
+            result = {'success': True, 'checkpoints_updated': updated}
+        elif action == 'reconcile':
+            result = {'success': True, **reconcile_balances(conn, full=query_params.get('full') in ('1', 'true'))}
+            conn.rollback()
+        elif query_params.get('user_id'):
+            user_id = int(query_params['user_id'])
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            balance = ledger_balances(cur, [user_id]).get(user_id, Money())
+            cur.execute("""
+                SELECT id, amount, entry_type, source_table, source_id, description, created_at
+                FROM t_p25272970_courier_button_site.balance_ledger
+                WHERE user_id = %s
+                ORDER BY id DESC
+                LIMIT 100
+            """, (user_id,))
+            entries = cur.fetchall()
+            cur.execute("SELECT COALESCE(balance, 0) as balance FROM t_p25272970_courier_button_site.users WHERE id = %s", (user_id,))
+            cached = cur.fetchone()
+            result = {
+                'success': True,
+                'user_id': user_id,
+                'balance': balance,
+                'cached_balance': cached['balance'] if cached else None,
+                'entries': entries
+            }
+        else:
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({'error': 'user_id or action required'}),
+                'isBase64Encoded': False
+            }
+    finally:
+        conn.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': json.dumps(convert_decimals(result), ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+
+def handle_duplicates(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    '''
+    Очередь вероятных дубликатов курьеров: GET — ждущие проверки пары, POST action=scan — запустить поиск,
+    POST action=dismiss {id} — пара не дубликат, POST action=merged {id} — объединены вручную
+    '''
+    auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
+    if not auth_token or not verify_token(auth_token)['valid']:
+        return {
+            'statusCode': 401,
+            'headers': headers,
+            'body': json.dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+    
+    method = event.get('httpMethod', 'GET')
+    action = (event.get('queryStringParameters') or {}).get('action', '')
+    conn = get_db_connection()
+    
+    try:
+        if method == 'POST' and action == 'scan':
+            result = run_duplicate_scan(conn)
+            log_activity(conn, 'duplicate_scan', f"Поиск дубликатов: {result['candidates']} пар среди {result['users']} курьеров", result)
+            conn.commit()
+            return {
+                'statusCode': 200,
+                'headers': headers,
+                'body': json.dumps({'success': True, **result}),
+                'isBase64Encoded': False
+            }
+        
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        
+        if method == 'POST' and action in ('dismiss', 'merged'):
+            body_data = json.loads(event.get('body') or '{}')
+            cur.execute("""
+                UPDATE t_p25272970_courier_button_site.user_duplicate_candidates
+                SET status = %s, resolved_at = NOW(), updated_at = NOW()
+                WHERE id = %s AND status = 'pending'
+            """, ('dismissed' if action == 'dismiss' else 'merged', body_data.get('id')))
+            updated = cur.rowcount
+            conn.commit()
+            return {
+                'statusCode': 200 if updated else 404,
+                'headers': headers,
+                'body': json.dumps({'success': bool(updated)}),
+                'isBase64Encoded': False
+            }
+        
+        cur.execute("""
+            SELECT d.id, d.score, d.reasons, d.source, d.keep_user_id, d.created_at,
+                   a.id as user_id, a.full_name as user_name, a.phone as user_phone, a.email as user_email,
+                   a.city as user_city, a.oauth_provider as user_provider, a.created_at as user_created_at,
+                   b.id as duplicate_user_id, b.full_name as duplicate_name, b.phone as duplicate_phone, b.email as duplicate_email,
+                   b.city as duplicate_city, b.oauth_provider as duplicate_provider, b.created_at as duplicate_created_at
+            FROM t_p25272970_courier_button_site.user_duplicate_candidates d
+            JOIN t_p25272970_courier_button_site.users a ON a.id = d.user_id
+            JOIN t_p25272970_courier_button_site.users b ON b.id = d.duplicate_user_id
+            WHERE d.status = 'pending'
+            ORDER BY d.score DESC, d.created_at DESC
+            LIMIT 500
+        """)
+        duplicates = [dict(item) for item in cur.fetchall()]
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({'success': True, 'duplicates': duplicates}, default=str, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+    finally:
+        conn.close()
+
+
+def handle_metrics(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    '''
+    Метрики тёплого контейнера: гистограммы задержек и счётчики запросов к БД по route/action,
+    состояние защиты исходящих вызовов
+    '''
+    auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
+    if not auth_token or not verify_token(auth_token)['valid']:
+        return {
+            'statusCode': 401,
+            'headers': headers,
+            'body': json.dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': json.dumps({
+            'success': True,
+            **get_route_metrics(),
+            'outbound': {'yandex_oauth': yandex_oauth_guard.snapshot()}
+        }),
+        'isBase64Encoded': False
+    }
+
+
 def handle_referrals(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     query_params = event.get('queryStringParameters') or {}
@@ -328,7 +1100,7 @@ def handle_couriers(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
 
 def get_all_couriers(headers: Dict[str, str]) -> Dict[str, Any]:
     print('>>> get_all_couriers вызвана')
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -408,7 +1180,7 @@ def update_courier(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     # Если указан реферальный код, проверяем и устанавливаем реферера
@@ -557,7 +1329,7 @@ def delete_courier(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     # Проверяем существование курьера и получаем telegram_id
@@ -594,22 +1366,19 @@ def delete_courier(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
     result = cur.fetchone()
     restore_until_formatted = result['restore_until'].strftime('%d.%m.%Y в %H:%M')
     
-    conn.commit()
-    
-    # Отправляем уведомление в Telegram (если есть telegram_id)
+    # Уведомление в Telegram уходит через outbox в той же транзакции (если есть telegram_id)
     if user.get('telegram_id'):
-        try:
-            message = f"""⚠️ <b>Ваш аккаунт был архивирован</b>
+        message = f"""⚠️ <b>Ваш аккаунт был архивирован</b>
 
 Ваш аккаунт курьера временно заморожен администратором.
 
 📅 <b>Окончательное удаление:</b> {restore_until_formatted}
 
 Если вы считаете, что это ошибка, свяжитесь с поддержкой до указанной даты для восстановления аккаунта."""
-            
-            send_telegram_notification(user['telegram_id'], message)
-        except Exception as e:
-            print(f'>>> WARNING: Не удалось отправить Telegram уведомление: {e}')
+        
+        enqueue_telegram_notification(cur, user['telegram_id'], message, 'courier_deleted')
+    
+    conn.commit()
     
     # Логируем удаление
     try:
@@ -651,7 +1420,7 @@ def restore_courier(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -719,7 +1488,7 @@ def restore_courier(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
 
 def permanent_delete_expired_couriers(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
     '''Окончательное удаление курьеров у которых истёк срок восстановления (14 дней)'''
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -776,7 +1545,7 @@ def permanent_delete_expired_couriers(event: Dict[str, Any], headers: Dict[str,
 
 
 def get_user_referral_stats(user_id: int, headers: Dict[str, str]) -> Dict[str, Any]:
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -821,15 +1590,8 @@ def get_user_referral_stats(user_id: int, headers: Dict[str, str]) -> Dict[str,
     total_bonus_earned = 0
     total_bonus_paid = 0
     
-    # Получаем баланс курьера
-    cur.execute("""
-        SELECT COALESCE(balance, 0) as balance
-        FROM t_p25272970_courier_button_site.users
-        WHERE id = %s
-    """, (user_id,))
-    
-    balance_row = cur.fetchone()
-    available = float(balance_row['balance'] or 0)
+    # Получаем баланс курьера по журналу (контрольная точка + хвост)
+    available = float(ledger_balances(cur, [user_id]).get(user_id, Money()))
     
     # Получаем информацию о выплатах (для статистики)
     cur.execute("""
@@ -885,7 +1647,7 @@ def get_user_referral_stats(user_id: int, headers: Dict[str, str]) -> Dict[str,
 
 
 def get_user_referral_progress(user_id: int, headers: Dict[str, str]) -> Dict[str, Any]:
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -923,7 +1685,7 @@ def get_user_referral_progress(user_id: int, headers: Dict[str, str]) -> Dict[st
 
 def get_dashboard_data(user_id: int, headers: Dict[str, str]) -> Dict[str, Any]:
     '''Получение всех данных дашборда одним запросом для оптимизации'''
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -1023,7 +1785,7 @@ def get_dashboard_data(user_id: int, headers: Dict[str, str]) -> Dict[str, Any]:
 
 
 def get_user_referrals_list(user_id: int, headers: Dict[str, str]) -> Dict[str, Any]:
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     # Упрощенный запрос без сложных подзапросов
@@ -1062,7 +1824,7 @@ def get_user_referrals_list(user_id: int, headers: Dict[str, str]) -> Dict[str,
 
 
 def get_admin_referral_stats(headers: Dict[str, str]) -> Dict[str, Any]:
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -1175,7 +1937,7 @@ def update_referral_orders(user_id: int, body: Dict[str, Any], headers: Dict[str
     orders_count = body.get('orders_count', 0)
     bonus_per_order = body.get('bonus_per_order', 50)
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -1227,7 +1989,7 @@ def set_inviter_code(user_id: int, body: Dict[str, Any], headers: Dict[str, str]
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -1349,7 +2111,7 @@ def check_referral_code(code: str, headers: Dict[str, str]) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -1429,7 +2191,7 @@ def handle_auth(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
         
         record_login_attempt(username)
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor()
         
         cur.execute("""
@@ -1522,7 +2284,7 @@ def handle_auth(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
         result = verify_token(auth_token)
         
         if result['valid']:
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
             user_id = result['user_id']
@@ -1634,7 +2396,7 @@ def handle_telegram_login(body_data: Dict[str, Any], headers: Dict[str, str]) ->
                 print(f'>>> Telegram signature verified successfully')
         
         # Подключаемся к БД
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
         # Ищем пользователя по telegram_id
@@ -1665,6 +2427,7 @@ def handle_telegram_login(body_data: Dict[str, Any], headers: Dict[str, str]) ->
             
             user = cur.fetchone()
             user_id = user['id']
+            flag_probable_duplicates(conn, cur, user_id)
             
             # Если указан реферальный код пригласителя
             if referral_code:
@@ -1752,44 +2515,31 @@ def handle_oauth_login(provider: str, body_data: Dict[str, Any], headers: Dict[s
         print(f'>>> OAuth Login: provider={provider}, code={code[:20] if code else None}..., redirect_uri={redirect_uri}')
         
         if provider == 'yandex':
-            # Обмен code на access_token
-            token_response = requests.post('https://oauth.yandex.ru/token', data={
-                'grant_type': 'authorization_code',
-                'code': code,
-                'client_id': '97aff4efd9cd4403854397576fed94d5',
-                'client_secret': os.environ.get('YANDEX_CLIENT_SECRET', ''),
-                'redirect_uri': redirect_uri
-            })
-            
-            print(f'>>> Yandex token response: status={token_response.status_code}')
+            # Обмен code на access_token и получение профиля через guard (дедлайн + single-flight + circuit breaker)
+            exchange = yandex_oauth_guard.call(
+                f'{code}|{redirect_uri}',
+                lambda timeout: exchange_yandex_oauth_code(code, redirect_uri, timeout),
+                None
+            )
             
-            if token_response.status_code != 200:
-                error_detail = token_response.text
-                print(f'>>> Yandex token error: {error_detail}')
+            if exchange is None:
                 return {
-                    'statusCode': 400,
+                    'statusCode': 503,
                     'headers': headers,
-                    'body': json.dumps({'success': False, 'error': f'Failed to exchange code for token: {error_detail}'}),
+                    'body': json.dumps({'success': False, 'error': 'Яндекс временно недоступен, попробуйте войти позже'}),
                     'isBase64Encoded': False
                 }
             
-            token_data = token_response.json()
-            access_token = token_data.get('access_token')
-            
-            # Получаем данные пользователя
-            user_info_response = requests.get('https://login.yandex.ru/info', 
-                headers={'Authorization': f'OAuth {access_token}'}
-            )
-            
-            if user_info_response.status_code != 200:
+            if exchange.get('error'):
+                print(f'>>> Yandex OAuth error: {exchange["error"]}')
                 return {
                     'statusCode': 400,
                     'headers': headers,
-                    'body': json.dumps({'success': False, 'error': 'Failed to get user info'}),
+                    'body': json.dumps({'success': False, 'error': exchange['error']}),
                     'isBase64Encoded': False
                 }
             
-            user_info = user_info_response.json()
+            user_info = exchange['user_info']
             
             print(f'>>> Yandex user info: {user_info}')
             
@@ -1820,7 +2570,7 @@ def handle_oauth_login(provider: str, body_data: Dict[str, Any], headers: Dict[s
         
         referral_code = body_data.get('referral_code')
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
     
         # Стратегия поиска существующего пользователя:
@@ -1900,15 +2650,15 @@ def handle_oauth_login(provider: str, body_data: Dict[str, Any], headers: Dict[s
                 conn.commit()
                 existing_user = email_user
         
-        # Шаг 3: Если не нашли по email, но есть телефон - ищем по телефону
-        if not existing_user and phone:
+        # Шаг 3: Если не нашли по email, но есть телефон - ищем по телефону (в E.164, формат записи не важен)
+        if not existing_user and normalize_phone(phone):
             cur.execute("""
                 SELECT id, full_name, email, phone, city, avatar_url, oauth_provider, referral_code, invited_by_user_id, oauth_id, archived_at
                 FROM t_p25272970_courier_button_site.users
-                WHERE phone = %s AND oauth_provider = %s AND archived_at IS NULL
+                WHERE phone_e164 = %s AND oauth_provider = %s AND archived_at IS NULL
                 ORDER BY created_at ASC
                 LIMIT 1
-            """, (phone, provider))
+            """, (normalize_phone(phone), provider))
             
             phone_user = cur.fetchone()
             
@@ -1969,6 +2719,7 @@ def handle_oauth_login(provider: str, body_data: Dict[str, Any], headers: Dict[s
             user_id = cur.fetchone()['id']
             
             log_activity(conn, 'courier_registered', f'Зарегистрирован новый курьер: {full_name or email}', {'user_id': user_id, 'provider': provider})
+            flag_probable_duplicates(conn, cur, user_id)
             
             if referral_code:
                 cur.execute("""
@@ -2089,7 +2840,7 @@ def handle_couriers(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
@@ -2186,7 +2937,6 @@ def handle_couriers(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
             """, (courier_id,))
             
             result = cur.fetchone()
-            conn.commit()
             
             restore_until_formatted = result['restore_until'].strftime('%d.%m.%Y в %H:%M')
             
@@ -2197,7 +2947,7 @@ def handle_couriers(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
                 'restore_until': result['restore_until'].isoformat()
             })
             
-            # Отправляем уведомление курьеру в Telegram (если привязан)
+            # Уведомление курьеру в Telegram (если привязан) — через outbox в той же транзакции
             cur.execute("""
                 SELECT messenger_user_id FROM t_p25272970_courier_button_site.messenger_connections
                 WHERE courier_id = %s AND messenger_type = 'telegram' AND is_verified = true
@@ -2213,7 +2963,9 @@ def handle_couriers(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
 
 Если вы считаете, что это ошибка, свяжитесь с поддержкой до указанной даты для восстановления аккаунта."""
                 
-                send_telegram_notification(telegram['messenger_user_id'], message)
+                enqueue_telegram_notification(cur, telegram['messenger_user_id'], message, 'courier_archived')
+            
+            conn.commit()
             
             return {
                 'statusCode': 200,
@@ -2274,7 +3026,7 @@ def handle_profile(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
     
     user_id = int(user_id_header)
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     query_params = event.get('queryStringParameters') or {}
@@ -2544,9 +3296,17 @@ def handle_profile(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
     }
 
 
-def _distribute_to_admins(admin_share_total: float, original_total: float, cur) -> list:
-    '''Распределяет деньги между админами пропорционально рекламным расходам'''
-    distributions = []
+def load_distribution_settings(cur) -> Dict[str, Any]:
+    '''
+    Всё, что нужно для распределения выплат, кроме прогресса самобонуса курьера:
+    настройки самобонуса из bot_content и админы с рекламными расходами
+    '''
+    cur.execute("""
+        SELECT self_bonus_amount, self_bonus_orders
+        FROM t_p25272970_courier_button_site.bot_content
+        LIMIT 1
+    """)
+    content_settings = cur.fetchone()
     
     cur.execute("""
         SELECT id, username, ad_spend_current 
@@ -2554,70 +3314,69 @@ def _distribute_to_admins(admin_share_total: float, original_total: float, cur)
         WHERE ad_spend_current > 0
         ORDER BY ad_spend_current DESC
     """)
+    admins_with_spend = [dict(admin) for admin in cur.fetchall()]
     
-    admins_with_spend = cur.fetchall()
+    cur.execute("SELECT COUNT(*) as admin_count FROM t_p25272970_courier_button_site.admins")
+    admin_count = cur.fetchone()['admin_count']
+    
+    return {
+        'self_bonus_limit': Money.of(content_settings['self_bonus_amount']) if content_settings and content_settings['self_bonus_amount'] else Money.of(5000),
+        'self_bonus_amount': Money.of(content_settings['self_bonus_amount']) if content_settings else Money.of(5000),
+        'self_bonus_orders': int(content_settings['self_bonus_orders']) if content_settings else 150,
+        'admins_with_spend': admins_with_spend,
+        'admin_count': admin_count
+    }
+
+
+def share_percentage(amount: Money, total: Money) -> float:
+    return amount.kopecks * 100.0 / total.kopecks if total.kopecks else 0.0
+
+
+def _distribute_to_admins(admin_share_total: Money, original_total: Money, settings: Dict[str, Any]) -> list:
+    '''Распределяет деньги между админами пропорционально рекламным расходам (доли в сумме — ровно admin_share_total)'''
+    distributions = []
+    admins_with_spend = settings['admins_with_spend']
     
     if admins_with_spend:
-        total_ad_spend = sum([float(a[2] or 0) for a in admins_with_spend])
+        spends = [Money.of(a['ad_spend_current']) for a in admins_with_spend]
+        total_ad_spend = sum(spends, Money())
         
-        for admin in admins_with_spend:
-            admin_id = admin[0]
-            admin_username = admin[1]
-            admin_ad_spend = float(admin[2] or 0)
-            
-            admin_amount = (admin_ad_spend / total_ad_spend) * admin_share_total
-            admin_percentage = (admin_amount / original_total) * 100.0
-            
+        for admin, admin_ad_spend, admin_amount in zip(admins_with_spend, spends, admin_share_total.allocate(spends)):
             distributions.append({
                 'recipient_type': 'admin',
-                'recipient_id': admin_id,
+                'recipient_id': admin['id'],
                 'amount': admin_amount,
-                'percentage': admin_percentage,
-                'description': f'Админ {admin_username} ({(admin_ad_spend/total_ad_spend)*100:.1f}% расходов)'
-            })
-    else:
-        cur.execute("SELECT COUNT(*) FROM t_p25272970_courier_button_site.admins")
-        admin_count = cur.fetchone()[0]
-        
-        if admin_count > 0:
-            distributions.append({
-                'recipient_type': 'admin',
-                'recipient_id': None,
-                'amount': admin_share_total,
-                'percentage': (admin_share_total / original_total) * 100.0,
-                'description': f'Распределение поровну между {admin_count} админами'
+                'percentage': share_percentage(admin_amount, original_total),
+                'description': f"Админ {admin['username']} ({share_percentage(admin_ad_spend, total_ad_spend):.1f}% расходов)"
             })
+    elif settings['admin_count'] > 0:
+        distributions.append({
+            'recipient_type': 'admin',
+            'recipient_id': None,
+            'amount': admin_share_total,
+            'percentage': share_percentage(admin_share_total, original_total),
+            'description': f"Распределение поровну между {settings['admin_count']} админами"
+        })
     
     return distributions
 
 
-def calculate_payment_distribution(total_amount: float, courier_id: int, referrer_id: int, self_bonus_completed: bool, cur) -> list:
+def plan_payment_distribution(total_amount: Money, courier_id: int, referrer_id: int, self_bonus_completed: bool,
+                              current_bonus: Money, settings: Dict[str, Any]) -> list:
     '''
-    Рассчитывает распределение выплат по правилам:
-    1. Курьер получает первые X₽ за Y заказов (самобонус из bot_content)
+    Распределение выплаты без обращений к БД (используется и при загрузке, и в dry_run):
+    1. Курьер получает первые X₽ (самобонус из bot_content) за вычетом уже заработанного current_bonus
     2. После самобонуса: рефереру 60%, админам 40% пропорционально рекламным расходам
     3. Если нет реферера: все курьеру до завершения самобонуса, потом админам
+    Суммы в Money: доли всех получателей в сумме дают ровно total_amount
     '''
     distributions = []
-    
-    # Получаем настройки самобонуса из базы
-    cur.execute("""
-        SELECT self_bonus_amount, self_bonus_orders
-        FROM t_p25272970_courier_button_site.bot_content
-        LIMIT 1
-    """)
-    content_settings = cur.fetchone()
-    self_bonus_limit = float(content_settings['self_bonus_amount']) if content_settings and content_settings['self_bonus_amount'] else 5000.0
+    total_amount = Money.of(total_amount)
+    current_bonus = Money.of(current_bonus)
+    self_bonus_limit = settings['self_bonus_limit']
     
     if not self_bonus_completed:
-        # Получаем текущий прогресс самобонуса
-        cur.execute("""
-            SELECT bonus_earned FROM t_p25272970_courier_button_site.courier_self_bonus_tracking
-            WHERE courier_id = %s
-        """, (courier_id,))
-        tracking = cur.fetchone()
-        current_bonus = float(tracking['bonus_earned']) if tracking else 0.0
-        remaining_bonus = max(0, self_bonus_limit - current_bonus)
+        remaining_bonus = max(Money(), self_bonus_limit - current_bonus)
         
         # Самобонус: только до лимита из базы
         self_bonus_amount = min(total_amount, remaining_bonus)
@@ -2628,243 +3387,1343 @@ def calculate_payment_distribution(total_amount: float, courier_id: int, referre
                 'recipient_type': 'courier_self',
                 'recipient_id': courier_id,
                 'amount': self_bonus_amount,
-                'percentage': (self_bonus_amount / total_amount) * 100.0,
+                'percentage': share_percentage(self_bonus_amount, total_amount),
                 'description': f'Самобонус ({current_bonus:.0f}₽ → {current_bonus + self_bonus_amount:.0f}₽ из {self_bonus_limit:.0f}₽)'
             })
         
         # Остаток распределяем: 60% рефереру, 40% админам
         if remaining_amount > 0:
             if referrer_id:
-                referrer_share = remaining_amount * 0.60
-                admin_share_total = remaining_amount * 0.40
+                referrer_share, admin_share = remaining_amount.allocate([60, 40])
                 
                 distributions.append({
                     'recipient_type': 'courier_referrer',
                     'recipient_id': referrer_id,
                     'amount': referrer_share,
-                    'percentage': (referrer_share / total_amount) * 100.0,
+                    'percentage': share_percentage(referrer_share, total_amount),
                     'description': 'Выплата рефереру (60% от остатка)'
                 })
-                
-                # Админам
-                admin_distributions = _distribute_to_admins(admin_share_total, total_amount, cur)
-                distributions.extend(admin_distributions)
+                distributions.extend(_distribute_to_admins(admin_share, total_amount, settings))
             else:
                 # Нет реферера - всё админам
-                admin_distributions = _distribute_to_admins(remaining_amount, total_amount, cur)
-                distributions.extend(admin_distributions)
+                distributions.extend(_distribute_to_admins(remaining_amount, total_amount, settings))
     elif referrer_id:
-        referrer_share = total_amount * 0.60
-        admin_share_total = total_amount * 0.40
-        
+        referrer_share, admin_share = total_amount.allocate([60, 40])
         distributions.append({
             'recipient_type': 'courier_referrer',
             'recipient_id': referrer_id,
             'amount': referrer_share,
-            'percentage': 60.0,
+            'percentage': share_percentage(referrer_share, total_amount),
             'description': 'Выплата рефереру (60%)'
         })
-        
-        # Получаем админов с рекламными расходами
-        cur.execute("""
-            SELECT id, username, ad_spend_current 
-            FROM t_p25272970_courier_button_site.admins 
-            WHERE ad_spend_current > 0
-            ORDER BY ad_spend_current DESC
-        """)
-        
-        admins_with_spend = cur.fetchall()
-        
-        if admins_with_spend:
-            total_ad_spend = sum([float(a[2] or 0) for a in admins_with_spend])
-            
-            # Распределяем пропорционально расходам
-            for admin in admins_with_spend:
-                admin_id = admin[0]
-                admin_username = admin[1]
-                admin_ad_spend = float(admin[2] or 0)
-                
-                admin_percentage = (admin_ad_spend / total_ad_spend) * 40.0
-                admin_amount = (admin_ad_spend / total_ad_spend) * admin_share_total
-                
-                distributions.append({
-                    'recipient_type': 'admin',
-                    'recipient_id': admin_id,
-                    'amount': admin_amount,
-                    'percentage': admin_percentage,
-                    'description': f'Админ {admin_username} ({admin_percentage:.1f}% от расходов)'
-                })
-        else:
-            # Если нет расходов, делим поровну
-            cur.execute("SELECT COUNT(*) FROM t_p25272970_courier_button_site.admins")
-            admin_count = cur.fetchone()[0]
-            
-            if admin_count > 0:
-                admin_share_each = admin_share_total / admin_count
-                distributions.append({
-                    'recipient_type': 'admin',
-                    'recipient_id': None,
-                    'amount': admin_share_total,
-                    'percentage': 40.0,
-                    'description': f'Распределение поровну между {admin_count} админами'
-                })
+        distributions.extend(_distribute_to_admins(admin_share, total_amount, settings))
     else:
         # Нет реферера - все админам
-        cur.execute("""
-            SELECT id, username, ad_spend_current 
-            FROM t_p25272970_courier_button_site.admins 
-            WHERE ad_spend_current > 0
-        """)
-        
-        admins_with_spend = cur.fetchall()
-        
-        if admins_with_spend:
-            total_ad_spend = sum([float(a[2] or 0) for a in admins_with_spend])
-            
-            for admin in admins_with_spend:
-                admin_id = admin[0]
-                admin_username = admin[1]
-                admin_ad_spend = float(admin[2] or 0)
-                
-                admin_percentage = (admin_ad_spend / total_ad_spend) * 100.0
-                admin_amount = (admin_ad_spend / total_ad_spend) * total_amount
-                
-                distributions.append({
-                    'recipient_type': 'admin',
-                    'recipient_id': admin_id,
-                    'amount': admin_amount,
-                    'percentage': admin_percentage,
-                    'description': f'Админ {admin_username} ({admin_percentage:.1f}% от расходов)'
-                })
-        else:
-            cur.execute("SELECT COUNT(*) FROM t_p25272970_courier_button_site.admins")
-            admin_count = cur.fetchone()[0]
-            
-            if admin_count > 0:
-                distributions.append({
-                    'recipient_type': 'admin',
-                    'recipient_id': None,
-                    'amount': total_amount,
-                    'percentage': 100.0,
-                    'description': f'Распределение поровну между {admin_count} админами (нет реферера)'
-                })
+        distributions.extend(_distribute_to_admins(total_amount, total_amount, settings))
     
     return distributions
 
 
-def handle_csv_upload(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
-    method = event.get('httpMethod', 'POST')
+def calculate_payment_distribution(total_amount: Money, courier_id: int, referrer_id: int, self_bonus_completed: bool, cur) -> list:
+    '''
+    Распределение выплаты по текущим настройкам и прогрессу самобонуса курьера в БД (см. plan_payment_distribution)
+    '''
+    settings = load_distribution_settings(cur)
+    current_bonus = Money()
     
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': headers,
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+    if not self_bonus_completed:
+        cur.execute("""
+            SELECT bonus_earned FROM t_p25272970_courier_button_site.courier_self_bonus_tracking
+            WHERE courier_id = %s
+        """, (courier_id,))
+        tracking = cur.fetchone()
+        current_bonus = Money.of(tracking['bonus_earned']) if tracking else Money()
     
-    auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
+    return plan_payment_distribution(total_amount, courier_id, referrer_id, self_bonus_completed, current_bonus, settings)
+
+
+def benchmark_activity_log(rows: int = 5000, events_per_row: int = 2) -> Dict[str, Any]:
+    """
+    Замер записи activity_log для загрузки CSV на rows строк (csv_payment_created + referrer_payment_allocated на строку):
+    построчные INSERT против буфера с одним INSERT при commit. Обе транзакции откатываются, таблица не меняется
+    """
+    events = [
+        (f'benchmark_{i % events_per_row}', f'Бенчмарк activity_log: событие {i}', json.dumps({'row': i // events_per_row}))
+        for i in range(rows * events_per_row)
+    ]
+    result = {'rows': rows, 'events': len(events)}
+    conn = get_db_connection()
+    cur = conn.cursor()
+
+    started = time.perf_counter()
+    for event in events:
+        cur.execute(
+            'INSERT INTO t_p25272970_courier_button_site.activity_log (event_type, message, data) VALUES (%s, %s, %s)',
+            event
+        )
+    result['per_row_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    result['per_row_statements'] = len(events)
+    conn.rollback()
+
+    started = time.perf_counter()
+    conn.activity_buffer.extend(events)
+    result['buffered_statements'] = 1 if conn.flush_activity() else 0
+    result['buffered_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    conn.rollback()
+
+    cur.close()
+    conn.close()
+    result['speedup'] = round(result['per_row_ms'] / result['buffered_ms'], 1) if result['buffered_ms'] else None
+    return result
+
+
+def benchmark_phone_lookup(users: int = 100000, lookups: int = 200) -> Dict[str, Any]:
+    """
+    Замер поиска по телефону на временной таблице из users строк в разных форматах записи:
+    phone LIKE '%1234' и phone = %s против индексов по phone_last4 и phone_e164 (как в V0101).
+    Транзакция откатывается, временная таблица исчезает вместе с ней
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    digits = "regexp_replace(phone, '\\D', '', 'g')"
+    cur.execute(f"""
+        CREATE TEMP TABLE phone_benchmark (
+            id SERIAL PRIMARY KEY,
+            phone VARCHAR(50),
+            phone_e164 VARCHAR(16) GENERATED ALWAYS AS (
+                CASE
+                    WHEN length({digits}) = 11 AND left({digits}, 1) = '8' THEN '+7' || substr({digits}, 2)
+                    WHEN length({digits}) = 10 THEN '+7' || {digits}
+                    WHEN length({digits}) BETWEEN 11 AND 15 THEN '+' || {digits}
+                END
+            ) STORED,
+            phone_last4 CHAR(4) GENERATED ALWAYS AS (
+                CASE WHEN length({digits}) >= 4 THEN right({digits}, 4) END
+            ) STORED
+        ) ON COMMIT DROP
+    """)
+    cur.execute("""
+        INSERT INTO phone_benchmark (phone)
+        SELECT CASE i % 3
+            WHEN 0 THEN '+7' || (9000000000 + i)::text
+            WHEN 1 THEN '8 (' || substr((9000000000 + i)::text, 1, 3) || ') ' || substr((9000000000 + i)::text, 4, 3) || '-' || right((9000000000 + i)::text, 4)
+            ELSE (9000000000 + i)::text
+        END
+        FROM generate_series(1, %s) i
+    """, (users,))
+    cur.execute('CREATE INDEX ON phone_benchmark(phone)')
+    cur.execute('CREATE INDEX ON phone_benchmark(phone_e164)')
+    cur.execute('CREATE INDEX ON phone_benchmark(phone_last4)')
+    cur.execute('ANALYZE phone_benchmark')
+    
+    rng = random.Random(42)
+    numbers = [str(9000000000 + rng.randint(1, users)) for _ in range(lookups)]
+    result = {'users': users, 'lookups': lookups}
+    
+    def timed(query, params) -> float:
+        started = time.perf_counter()
+        for value in params:
+            cur.execute(query, (value,))
+            cur.fetchall()
+        return round((time.perf_counter() - started) * 1000 / lookups, 3)
+    
+    result['last4_like_ms'] = timed('SELECT id FROM phone_benchmark WHERE phone LIKE %s', [f'%{n[-4:]}' for n in numbers])
+    result['last4_index_ms'] = timed('SELECT id FROM phone_benchmark WHERE phone_last4 = %s', [n[-4:] for n in numbers])
+    result['full_raw_ms'] = timed('SELECT id FROM phone_benchmark WHERE phone = %s', [f'+7{n}' for n in numbers])
+    result['full_e164_ms'] = timed('SELECT id FROM phone_benchmark WHERE phone_e164 = %s', [normalize_phone(f'8{n}') for n in numbers])
+    
+    conn.rollback()
+    cur.close()
+    conn.close()
+    result['last4_speedup'] = round(result['last4_like_ms'] / result['last4_index_ms'], 1) if result['last4_index_ms'] else None
+    return result
+
+
+def normalize_phone(phone: str):
+    '''
+    Телефон в E.164 — то же правило, что у вычисляемой колонки users.phone_e164 (V0101):
+    8XXXXXXXXXX и 10 цифр без кода страны считаются российскими. None, если цифр не хватает
+    '''
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    elif len(digits) == 10:
+        digits = '7' + digits
+    elif not 11 <= len(digits) <= 15:
+        return None
+    return '+' + digits
+
+
+def phone_last4(phone: str) -> str:
+    '''
+    Последние 4 цифры телефона без учёта форматирования (как users.phone_last4), пустая строка если цифр меньше
+    '''
+    digits = re.sub(r'\D', '', phone or '')
+    return digits[-4:] if len(digits) >= 4 else ''
+
+
+def parse_csv_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Разбор строки Leads CSV партнёрки: строки очищены, некорректные числа приводятся к 0
+    '''
+    external_id = row.get('external_id', '').strip()
+    creator_username = row.get('creator_username', '').strip().upper()
+    phone = row.get('phone', '').strip()
+    first_name = row.get('first_name', '').strip()
+    last_name = row.get('last_name', '').strip()
+    city = row.get('target_city', '').strip()
+    
+    # Безопасная конвертация чисел
+    try:
+        eats_order_number = int(row.get('eats_order_number', 0) or 0)
+    except (ValueError, TypeError):
+        eats_order_number = 0
     
-    if not auth_token:
-        return {
-            'statusCode': 401,
-            'headers': headers,
-            'body': json.dumps({'error': 'Unauthorized'}),
-            'isBase64Encoded': False
-        }
+    # Сумма сразу в копейки, без промежуточного float
+    reward_value = row.get('reward')
+    try:
+        reward = Money.of(reward_value.strip() if isinstance(reward_value, str) else reward_value)
+    except (InvalidOperation, ValueError, TypeError):
+        reward = Money()
     
-    token_data = verify_token(auth_token)
-    if not token_data['valid']:
-        return {
-            'statusCode': 401,
-            'headers': headers,
-            'body': json.dumps({'error': 'Invalid token'}),
-            'isBase64Encoded': False
-        }
+    status = row.get('status', 'active').strip()
     
-    body_data = json.loads(event.get('body', '{}'))
-    csv_rows = body_data.get('rows', [])
-    csv_filename = body_data.get('filename', '')
+    return {
+        'external_id': external_id,
+        'creator_username': creator_username,
+        'phone': phone,
+        'first_name': first_name,
+        'last_name': last_name,
+        'city': city,
+        'eats_order_number': eats_order_number,
+        'reward': reward,
+        'status': status
+    }
+
+
+def csv_row_hash(parsed: Dict[str, Any]) -> str:
+    '''
+    SHA-256 нормализованной строки CSV: одинаков для строк, отличающихся только пробелами и регистром кода курьера
+    '''
+    return hashlib.sha256(json.dumps(parsed, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+def csv_content_hash(row_hashes) -> str:
+    '''
+    Хэш файла по хэшам строк без учёта их порядка: сумма по модулю 2^256, считается за один проход
+    без хранения всех хэшей (потоковая загрузка больших файлов)
+    '''
+    total = 0
+    for row_hash in row_hashes:
+        total = (total + int(row_hash, 16)) % (1 << 256)
+    return f'{total:064x}'
+
+
+def save_csv_row_hashes(cur, row_hashes: Dict[str, str], batch_id: int = None):
+    '''
+    Запоминает хэши проведённых строк по external_id — в следующей загрузке такие строки пропускаются
+    '''
+    if not row_hashes:
+        return
+    
+    execute_values(cur, """
+        INSERT INTO t_p25272970_courier_button_site.csv_row_hashes (external_id, row_hash, batch_id)
+        VALUES %s
+        ON CONFLICT (external_id) DO UPDATE SET
+            row_hash = EXCLUDED.row_hash,
+            batch_id = EXCLUDED.batch_id,
+            updated_at = NOW()
+    """, [(external_id, row_hash, batch_id) for external_id, row_hash in row_hashes.items()])
+
+
+def apply_csv_row(conn, cur, parsed: Dict[str, Any], courier: Dict[str, Any], creator_username: str,
+                  csv_filename: str, csv_period_start, csv_period_end, batch_id: int = None) -> str:
+    '''
+    Проводит строку CSV по найденному курьеру: дельта к снапшоту, начисление, распределение выплат, самобонус.
+    Возвращает 'created' / 'updated' (к начислению курьера добавлена дельта) / 'duplicate' (новых данных нет)
+    '''
+    external_id = parsed['external_id']
+    phone = parsed['phone']
+    first_name = parsed['first_name']
+    last_name = parsed['last_name']
+    city = parsed['city']
+    eats_order_number = parsed['eats_order_number']
+    reward = Money.of(parsed['reward'])
+    status = parsed['status']
+    
+    courier_id = courier['id']
+    referrer_id = courier['invited_by_user_id']
+    referral_name = f"{first_name} {last_name}".strip()
+    
+    # Автоматически сохраняем external_id если ещё не сохранён
+    cur.execute("""
+        UPDATE t_p25272970_courier_button_site.users
+        SET external_id = %s, updated_at = NOW()
+        WHERE id = %s AND (external_id IS NULL OR external_id = '')
+    """, (external_id, courier_id))
     
-    if not csv_rows:
-        return {
-            'statusCode': 400,
-            'headers': headers,
-            'body': json.dumps({'error': 'No data provided'}),
-            'isBase64Encoded': False
-        }
+    # ВАРИАНТ А: Вычисляем дельту (разницу с предыдущей загрузкой)
+    cur.execute("""
+        SELECT last_known_amount, last_known_orders
+        FROM t_p25272970_courier_button_site.courier_earnings_snapshot
+        WHERE courier_id = %s AND external_id = %s
+    """, (courier_id, external_id))
     
-    # Парсим даты из имени файла (формат: Leads_2025-08-11-2025-10-10.csv)
-    import re
-    csv_period_start = None
-    csv_period_end = None
+    snapshot = cur.fetchone()
     
-    if csv_filename:
-        match = re.search(r'Leads_(\d{4}-\d{2}-\d{2})-(\d{4}-\d{2}-\d{2})', csv_filename)
-        if match:
-            csv_period_start = match.group(1)
-            csv_period_end = match.group(2)
+    if snapshot:
+        # Вычисляем дельту
+        delta_amount = reward - Money.of(snapshot['last_known_amount'])
+        delta_orders = eats_order_number - snapshot['last_known_orders']
+        
+        # Если дельта <= 0, значит это не новые данные или ошибка
+        if delta_amount <= 0:
+            return 'duplicate'
+        
+        actual_reward = delta_amount
+        actual_orders = delta_orders if delta_orders > 0 else 0
+    else:
+        # Первая загрузка для этого курьера
+        actual_reward = reward
+        actual_orders = eats_order_number
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    # Обновляем snapshot
+    cur.execute("""
+        INSERT INTO t_p25272970_courier_button_site.courier_earnings_snapshot
+        (courier_id, external_id, last_known_amount, last_known_orders, last_updated)
+        VALUES (%s, %s, %s, %s, NOW())
+        ON CONFLICT (courier_id, external_id) DO UPDATE SET
+            last_known_amount = %s,
+            last_known_orders = %s,
+            last_updated = NOW()
+    """, (courier_id, external_id, reward, eats_order_number, reward, eats_order_number))
     
-    processed = 0
-    skipped = 0
-    duplicates = 0
-    errors = []
-    unmatched = []
+    cur.execute("""
+        SELECT orders_completed, bonus_earned, is_completed
+        FROM t_p25272970_courier_button_site.courier_self_bonus_tracking
+        WHERE courier_id = %s
+    """, (courier_id,))
     
-    for row in csv_rows:
-        try:
-            external_id = row.get('external_id', '').strip()
-            creator_username = row.get('creator_username', '').strip().upper()
-            phone = row.get('phone', '').strip()
-            first_name = row.get('first_name', '').strip()
-            last_name = row.get('last_name', '').strip()
-            city = row.get('target_city', '').strip()
-            
-            # Безопасная конвертация чисел
-            try:
-                eats_order_number = int(row.get('eats_order_number', 0) or 0)
-            except (ValueError, TypeError):
-                eats_order_number = 0
-            
-            try:
-                reward_str = row.get('reward', '').strip()
-                reward = float(reward_str) if reward_str else 0.0
-            except (ValueError, TypeError):
-                reward = 0.0
-            
-            status = row.get('status', 'active').strip()
-            
-            if not external_id or not creator_username:
-                skipped += 1
-                errors.append(f"Пропущена строка: отсутствует ID или код курьера")
-                continue
-            
-            # Сначала ищем по external_id (если курьер уже был связан вручную)
+    self_bonus = cur.fetchone()
+    self_bonus_completed = False
+    
+    if self_bonus:
+        self_bonus_completed = self_bonus['is_completed']
+    else:
+        cur.execute("""
+            INSERT INTO t_p25272970_courier_button_site.courier_self_bonus_tracking
+            (courier_id, orders_completed, bonus_earned, is_completed)
+            VALUES (%s, 0, 0, FALSE)
+        """, (courier_id,))
+    
+    # Проверяем есть ли уже earning для этого курьера (по courier_id)
+    cur.execute("""
+        SELECT id FROM t_p25272970_courier_button_site.courier_earnings
+        WHERE courier_id = %s
+        ORDER BY created_at DESC
+        LIMIT 1
+    """, (courier_id,))
+    
+    existing_earning = cur.fetchone()
+    
+    if existing_earning:
+        # ОБНОВЛЯЕМ существующую запись: дельта добавляется к итогу начисления.
+        # Прежние распределения не трогаем — на них ссылаются записи balance_ledger, ниже добавляются строки дельты
+        earning_id = existing_earning['id']
+        
+        cur.execute("""
+            UPDATE t_p25272970_courier_button_site.courier_earnings
+            SET external_id = %s,
+                referrer_code = %s,
+                full_name = %s,
+                phone = %s,
+                city = %s,
+                orders_count = orders_count + %s,
+                total_amount = total_amount + %s,
+                csv_period_start = %s,
+                csv_period_end = %s,
+                csv_filename = %s,
+                batch_id = %s,
+                created_at = NOW()
+            WHERE id = %s
+        """, (external_id, creator_username, referral_name, phone, city, 
+              actual_orders, actual_reward, csv_period_start, csv_period_end, csv_filename, batch_id, earning_id))
+        
+        # Обновляем данные в users если нужно
+        cur.execute("""
+            UPDATE t_p25272970_courier_button_site.users
+            SET full_name = COALESCE(full_name, %s),
+                phone = COALESCE(phone, %s),
+                city = COALESCE(city, %s)
+            WHERE id = %s
+        """, (referral_name, phone, city, courier_id))
+        
+        outcome = 'updated'
+    else:
+        # СОЗДАЁМ новую запись (первая загрузка для курьера)
+        cur.execute("""
+            INSERT INTO t_p25272970_courier_button_site.courier_earnings
+            (courier_id, external_id, referrer_code, full_name, phone, city, 
+             orders_count, total_amount, status, csv_period_start, csv_period_end, csv_filename, batch_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending', %s, %s, %s, %s)
+            RETURNING id
+        """, (courier_id, external_id, creator_username, referral_name, phone, city, 
+              actual_orders, actual_reward, csv_period_start, csv_period_end, csv_filename, batch_id))
+        
+        earning_id = cur.fetchone()['id']
+        outcome = 'created'
+    
+    # Получаем имя курьера для логирования
+    cur.execute("""
+        SELECT full_name FROM t_p25272970_courier_button_site.users
+        WHERE id = %s
+    """, (courier_id,))
+    courier_name_result = cur.fetchone()
+    courier_name = courier_name_result['full_name'] if courier_name_result else f'ID {courier_id}'
+    
+    # Логируем начисление выплаты
+    log_activity(
+        conn,
+        'csv_payment_created',
+        f'Начислена выплата курьеру {courier_name}: {actual_reward}₽ ({actual_orders} заказов)',
+        {
+            'courier_id': courier_id,
+            'courier_name': courier_name,
+            'amount': float(actual_reward),
+            'orders': actual_orders,
+            'external_id': external_id,
+            'earning_id': earning_id
+        }
+    )
+    
+    distributions = calculate_payment_distribution(
+        actual_reward, courier_id, referrer_id, self_bonus_completed, cur
+    )
+    
+    balance_entries = []
+    for dist in distributions:
+        cur.execute("""
+            INSERT INTO t_p25272970_courier_button_site.payment_distributions
+            (earning_id, recipient_type, recipient_id, amount, percentage, description, payment_status, batch_id)
+            VALUES (%s, %s, %s, %s, %s, %s, 'pending', %s)
+            RETURNING id
+        """, (earning_id, dist['recipient_type'], dist['recipient_id'], 
+              dist['amount'], dist['percentage'], dist['description'], batch_id))
+        distribution_id = cur.fetchone()['id']
+        
+        # Начисляем деньги на баланс курьера (courier_self) или реферера (courier_referrer) — через журнал
+        if dist['recipient_type'] in ('courier_self', 'courier_referrer') and dist['recipient_id']:
+            balance_entries.append((dist['recipient_id'], dist['amount'], 'csv_distribution', 'payment_distributions',
+                                    distribution_id, dist['description']))
+        
+        # Логируем распределение выплаты
+        if dist['recipient_type'] == 'courier_referrer' and dist['recipient_id']:
             cur.execute("""
-                SELECT id, invited_by_user_id FROM t_p25272970_courier_button_site.users
-                WHERE external_id = %s
-            """, (external_id,))
+                SELECT full_name FROM t_p25272970_courier_button_site.users
+                WHERE id = %s
+            """, (dist['recipient_id'],))
+            referrer_result = cur.fetchone()
+            referrer_name = referrer_result['full_name'] if referrer_result else f"ID {dist['recipient_id']}"
+            
+            log_activity(
+                conn,
+                'referrer_payment_allocated',
+                f"Рефереру {referrer_name} начислено {dist['amount']:.2f}₽ (60%) за курьера {courier_name}",
+                {
+                    'referrer_id': dist['recipient_id'],
+                    'referrer_name': referrer_name,
+                    'courier_id': courier_id,
+                    'courier_name': courier_name,
+                    'amount': float(dist['amount']),
+                    'percentage': float(dist['percentage']),
+                    'earning_id': earning_id
+                }
+            )
+    
+    post_balance_entries(cur, balance_entries)
+    
+    if not self_bonus_completed:
+        # Получаем настройки самобонуса
+        cur.execute("""
+            SELECT self_bonus_amount, self_bonus_orders FROM t_p25272970_courier_button_site.bot_content LIMIT 1
+        """)
+        bonus_settings = cur.fetchone()
+        self_bonus_amount = Money.of(bonus_settings['self_bonus_amount']) if bonus_settings else Money.of(5000)
+        self_bonus_orders = int(bonus_settings['self_bonus_orders']) if bonus_settings else 150
+        
+        # Обновляем счётчики заказов
+        cur.execute("""
+            UPDATE t_p25272970_courier_button_site.courier_self_bonus_tracking
+            SET orders_completed = orders_completed + %s,
+                updated_at = NOW()
+            WHERE courier_id = %s
+            RETURNING orders_completed, is_completed
+        """, (actual_orders, courier_id))
+        
+        updated_tracking = cur.fetchone()
+        current_orders = int(updated_tracking['orders_completed']) if updated_tracking else 0
+        already_completed = updated_tracking['is_completed'] if updated_tracking else False
+        
+        # Проверяем достижение 150 заказов для начисления 5000₽
+        if current_orders >= self_bonus_orders and not already_completed:
+            # Начисляем 5000₽ на баланс курьера (один раз на курьера — источник в журнале уникален)
+            post_balance_entries(cur, [(courier_id, self_bonus_amount, 'self_bonus', 'courier_self_bonus_tracking',
+                                        courier_id, f'Самобонус за {current_orders} заказов')])
+            cur.execute("""
+                UPDATE t_p25272970_courier_button_site.users
+                SET self_bonus_paid = TRUE,
+                    updated_at = NOW()
+                WHERE id = %s
+            """, (courier_id,))
+            
+            # Отмечаем самобонус как завершённый
+            cur.execute("""
+                UPDATE t_p25272970_courier_button_site.courier_self_bonus_tracking
+                SET is_completed = TRUE,
+                    bonus_earned = %s,
+                    updated_at = NOW()
+                WHERE courier_id = %s
+            """, (self_bonus_amount, courier_id))
+            
+            log_activity(
+                conn,
+                'self_bonus_completed',
+                f'Курьер {courier_name} выполнил {current_orders} заказов! Начислено {self_bonus_amount:.0f}₽ на баланс',
+                {
+                    'courier_id': courier_id,
+                    'courier_name': courier_name,
+                    'bonus_amount': float(self_bonus_amount),
+                    'orders_completed': current_orders,
+                    'external_id': external_id
+                }
+            )
+        
+        # Проверяем достигли ли 30 заказов для стартовой выплаты
+        cur.execute("""
+            SELECT orders_completed FROM t_p25272970_courier_button_site.courier_self_bonus_tracking
+            WHERE courier_id = %s
+        """, (courier_id,))
+        
+        tracking = cur.fetchone()
+        if tracking and tracking['orders_completed'] >= 30:
+            # Отмечаем что курьер достиг 30 заказов и нужно уведомить
+            cur.execute("""
+                UPDATE t_p25272970_courier_button_site.users
+                SET startup_bonus_eligible_at = NOW(),
+                    startup_bonus_notified = FALSE
+                WHERE id = %s AND startup_bonus_eligible_at IS NULL
+            """, (courier_id,))
+    
+    cur.execute("""
+        INSERT INTO t_p25272970_courier_button_site.referral_progress
+        (courier_id, referral_phone, referral_name, external_id, orders_count, reward_amount, status, last_updated)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+        ON CONFLICT (external_id) DO UPDATE SET
+            orders_count = %s,
+            reward_amount = %s,
+            status = %s,
+            last_updated = NOW()
+    """, (courier_id, phone, referral_name, external_id, eats_order_number, reward, status,
+          eats_order_number, reward, status))
+    
+    return outcome
+
+
+def refresh_courier_earnings_stats(cur, courier_ids: list = None):
+    '''
+    Закрывает pending-начисления и пересчитывает итоги курьеров в users по courier_earnings и payment_distributions.
+    courier_ids — только эти курьеры (одна строка CSV: курьер и его реферер), иначе все с начислениями
+    '''
+    courier_ids = [courier_id for courier_id in courier_ids if courier_id] if courier_ids is not None else None
+    earnings_filter = 'courier_id = ANY(%(ids)s)' if courier_ids is not None else 'TRUE'
+    referrer_filter = 'recipient_id = ANY(%(ids)s)' if courier_ids is not None else 'TRUE'
+    
+    cur.execute(f"""
+        UPDATE t_p25272970_courier_button_site.courier_earnings
+        SET status = 'processed', processed_at = NOW()
+        WHERE status = 'pending' AND {earnings_filter}
+    """, {'ids': courier_ids})
+    
+    # Обновляем статистику курьеров: total_orders, total_earnings, referral_earnings — одним UPDATE для всех затронутых курьеров с начислениями
+    cur.execute(f"""
+        UPDATE t_p25272970_courier_button_site.users u
+        SET total_orders = stats.total_orders,
+            total_earnings = stats.total_earnings,
+            referral_earnings = stats.referral_earnings,
+            self_orders_count = stats.self_orders_count,
+            self_bonus_paid = stats.self_bonus_paid,
+            updated_at = NOW()
+        FROM (
+            SELECT 
+                e.courier_id,
+                COALESCE(e.total_orders, 0) as total_orders,
+                COALESCE(e.total_earnings, 0) as total_earnings,
+                COALESCE(r.referral_earnings, 0) as referral_earnings,
+                COALESCE(t.orders_completed, 0) as self_orders_count,
+                COALESCE(t.is_completed, FALSE) as self_bonus_paid
+            FROM (
+                SELECT courier_id, SUM(orders_count) as total_orders, SUM(total_amount) as total_earnings
+                FROM t_p25272970_courier_button_site.courier_earnings
+                WHERE {earnings_filter}
+                GROUP BY courier_id
+            ) e
+            LEFT JOIN (
+                SELECT recipient_id, SUM(amount) as referral_earnings
+                FROM t_p25272970_courier_button_site.payment_distributions
+                WHERE recipient_type = 'courier_referrer' AND {referrer_filter}
+                GROUP BY recipient_id
+            ) r ON r.recipient_id = e.courier_id
+            LEFT JOIN t_p25272970_courier_button_site.courier_self_bonus_tracking t ON t.courier_id = e.courier_id
+        ) stats
+        WHERE u.id = stats.courier_id
+    """, {'ids': courier_ids})
+
+
+def save_unmatched_csv_rows(cur, unmatched: list, unmatched_rows: Dict[str, Dict[str, Any]],
+                            csv_filename: str, csv_period_start, csv_period_end):
+    '''
+    Сохраняет несопоставленные строки CSV в очередь csv_unmatched_rows вместе с подсказками.
+    Строка, уже ждущая привязки, заменяется новой версией (суммы в CSV накопительные)
+    '''
+    if not unmatched:
+        return
+    
+    execute_values(cur, """
+        INSERT INTO t_p25272970_courier_button_site.csv_unmatched_rows
+        (external_id, row_data, suggested_couriers, csv_filename, csv_period_start, csv_period_end)
+        VALUES %s
+        ON CONFLICT (external_id) DO UPDATE SET
+            row_data = EXCLUDED.row_data,
+            suggested_couriers = EXCLUDED.suggested_couriers,
+            csv_filename = EXCLUDED.csv_filename,
+            csv_period_start = EXCLUDED.csv_period_start,
+            csv_period_end = EXCLUDED.csv_period_end,
+            status = 'pending',
+            error = NULL,
+            updated_at = NOW(),
+            resolved_at = NULL
+    """, [
+        (
+            item['external_id'],
+            json.dumps(unmatched_rows[item['external_id']], ensure_ascii=False),
+            json.dumps(convert_decimals(item['suggested_couriers']), ensure_ascii=False),
+            csv_filename,
+            csv_period_start,
+            csv_period_end
+        )
+        for item in {item['external_id']: item for item in unmatched}.values()
+    ])
+
+
+def resolve_matched_csv_rows(cur, external_ids: list):
+    '''
+    Строки из очереди, которые при повторной загрузке CSV сопоставились автоматически, больше не ждут привязки
+    '''
+    if not external_ids:
+        return
+    
+    cur.execute("""
+        UPDATE t_p25272970_courier_button_site.csv_unmatched_rows r
+        SET status = 'applied', courier_id = u.id, resolved_at = NOW(), updated_at = NOW()
+        FROM t_p25272970_courier_button_site.users u
+        WHERE u.external_id = r.external_id
+          AND r.external_id = ANY(%s)
+          AND r.status = 'pending'
+    """, (external_ids,))
+
+
+def apply_pending_csv_row(conn, courier_id: int, external_id: str) -> Dict[str, Any]:
+    '''
+    Проводит ждущую привязки строку CSV для только что связанного курьера тем же путём, что и загрузка CSV.
+    Вызывается после commit привязки: при ошибке строка остаётся в очереди с текстом ошибки
+    '''
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    cur.execute("""
+        SELECT id, row_data, csv_filename, csv_period_start, csv_period_end
+        FROM t_p25272970_courier_button_site.csv_unmatched_rows
+        WHERE external_id = %s AND status = 'pending'
+        FOR UPDATE
+    """, (external_id,))
+    pending = cur.fetchone()
+    
+    if not pending:
+        cur.close()
+        return {'applied': False}
+    
+    try:
+        cur.execute("""
+            SELECT id, invited_by_user_id, full_name FROM t_p25272970_courier_button_site.users
+            WHERE id = %s
+        """, (courier_id,))
+        courier = cur.fetchone()
+        
+        parsed = parse_csv_row(pending['row_data'])
+        outcome = apply_csv_row(
+            conn, cur, parsed, courier, parsed['creator_username'],
+            pending['csv_filename'], pending['csv_period_start'], pending['csv_period_end']
+        )
+        refresh_courier_earnings_stats(cur, [courier_id, courier['invited_by_user_id']])
+        save_csv_row_hashes(cur, {external_id: csv_row_hash(parsed)})
+        
+        cur.execute("""
+            UPDATE t_p25272970_courier_button_site.csv_unmatched_rows
+            SET status = 'applied', courier_id = %s, error = NULL, resolved_at = NOW(), updated_at = NOW()
+            WHERE id = %s
+        """, (courier_id, pending['id']))
+        
+        log_activity(
+            conn,
+            'csv_unmatched_applied',
+            f"Проведена отложенная строка CSV для курьера {courier['full_name']}: {parsed['reward']}₽",
+            {
+                'courier_id': courier_id,
+                'courier_name': courier['full_name'],
+                'external_id': external_id,
+                'amount': float(parsed['reward']),
+                'outcome': outcome
+            }
+        )
+        conn.commit()
+        return {'applied': outcome != 'duplicate', 'outcome': outcome, 'amount': float(parsed['reward'])}
+    except Exception as e:
+        conn.rollback()
+        cur.execute("""
+            UPDATE t_p25272970_courier_button_site.csv_unmatched_rows
+            SET error = %s, updated_at = NOW()
+            WHERE id = %s
+        """, (str(e), pending['id']))
+        conn.commit()
+        return {'applied': False, 'error': str(e)}
+    finally:
+        cur.close()
+
+
+def handle_csv_unmatched(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    '''
+    Очередь несопоставленных строк CSV: GET — ждущие привязки, DELETE ?external_id= — отклонить строку
+    '''
+    auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
+    if not auth_token or not verify_token(auth_token)['valid']:
+        return {
+            'statusCode': 401,
+            'headers': headers,
+            'body': json.dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+    
+    method = event.get('httpMethod', 'GET')
+    query_params = event.get('queryStringParameters') or {}
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    if method == 'DELETE':
+        external_id = (query_params.get('external_id') or '').strip()
+        cur.execute("""
+            UPDATE t_p25272970_courier_button_site.csv_unmatched_rows
+            SET status = 'dismissed', resolved_at = NOW(), updated_at = NOW()
+            WHERE external_id = %s AND status = 'pending'
+        """, (external_id,))
+        dismissed = cur.rowcount
+        conn.commit()
+        cur.close()
+        conn.close()
+        return {
+            'statusCode': 200 if dismissed else 404,
+            'headers': headers,
+            'body': json.dumps({'success': bool(dismissed)}),
+            'isBase64Encoded': False
+        }
+    
+    cur.execute("""
+        SELECT external_id, row_data, suggested_couriers, csv_filename, error, updated_at
+        FROM t_p25272970_courier_button_site.csv_unmatched_rows
+        WHERE status = 'pending'
+        ORDER BY updated_at DESC
+        LIMIT 500
+    """)
+    
+    unmatched = []
+    for item in cur.fetchall():
+        parsed = parse_csv_row(item['row_data'])
+        phone = parsed['phone']
+        unmatched.append({
+            'external_id': item['external_id'],
+            'full_name': f"{parsed['first_name']} {parsed['last_name']}".strip(),
+            'phone': phone,
+            'city': parsed['city'],
+            'last_4_digits': phone_last4(phone),
+            'reward': parsed['reward'],
+            'suggested_couriers': item['suggested_couriers'] or [],
+            'csv_filename': item['csv_filename'],
+            'error': item['error'],
+            'updated_at': item['updated_at']
+        })
+    
+    cur.close()
+    conn.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': json.dumps(convert_decimals({'success': True, 'unmatched': unmatched})),
+        'isBase64Encoded': False
+    }
+
+
+NAME_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c', 'ч': 'ch', 'ш': 'sh', 'щ': 'sh',
+    'ъ': '', 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'iu', 'я': 'ia'
+})
+
+# Латинские варианты написания, сводимые к той же форме, что и транслит кириллицы
+NAME_LATIN_FOLDS = (('shch', 'sh'), ('sch', 'sh'), ('kh', 'h'), ('ts', 'c'), ('tz', 'c'), ('ph', 'f'), ('w', 'v'), ('x', 'ks'), ('y', 'i'), ('j', 'i'))
+
+MATCH_NAME_THRESHOLD = 0.5
+
+
+def normalize_person_name(name: str) -> str:
+    '''
+    ФИО в одной латинской форме для нечёткого сравнения: ё→е, транслит кириллицы, свёртка вариантов
+    латиницы (Dmitriy / Dmitrii / Дмитрий → dmitri), без знаков и повторов букв
+    '''
+    normalized = (name or '').lower().translate(NAME_TRANSLIT)
+    for variant, canonical in NAME_LATIN_FOLDS:
+        normalized = normalized.replace(variant, canonical)
+    normalized = re.sub(r'[^a-z]+', ' ', normalized)
+    normalized = re.sub(r'(.)\1+', r'\1', normalized)
+    return ' '.join(normalized.split())
+
+
+def name_trigrams(normalized: str) -> set:
+    '''
+    Триграммы по словам, как в pg_trgm: слово дополняется двумя пробелами слева и одним справа,
+    поэтому порядок слов (Имя Фамилия / Фамилия Имя) не влияет на похожесть
+    '''
+    trigrams = set()
+    for word in normalized.split():
+        padded = f'  {word} '
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+class CourierSuggestionIndex:
+    '''
+    Триграммный индекс ФИО свободных курьеров для подсказок по несопоставленным строкам CSV.
+    Строится одним запросом на пачку строк, поиск идёт по инвертированному индексу в памяти
+    '''
+
+    def __init__(self, couriers: list):
+        self.couriers = [dict(courier) for courier in couriers]
+        self.trigrams = []
+        self.postings = {}
+        for position, courier in enumerate(self.couriers):
+            trigrams = name_trigrams(normalize_person_name(courier['full_name']))
+            self.trigrams.append(trigrams)
+            for trigram in trigrams:
+                self.postings.setdefault(trigram, []).append(position)
+
+    @classmethod
+    def load(cls, cur) -> 'CourierSuggestionIndex':
+        cur.execute("""
+            SELECT id, full_name, phone, city, referral_code
+            FROM t_p25272970_courier_button_site.users
+            WHERE is_active = true
+            AND (external_id IS NULL OR external_id = '')
+            AND full_name IS NOT NULL
+        """)
+        return cls(cur.fetchall())
+
+    def suggest(self, full_name: str, city: str, last_4_digits: str, limit: int = 5) -> list:
+        '''
+        Кандидаты с похожестью ФИО не ниже MATCH_NAME_THRESHOLD (Жаккар по триграммам),
+        итоговый балл: ФИО до 50, город 25, последние 4 цифры телефона 25
+        '''
+        query = name_trigrams(normalize_person_name(full_name))
+        if not query:
+            return []
+        
+        # Фильтр по префиксу: при похожести >= порога общих триграмм не меньше ceil(порог * |query|),
+        # значит кандидат обязан содержать хотя бы одну из самых редких |query| - ceil(порог * |query|) + 1
+        required = math.ceil(MATCH_NAME_THRESHOLD * len(query))
+        rarest = sorted(query, key=lambda trigram: len(self.postings.get(trigram, ())))[:len(query) - required + 1]
+        candidates = {position for trigram in rarest for position in self.postings.get(trigram, ())}
+        
+        suggestions = []
+        for position in candidates:
+            common = len(query & self.trigrams[position])
+            similarity = common / (len(query) + len(self.trigrams[position]) - common)
+            if similarity < MATCH_NAME_THRESHOLD:
+                continue
+            
+            courier = self.couriers[position]
+            score = similarity * 50
+            matches = [f'ФИО ({int(similarity * 100)}%)']
+            
+            if courier['city'] and city and courier['city'].lower() == city.lower():
+                score += 25
+                matches.append('Город')
+            
+            if last_4_digits and phone_last4(courier['phone']) == last_4_digits:
+                score += 25
+                matches.append('Телефон (4 цифры)')
+            
+            suggestions.append({**courier, 'match_score': int(score), 'matches': matches})
+        
+        suggestions.sort(key=lambda item: item['match_score'], reverse=True)
+        return suggestions[:limit]
+
+
+# Размеченные пары (ФИО из CSV, ФИО в профиле, один ли это человек) для benchmark_courier_matcher
+COURIER_MATCH_PAIRS = [
+    ('Иван Петров', 'Иван Петров', True),
+    ('Петров Иван', 'Иван Петров', True),
+    ('Ivan Petrov', 'Иван Петров', True),
+    ('Семён Фёдоров', 'Семен Федоров', True),
+    ('Dmitriy Kuznetsov', 'Дмитрий Кузнецов', True),
+    ('Dmitrii Kuznecov', 'Дмитрий Кузнецов', True),
+    ('Юлия Соколова', 'Yuliya Sokolova', True),
+    ('Алексей Смирнов', 'Алексей Смирнов Викторович', True),
+    ('Aleksandr Shcherbakov', 'Александр Щербаков', True),
+    ('Александр Щербаков', 'Aleksandr Sherbakov', True),
+    ('Евгений Хабибуллин', 'Evgeny Khabibullin', True),
+    ('Наталья Ким', 'Наталия Ким', True),
+    ('Sergej Volkov', 'Сергей Волков', True),
+    ('Ксения Журавлёва', 'Kseniya Zhuravleva', True),
+    ('Анна Иванова', 'Анна Ивановa', True),
+    ('Олег Зайцев', 'Zaitsev Oleg', True),
+    ('Иван Петров', 'Петр Иванов', False),
+    ('Иван Петров', 'Иван Сидоров', False),
+    ('Анна Иванова', 'Анна Смирнова', False),
+    ('Dmitriy Kuznetsov', 'Дмитрий Козлов', False),
+    ('Юлия Соколова', 'Юрий Соколов', False),
+    ('Алексей Смирнов', 'Александр Смирнов', False),
+    ('Ким Наталья', 'Ким Чен', False),
+    ('Олег Зайцев', 'Ольга Зайцева', False),
+]
+
+
+def benchmark_courier_matcher(pool_size: int = 20000, queries: int = 500) -> Dict[str, Any]:
+    '''
+    Точность и полнота подсказок на размеченных парах COURIER_MATCH_PAIRS (триграммы против прежнего
+    совпадения слов подстрокой) и скорость поиска по синтетической базе из pool_size курьеров. Без БД
+    '''
+    def word_overlap(csv_name: str, db_name: str) -> bool:
+        csv_parts = csv_name.lower().split()[:2]
+        db_parts = db_name.lower().split()
+        return any(
+            csv_part in db_part or db_part in csv_part
+            for csv_part in csv_parts
+            for db_part in db_parts
+            if len(csv_part) >= 3 and len(db_part) >= 3
+        )
+    
+    def trigram_match(csv_name: str, db_name: str) -> bool:
+        return bool(CourierSuggestionIndex([{'id': 1, 'full_name': db_name, 'phone': None, 'city': None, 'referral_code': None}]).suggest(csv_name, '', ''))
+    
+    def quality(predict) -> Dict[str, Any]:
+        tp = sum(1 for a, b, label in COURIER_MATCH_PAIRS if label and predict(a, b))
+        fp = sum(1 for a, b, label in COURIER_MATCH_PAIRS if not label and predict(a, b))
+        positives = sum(1 for _, _, label in COURIER_MATCH_PAIRS if label)
+        return {
+            'precision': round(tp / (tp + fp), 3) if tp + fp else None,
+            'recall': round(tp / positives, 3) if positives else None
+        }
+    
+    first_names = ['Иван', 'Алексей', 'Дмитрий', 'Сергей', 'Анна', 'Юлия', 'Ольга', 'Наталья', 'Евгений', 'Ксения', 'Михаил', 'Татьяна']
+    last_names = ['Петров', 'Смирнов', 'Кузнецов', 'Волков', 'Соколов', 'Федоров', 'Зайцев', 'Щербаков', 'Журавлев', 'Козлов', 'Новиков', 'Морозов']
+    rng = random.Random(42)
+    pool = [
+        {
+            'id': i,
+            'full_name': f'{rng.choice(first_names)} {rng.choice(last_names)}{rng.choice(["", "а", "ин", "ский"])}',
+            'phone': f'+7999{i:07d}',
+            'city': rng.choice(['Москва', 'Казань', 'Самара']),
+            'referral_code': f'BENCH{i}'
+        }
+        for i in range(pool_size)
+    ]
+    
+    started = time.perf_counter()
+    index = CourierSuggestionIndex(pool)
+    build_ms = (time.perf_counter() - started) * 1000
+    
+    started = time.perf_counter()
+    for i in range(queries):
+        courier = pool[rng.randrange(pool_size)]
+        index.suggest(normalize_person_name(courier['full_name']), courier['city'], courier['phone'][-4:])
+    search_ms = (time.perf_counter() - started) * 1000
+    
+    return {
+        'pairs': len(COURIER_MATCH_PAIRS),
+        'word_overlap': quality(word_overlap),
+        'trigram': quality(trigram_match),
+        'pool_size': pool_size,
+        'build_ms': round(build_ms, 1),
+        'search_ms_per_row': round(search_ms / queries, 3)
+    }
+
+
+DEDUP_MIN_SCORE = 45
+# Совпали только ФИО и город (телефон и email не совпадают или не у обоих) — однофамильцы не отличимы от дубликатов,
+# такая пара не дотягивает до DEDUP_MIN_SCORE
+DEDUP_NAME_ONLY_MAX_SCORE = 40
+DEDUP_MAX_BLOCK = 50
+
+
+def dedup_name_key(full_name: str):
+    '''
+    Ключ блокировки «похожее звучание»: первые два слова нормализованного ФИО без гласных после первой буквы,
+    в алфавитном порядке (Иван Петров / Petrov Ivan / Иван Петрова → ivn ptrv). None для пустого имени
+    '''
+    words = normalize_person_name(full_name).split()[:2]
+    if not words:
+        return None
+    return ' '.join(sorted(re.sub(r'(.)\1+', r'\1', word[0] + re.sub(r'[aeiou]', '', word[1:])) for word in words))
+
+
+def dedup_blocking_keys(user: Dict[str, Any]) -> list:
+    '''
+    Ключи, по которым пользователи попадают в один блок: телефон E.164, email, похожее ФИО + город
+    '''
+    keys = []
+    if user.get('phone_e164'):
+        keys.append(('phone', user['phone_e164']))
+    if user.get('email') and '@' in user['email']:
+        keys.append(('email', user['email'].strip().lower()))
+    if user.get('name_key') and user.get('city'):
+        keys.append(('name', user['name_key'], user['city'].strip().lower()))
+    return keys
+
+
+def score_duplicate_pair(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Оценка пары: телефон 50 (разные телефоны −25), email 50, похожесть ФИО по триграммам до 35, город 15.
+    Без совпадения телефона или email — не выше DEDUP_NAME_ONLY_MAX_SCORE. Оставить предлагается более старый аккаунт
+    '''
+    score = 0
+    reasons = []
+    contact_match = False
+    
+    if a.get('phone_e164') and a.get('phone_e164') == b.get('phone_e164'):
+        score += 50
+        contact_match = True
+        reasons.append('Телефон')
+    elif a.get('phone_e164') and b.get('phone_e164'):
+        # Разные телефоны у обоих — скорее однофамильцы
+        score -= 25
+    
+    if a.get('email') and b.get('email') and a['email'].strip().lower() == b['email'].strip().lower():
+        score += 50
+        contact_match = True
+        reasons.append('Email')
+    
+    name_a = name_trigrams(normalize_person_name(a.get('full_name')))
+    name_b = name_trigrams(normalize_person_name(b.get('full_name')))
+    if name_a and name_b:
+        similarity = len(name_a & name_b) / len(name_a | name_b)
+        if similarity >= MATCH_NAME_THRESHOLD:
+            score += similarity * 35
+            reasons.append(f'ФИО ({int(similarity * 100)}%)')
+    
+    if a.get('city') and b.get('city') and a['city'].strip().lower() == b['city'].strip().lower():
+        score += 15
+        reasons.append('Город')
+    
+    if a.get('oauth_provider') != b.get('oauth_provider'):
+        reasons.append(f"{a.get('oauth_provider') or '—'} / {b.get('oauth_provider') or '—'}")
+    
+    if not contact_match:
+        score = min(score, DEDUP_NAME_ONLY_MAX_SCORE)
+    
+    keep = min((a, b), key=lambda user: (user.get('created_at') or datetime.max, user['id']))
+    return {'score': max(min(int(score), 100), 0), 'reasons': reasons, 'keep_user_id': keep['id']}
+
+
+def find_duplicate_candidates(users: list) -> Dict[str, Any]:
+    '''
+    Пары вероятных дубликатов без сравнения всех со всеми: пары строятся только внутри блоков
+    с общим ключом (dedup_blocking_keys). Блоки больше DEDUP_MAX_BLOCK пропускаются — это не дубликаты,
+    а слишком общий ключ (например, одинаковые заглушки вместо телефона)
+    '''
+    blocks = {}
+    for user in users:
+        for key in dedup_blocking_keys(user):
+            blocks.setdefault(key, []).append(user)
+    
+    pairs = {}
+    skipped_blocks = 0
+    for members in blocks.values():
+        if len(members) < 2:
+            continue
+        if len(members) > DEDUP_MAX_BLOCK:
+            skipped_blocks += 1
+            continue
+        for i, a in enumerate(members):
+            for b in members[i + 1:]:
+                if a['id'] != b['id']:
+                    pairs[(min(a['id'], b['id']), max(a['id'], b['id']))] = (a, b)
+    
+    candidates = []
+    for (user_id, duplicate_user_id), (a, b) in pairs.items():
+        result = score_duplicate_pair(a, b)
+        if result['score'] >= DEDUP_MIN_SCORE:
+            candidates.append({'user_id': user_id, 'duplicate_user_id': duplicate_user_id, **result})
+    
+    return {
+        'blocks': sum(1 for members in blocks.values() if len(members) > 1),
+        'skipped_blocks': skipped_blocks,
+        'pairs_compared': len(pairs),
+        'candidates': candidates
+    }
+
+
+def save_duplicate_candidates(cur, candidates: list, source: str):
+    '''
+    Пишет пары в очередь проверки. Решённые админом пары (dismissed/merged) не возвращаются в очередь
+    '''
+    if not candidates:
+        return
+    
+    execute_values(cur, """
+        INSERT INTO t_p25272970_courier_button_site.user_duplicate_candidates
+        (user_id, duplicate_user_id, keep_user_id, score, reasons, source)
+        VALUES %s
+        ON CONFLICT (user_id, duplicate_user_id) DO UPDATE SET
+            keep_user_id = EXCLUDED.keep_user_id,
+            score = EXCLUDED.score,
+            reasons = EXCLUDED.reasons,
+            updated_at = NOW()
+        WHERE user_duplicate_candidates.status = 'pending'
+    """, [
+        (item['user_id'], item['duplicate_user_id'], item['keep_user_id'], item['score'],
+         json.dumps(item['reasons'], ensure_ascii=False), source)
+        for item in candidates
+    ])
+
+
+def run_duplicate_scan(conn) -> Dict[str, Any]:
+    '''
+    Задание поиска дубликатов по всем активным курьерам: пересчитывает name_key (он же заполняет
+    колонку для поиска при регистрации), строит блоки и пишет очередь проверки. Один проход по users
+    '''
+    started = time.perf_counter()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        SELECT id, full_name, email, phone_e164, city, oauth_provider, created_at, name_key
+        FROM t_p25272970_courier_button_site.users
+        WHERE archived_at IS NULL AND COALESCE(is_active, true) = true
+    """)
+    users = [dict(user) for user in cur.fetchall()]
+    
+    changed_keys = []
+    for user in users:
+        name_key = dedup_name_key(user['full_name'])
+        if name_key != user['name_key']:
+            changed_keys.append((user['id'], name_key))
+            user['name_key'] = name_key
+    
+    if changed_keys:
+        execute_values(cur, """
+            UPDATE t_p25272970_courier_button_site.users AS u
+            SET name_key = v.name_key
+            FROM (VALUES %s) AS v(id, name_key)
+            WHERE u.id = v.id
+        """, changed_keys, template='(%s, %s::varchar)')
+    
+    result = find_duplicate_candidates(users)
+    save_duplicate_candidates(cur, result['candidates'], 'scan')
+    conn.commit()
+    cur.close()
+    
+    return {
+        'users': len(users),
+        'name_keys_updated': len(changed_keys),
+        'blocks': result['blocks'],
+        'skipped_blocks': result['skipped_blocks'],
+        'pairs_compared': result['pairs_compared'],
+        'candidates': len(result['candidates']),
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+
+
+def flag_probable_duplicates(conn, cur, user_id: int) -> int:
+    '''
+    Проверка при регистрации: те же ключи блокировки, но через индексы users (phone_e164, LOWER(email), name_key).
+    Записывает name_key нового пользователя и найденные пары в очередь; регистрацию не блокирует
+    '''
+    cur.execute("""
+        SELECT id, full_name, email, phone_e164, city, oauth_provider, created_at
+        FROM t_p25272970_courier_button_site.users
+        WHERE id = %s
+    """, (user_id,))
+    user = cur.fetchone()
+    if not user:
+        return 0
+    user = dict(user)
+    user['name_key'] = dedup_name_key(user['full_name'])
+    
+    cur.execute("""
+        UPDATE t_p25272970_courier_button_site.users SET name_key = %s WHERE id = %s
+    """, (user['name_key'], user_id))
+    
+    email = user['email'].strip().lower() if user['email'] and '@' in user['email'] else None
+    cur.execute("""
+        SELECT id, full_name, email, phone_e164, city, oauth_provider, created_at
+        FROM t_p25272970_courier_button_site.users
+        WHERE id <> %s
+        AND archived_at IS NULL
+        AND (
+            phone_e164 = %s
+            OR LOWER(email) = %s
+            OR (name_key = %s AND LOWER(city) = LOWER(%s))
+        )
+        LIMIT %s
+    """, (user_id, user['phone_e164'], email, user['name_key'], user['city'], DEDUP_MAX_BLOCK))
+    
+    candidates = []
+    for other in cur.fetchall():
+        result = score_duplicate_pair(user, dict(other))
+        if result['score'] >= DEDUP_MIN_SCORE:
+            candidates.append({'user_id': min(user_id, other['id']), 'duplicate_user_id': max(user_id, other['id']), **result})
+    
+    save_duplicate_candidates(cur, candidates, 'registration')
+    if candidates:
+        log_activity(
+            conn,
+            'probable_duplicate_registered',
+            f"Новый курьер {user['full_name']} похож на уже зарегистрированных ({len(candidates)})",
+            {'user_id': user_id, 'candidates': [item['duplicate_user_id'] if item['user_id'] == user_id else item['user_id'] for item in candidates]}
+        )
+    return len(candidates)
+
+
+def benchmark_duplicate_scan(users: int = 100000, duplicate_share: float = 0.02) -> Dict[str, Any]:
+    '''
+    Скорость блокировки и оценки пар (find_duplicate_candidates) на синтетической базе с заданной долей
+    дубликатов: разные провайдеры, транслит и перестановка ФИО, другой формат телефона. Без БД
+    '''
+    first_names = ['Иван', 'Алексей', 'Дмитрий', 'Сергей', 'Анна', 'Юлия', 'Ольга', 'Наталья', 'Евгений', 'Ксения', 'Михаил', 'Татьяна']
+    syllables = ['ко', 'ва', 'ли', 'ре', 'су', 'мо', 'та', 'ни', 'ро', 'бе', 'за', 'гу']
+    cities = ['Москва', 'Казань', 'Самара', 'Пермь', 'Омск', 'Тула', 'Уфа', 'Сочи']
+    rng = random.Random(42)
+    
+    pool = []
+    for i in range(users):
+        last_name = ''.join(rng.choice(syllables) for _ in range(4)).capitalize() + 'ов'
+        pool.append({
+            'id': i + 1,
+            'full_name': f'{rng.choice(first_names)} {last_name}',
+            'email': f'courier{i}@example.com' if rng.random() < 0.5 else None,
+            'phone_e164': normalize_phone(f'8{9000000000 + i}') if rng.random() < 0.7 else None,
+            'city': rng.choice(cities),
+            'oauth_provider': 'yandex',
+            'created_at': datetime(2025, 1, 1) + timedelta(minutes=i)
+        })
+    
+    planted = int(users * duplicate_share)
+    origin = {}
+    for j in range(planted):
+        original = pool[rng.randrange(users)]
+        origin[users + j + 1] = original['id']
+        first, last = original['full_name'].split(' ', 1)
+        pool.append({
+            **original,
+            'id': users + j + 1,
+            'full_name': f'{last} {first}' if j % 2 else original['full_name'].lower().translate(NAME_TRANSLIT).title(),
+            'email': None,
+            'oauth_provider': 'telegram',
+            'created_at': original['created_at'] + timedelta(days=30)
+        })
+    
+    started = time.perf_counter()
+    for user in pool:
+        user['name_key'] = dedup_name_key(user['full_name'])
+    keys_ms = (time.perf_counter() - started) * 1000
+    
+    started = time.perf_counter()
+    result = find_duplicate_candidates(pool)
+    scan_ms = (time.perf_counter() - started) * 1000
+    
+    # Верная пара — аккаунты одного человека: исходный и его копия или две копии одного исходного
+    true_candidates = [
+        item for item in result['candidates']
+        if origin.get(item['user_id'], item['user_id']) == origin.get(item['duplicate_user_id'], item['duplicate_user_id'])
+    ]
+    found_planted = len({item['duplicate_user_id'] for item in true_candidates if item['duplicate_user_id'] in origin})
+    
+    return {
+        'users': len(pool),
+        'planted_duplicates': planted,
+        'found_planted': found_planted,
+        'candidates': len(result['candidates']),
+        'false_positives': len(result['candidates']) - len(true_candidates),
+        'precision': round(len(true_candidates) / len(result['candidates']), 3) if result['candidates'] else None,
+        'recall': round(found_planted / planted, 3) if planted else None,
+        'pairs_compared': result['pairs_compared'],
+        'all_pairs': len(pool) * (len(pool) - 1) // 2,
+        'name_keys_ms': round(keys_ms, 1),
+        'scan_ms': round(scan_ms, 1)
+    }
+
+
+def process_csv_rows(conn, cur, items: list, batch_id: int, csv_filename: str, csv_period_start, csv_period_end) -> Dict[str, Any]:
+    '''
+    Проводит строки CSV — кортежи (исходная строка, parse_csv_row, csv_row_hash): поиск курьера, начисление,
+    очередь несопоставленных, хэши проведённых строк. Каждая строка в своей точке сохранения.
+    Итоги курьеров не пересчитывает — refresh_courier_earnings_stats вызывается один раз в конце загрузки
+    '''
+    processed = 0
+    skipped = 0
+    duplicates = 0
+    errors = []
+    unmatched = []
+    unmatched_rows = {}
+    matched_external_ids = []
+    applied_row_hashes = {}
+    suggestion_index = None
+    
+    for row, parsed, row_hash in items:
+        cur.execute('SAVEPOINT csv_row')
+        activity_mark = len(conn.activity_buffer)
+        try:
+            external_id = parsed['external_id']
+            creator_username = parsed['creator_username']
+            phone = parsed['phone']
+            first_name = parsed['first_name']
+            last_name = parsed['last_name']
+            city = parsed['city']
+            
+            if not external_id or not creator_username:
+                skipped += 1
+                errors.append(f"Пропущена строка: отсутствует ID или код курьера")
+                continue
+            
+            # Сначала ищем по external_id (если курьер уже был связан вручную)
+            cur.execute("""
+                SELECT id, invited_by_user_id FROM t_p25272970_courier_button_site.users
+                WHERE external_id = %s
+            """, (external_id,))
             
             courier = cur.fetchone()
             
             # Если не нашли по external_id, ищем по ФИО, городу и последним 4 цифрам телефона
             if not courier:
                 referral_name = f"{first_name} {last_name}".strip()
-                last_4_digits = phone[-4:] if len(phone) >= 4 else ''
+                last_4_digits = phone_last4(phone)
                 
                 # УЛУЧШЕНО: Попытка 1 - точное совпадение ФИО + Город + Телефон
                 if last_4_digits:
                     cur.execute("""
                         SELECT id, invited_by_user_id, full_name, phone, city 
                         FROM t_p25272970_courier_button_site.users
-                        WHERE LOWER(full_name) = LOWER(%s)
+                        WHERE phone_last4 = %s
+                        AND LOWER(full_name) = LOWER(%s)
                         AND LOWER(city) = LOWER(%s)
-                        AND phone LIKE %s
                         LIMIT 1
-                    """, (referral_name, city, f'%{last_4_digits}'))
+                    """, (last_4_digits, referral_name, city))
                     courier = cur.fetchone()
                 
                 # УЛУЧШЕНО: Попытка 2 - точное совпадение ФИО + Город (БЕЗ телефона)
@@ -2879,7 +4738,7 @@ def handle_csv_upload(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
                     """, (referral_name, city))
                     courier = cur.fetchone()
                 
-                # УЛУЧШЕНО: Попытка 3 - транслитерация + город (для случаев Иван → Ivan)
+                # УЛУЧШЕНО: Попытка 3 - перевёрнутое ФИО + город (транслитерация — в подсказках ниже)
                 if not courier and first_name and last_name:
                     # Пробуем перевернуть имя и фамилию (в CSV может быть "Фамилия Имя")
                     reversed_name = f"{last_name} {first_name}".strip()
@@ -2894,95 +4753,12 @@ def handle_csv_upload(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
                     courier = cur.fetchone()
                 
                 if not courier:
-                    # Ищем похожих курьеров: ФИО должно быть похоже + город + последние 4 цифры
-                    name_parts = referral_name.split()
-                    first_name_csv = name_parts[0] if len(name_parts) > 0 else ''
-                    last_name_csv = name_parts[1] if len(name_parts) > 1 else ''
-                    
-                    # Получаем всех курьеров из того же города с похожими последними 4 цифрами
-                    # НО исключаем тех, кто уже привязан к другому external_id
-                    cur.execute("""
-                        SELECT id, full_name, phone, city, referral_code
-                        FROM t_p25272970_courier_button_site.users
-                        WHERE LOWER(city) = LOWER(%s)
-                        AND phone LIKE %s
-                        AND is_active = true
-                        AND (external_id IS NULL OR external_id = '')
-                    """, (city, f'%{last_4_digits}'))
-                    
-                    city_phone_matches = cur.fetchall()
-                    
-                    # Фильтруем по схожести имени (хотя бы одно слово должно совпадать)
-                    suggested_couriers = []
-                    for c in city_phone_matches:
-                        db_name_parts = c['full_name'].lower().split()
-                        csv_name_parts = [first_name_csv.lower(), last_name_csv.lower()]
-                        
-                        # Проверяем есть ли хотя бы одно совпадение в словах имени
-                        has_name_match = any(
-                            csv_part in db_part or db_part in csv_part 
-                            for csv_part in csv_name_parts 
-                            for db_part in db_name_parts
-                            if len(csv_part) >= 3 and len(db_part) >= 3
-                        )
-                        
-                        if has_name_match:
-                            suggested_couriers.append(c)
-                    
-                    # Если нет совпадений по городу+телефону+имени, ищем только по имени в любом городе
-                    if not suggested_couriers and (first_name_csv or last_name_csv):
-                        cur.execute("""
-                            SELECT id, full_name, phone, city, referral_code
-                            FROM t_p25272970_courier_button_site.users
-                            WHERE (
-                                LOWER(full_name) LIKE LOWER(%s)
-                                OR LOWER(full_name) LIKE LOWER(%s)
-                            )
-                            AND is_active = true
-                            AND (external_id IS NULL OR external_id = '')
-                            LIMIT 3
-                        """, (f'%{first_name_csv}%', f'%{last_name_csv}%'))
-                        
-                        suggested_couriers = cur.fetchall()
-                    
-                    # Добавляем степень совпадения для каждого предложенного курьера
-                    suggestions_with_score = []
-                    for c in suggested_couriers:
-                        score = 0
-                        matches = []
-                        
-                        # ФИО совпадение (до 50%)
-                        db_name_lower = c['full_name'].lower()
-                        csv_name_lower = referral_name.lower()
-                        if db_name_lower == csv_name_lower:
-                            score += 50
-                            matches.append('ФИО (100%)')
-                        else:
-                            name_words_match = sum(1 for word in csv_name_lower.split() if word in db_name_lower)
-                            if name_words_match > 0:
-                                name_score = (name_words_match / len(csv_name_lower.split())) * 50
-                                score += name_score
-                                matches.append(f'ФИО ({int(name_score * 2)}%)')
-                        
-                        # Город совпадение (25%)
-                        if c['city'] and c['city'].lower() == city.lower():
-                            score += 25
-                            matches.append('Город')
-                        
-                        # Телефон совпадение (25%)
-                        if c['phone'] and c['phone'].endswith(last_4_digits):
-                            score += 25
-                            matches.append('Телефон (4 цифры)')
-                        
-                        suggestions_with_score.append({
-                            **dict(c),
-                            'match_score': int(score),
-                            'matches': matches
-                        })
-                    
-                    # Сортируем по степени совпадения
-                    suggestions_with_score.sort(key=lambda x: x['match_score'], reverse=True)
+                    # Подсказки: триграммы ФИО (с транслитерацией) + город + последние 4 цифры телефона
+                    if suggestion_index is None:
+                        suggestion_index = CourierSuggestionIndex.load(cur)
+                    suggestions_with_score = suggestion_index.suggest(referral_name, city, last_4_digits)
                     
+                    unmatched_rows[external_id] = row
                     unmatched.append({
                         'external_id': external_id,
                         'full_name': referral_name,
@@ -2998,389 +4774,702 @@ def handle_csv_upload(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
                 else:
                     creator_username = f"AUTO_{courier['id']}"
             
-            courier_id = courier['id']
-            referrer_id = courier['invited_by_user_id']
-            referral_name = f"{first_name} {last_name}".strip()
-            
-            # Автоматически сохраняем external_id если ещё не сохранён
-            cur.execute("""
-                UPDATE t_p25272970_courier_button_site.users
-                SET external_id = %s, updated_at = NOW()
-                WHERE id = %s AND (external_id IS NULL OR external_id = '')
-            """, (external_id, courier_id))
-            
-            # ВАРИАНТ А: Вычисляем дельту (разницу с предыдущей загрузкой)
-            cur.execute("""
-                SELECT last_known_amount, last_known_orders
-                FROM t_p25272970_courier_button_site.courier_earnings_snapshot
-                WHERE courier_id = %s AND external_id = %s
-            """, (courier_id, external_id))
-            
-            snapshot = cur.fetchone()
+            outcome = apply_csv_row(conn, cur, parsed, courier, creator_username, csv_filename, csv_period_start, csv_period_end, batch_id)
+            matched_external_ids.append(external_id)
+            applied_row_hashes[external_id] = row_hash
             
-            if snapshot:
-                # Вычисляем дельту
-                delta_amount = reward - float(snapshot['last_known_amount'])
-                delta_orders = eats_order_number - snapshot['last_known_orders']
-                
-                # Если дельта <= 0, значит это не новые данные или ошибка
-                if delta_amount <= 0:
-                    duplicates += 1
-                    continue
-                    
-                actual_reward = delta_amount
-                actual_orders = delta_orders if delta_orders > 0 else 0
-            else:
-                # Первая загрузка для этого курьера
-                actual_reward = reward
-                actual_orders = eats_order_number
-            
-            # Обновляем snapshot
-            cur.execute("""
-                INSERT INTO t_p25272970_courier_button_site.courier_earnings_snapshot
-                (courier_id, external_id, last_known_amount, last_known_orders, last_updated)
-                VALUES (%s, %s, %s, %s, NOW())
-                ON CONFLICT (courier_id, external_id) DO UPDATE SET
-                    last_known_amount = %s,
-                    last_known_orders = %s,
-                    last_updated = NOW()
-            """, (courier_id, external_id, reward, eats_order_number, reward, eats_order_number))
-            
-            cur.execute("""
-                SELECT orders_completed, bonus_earned, is_completed
-                FROM t_p25272970_courier_button_site.courier_self_bonus_tracking
-                WHERE courier_id = %s
-            """, (courier_id,))
-            
-            self_bonus = cur.fetchone()
-            self_bonus_completed = False
-            
-            if self_bonus:
-                self_bonus_completed = self_bonus['is_completed']
-            else:
-                cur.execute("""
-                    INSERT INTO t_p25272970_courier_button_site.courier_self_bonus_tracking
-                    (courier_id, orders_completed, bonus_earned, is_completed)
-                    VALUES (%s, 0, 0, FALSE)
-                """, (courier_id,))
-            
-            # Проверяем есть ли уже earning для этого курьера (по courier_id)
-            cur.execute("""
-                SELECT id FROM t_p25272970_courier_button_site.courier_earnings
-                WHERE courier_id = %s
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (courier_id,))
-            
-            existing_earning = cur.fetchone()
-            
-            if existing_earning:
-                # ОБНОВЛЯЕМ существующую запись (финальная сумма из CSV)
-                earning_id = existing_earning['id']
-                
-                # Удаляем старые распределения
-                cur.execute("""
-                    DELETE FROM t_p25272970_courier_button_site.payment_distributions
-                    WHERE earning_id = %s
-                """, (earning_id,))
-                
-                # Обновляем earning с новыми данными
-                cur.execute("""
-                    UPDATE t_p25272970_courier_button_site.courier_earnings
-                    SET external_id = %s,
-                        referrer_code = %s,
-                        full_name = %s,
-                        phone = %s,
-                        city = %s,
-                        orders_count = %s,
-                        total_amount = %s,
-                        csv_period_start = %s,
-                        csv_period_end = %s,
-                        csv_filename = %s,
-                        created_at = NOW()
-                    WHERE id = %s
-                """, (external_id, creator_username, referral_name, phone, city, 
-                      actual_orders, actual_reward, csv_period_start, csv_period_end, csv_filename, earning_id))
-                
-                # Обновляем данные в users если нужно
-                cur.execute("""
-                    UPDATE t_p25272970_courier_button_site.users
-                    SET full_name = COALESCE(full_name, %s),
-                        phone = COALESCE(phone, %s),
-                        city = COALESCE(city, %s)
-                    WHERE id = %s
-                """, (referral_name, phone, city, courier_id))
-                
+            if outcome == 'duplicate':
+                duplicates += 1
+                continue
+            if outcome == 'updated':
                 duplicates += 1
-            else:
-                # СОЗДАЁМ новую запись (первая загрузка для курьера)
-                cur.execute("""
-                    INSERT INTO t_p25272970_courier_button_site.courier_earnings
-                    (courier_id, external_id, referrer_code, full_name, phone, city, 
-                     orders_count, total_amount, status, csv_period_start, csv_period_end, csv_filename)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending', %s, %s, %s)
-                    RETURNING id
-                """, (courier_id, external_id, creator_username, referral_name, phone, city, 
-                      actual_orders, actual_reward, csv_period_start, csv_period_end, csv_filename))
-                
-                earning_id = cur.fetchone()['id']
-            
-            # Получаем имя курьера для логирования
-            cur.execute("""
-                SELECT full_name FROM t_p25272970_courier_button_site.users
-                WHERE id = %s
-            """, (courier_id,))
-            courier_name_result = cur.fetchone()
-            courier_name = courier_name_result['full_name'] if courier_name_result else f'ID {courier_id}'
-            
-            # Логируем начисление выплаты
-            log_activity(
-                conn,
-                'csv_payment_created',
-                f'Начислена выплата курьеру {courier_name}: {actual_reward}₽ ({actual_orders} заказов)',
-                {
-                    'courier_id': courier_id,
-                    'courier_name': courier_name,
-                    'amount': float(actual_reward),
-                    'orders': actual_orders,
-                    'external_id': external_id,
-                    'earning_id': earning_id
-                }
-            )
             
-            distributions = calculate_payment_distribution(
-                actual_reward, courier_id, referrer_id, self_bonus_completed, cur
-            )
+            processed += 1
             
-            for dist in distributions:
-                cur.execute("""
-                    INSERT INTO t_p25272970_courier_button_site.payment_distributions
-                    (earning_id, recipient_type, recipient_id, amount, percentage, description, payment_status)
-                    VALUES (%s, %s, %s, %s, %s, %s, 'pending')
-                """, (earning_id, dist['recipient_type'], dist['recipient_id'], 
-                      dist['amount'], dist['percentage'], dist['description']))
-                
-                # Начисляем деньги на баланс курьера (courier_self) или реферера (courier_referrer)
-                if dist['recipient_type'] in ('courier_self', 'courier_referrer') and dist['recipient_id']:
-                    cur.execute("""
-                        UPDATE t_p25272970_courier_button_site.users
-                        SET balance = COALESCE(balance, 0) + %s, updated_at = NOW()
-                        WHERE id = %s
-                    """, (dist['amount'], dist['recipient_id']))
-                
-                # Логируем распределение выплаты
-                if dist['recipient_type'] == 'courier_referrer' and dist['recipient_id']:
-                    cur.execute("""
-                        SELECT full_name FROM t_p25272970_courier_button_site.users
-                        WHERE id = %s
-                    """, (dist['recipient_id'],))
-                    referrer_result = cur.fetchone()
-                    referrer_name = referrer_result['full_name'] if referrer_result else f"ID {dist['recipient_id']}"
-                    
-                    log_activity(
-                        conn,
-                        'referrer_payment_allocated',
-                        f"Рефереру {referrer_name} начислено {dist['amount']:.2f}₽ (60%) за курьера {courier_name}",
-                        {
-                            'referrer_id': dist['recipient_id'],
-                            'referrer_name': referrer_name,
-                            'courier_id': courier_id,
-                            'courier_name': courier_name,
-                            'amount': float(dist['amount']),
-                            'percentage': float(dist['percentage']),
-                            'earning_id': earning_id
-                        }
-                    )
+        except Exception as e:
+            # Откатываем только эту строку: остальные строки пачки проводятся дальше
+            cur.execute('ROLLBACK TO SAVEPOINT csv_row')
+            del conn.activity_buffer[activity_mark:]
+            errors.append(f"Ошибка обработки {parsed['external_id']}: {str(e)}")
+            skipped += 1
+        finally:
+            cur.execute('RELEASE SAVEPOINT csv_row')
+    
+    save_unmatched_csv_rows(cur, unmatched, unmatched_rows, csv_filename, csv_period_start, csv_period_end)
+    resolve_matched_csv_rows(cur, matched_external_ids)
+    save_csv_row_hashes(cur, applied_row_hashes, batch_id)
+    
+    return {
+        'processed': processed,
+        'skipped': skipped,
+        'duplicates': duplicates,
+        'matched': len(matched_external_ids),
+        'errors': errors,
+        'unmatched': unmatched
+    }
+
+
+CSV_CHUNK_SIZE = 500
+CSV_JOB_TIME_BUDGET = 20.0
+CSV_JOB_MAX_ERRORS = 100
+
+def parse_csv_period(csv_filename: str):
+    '''
+    Период выгрузки из имени файла партнёрки (формат: Leads_2025-08-11-2025-10-10.csv)
+    '''
+    match = re.search(r'Leads_(\d{4}-\d{2}-\d{2})-(\d{4}-\d{2}-\d{2})', csv_filename or '')
+    if not match:
+        return None, None
+    return match.group(1), match.group(2)
+
+
+def iter_csv_rows(payload: bytes):
+    '''
+    Генератор строк сырого CSV (в том числе gzip): распаковка, декодирование и разбор идут по мере чтения,
+    весь файл в виде списка строк в памяти не собирается
+    '''
+    stream = io.BytesIO(payload)
+    if payload[:2] == b'\x1f\x8b':
+        stream = gzip.GzipFile(fileobj=stream)
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    header = [name.strip() for name in next(reader, [])]
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        yield {name: (values[i].strip() if i < len(values) else '') for i, name in enumerate(header)}
+
+
+def iter_csv_items(payload: bytes, start: int = 0):
+    for row in islice(iter_csv_rows(payload), start, None):
+        parsed = parse_csv_row(row)
+        yield row, parsed, csv_row_hash(parsed)
+
+
+def filter_changed_csv_rows(cur, items: list) -> list:
+    '''
+    Отбрасывает строки, проведённые ранее в точно такой же версии (один запрос на пачку)
+    '''
+    cur.execute("""
+        SELECT external_id, row_hash FROM t_p25272970_courier_button_site.csv_row_hashes
+        WHERE external_id = ANY(%s)
+    """, (list({parsed['external_id'] for _, parsed, _ in items}),))
+    applied_hashes = {item['external_id']: item['row_hash'] for item in cur.fetchall()}
+    return [item for item in items if applied_hashes.get(item[1]['external_id']) != item[2]]
+
+
+def csv_job_progress(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'job_id': job['id'],
+        'batch_id': job['batch_id'],
+        'status': job['status'],
+        'rows_total': job['rows_total'],
+        'rows_done': job['rows_done'],
+        'processed': job['processed'],
+        'matched': job['matched'],
+        'unmatched': job['unmatched'],
+        'skipped': job['skipped'],
+        'duplicates': job['duplicates'],
+        'errors': job['errors'] or [],
+        'progress': round(job['rows_done'] * 100.0 / job['rows_total'], 1) if job['rows_total'] else 100.0
+    }
+
+
+def run_csv_job(conn, job_id: int, deadline: float) -> Dict[str, Any]:
+    '''
+    Продолжает потоковую загрузку с курсора rows_done: пачки по CSV_CHUNK_SIZE строк, commit после каждой.
+    Останавливается по deadline — следующий вызов (action=resume) продолжит с того же места
+    '''
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        SELECT * FROM t_p25272970_courier_button_site.csv_upload_jobs
+        WHERE id = %s
+        FOR UPDATE SKIP LOCKED
+    """, (job_id,))
+    job = cur.fetchone()
+    
+    if not job or job['status'] != 'running':
+        conn.rollback()
+        cur.close()
+        return job
+    
+    items = iter_csv_items(bytes(job['payload']), job['rows_done'])
+    
+    while True:
+        chunk = list(islice(items, CSV_CHUNK_SIZE))
+        if not chunk:
+            break
+        
+        changed = filter_changed_csv_rows(cur, chunk)
+        result = process_csv_rows(conn, cur, changed, job['batch_id'], job['filename'],
+                                  job['csv_period_start'], job['csv_period_end'])
+        errors = (job['errors'] or []) + result['errors']
+        
+        cur.execute("""
+            UPDATE t_p25272970_courier_button_site.csv_upload_jobs
+            SET rows_done = rows_done + %s,
+                processed = processed + %s,
+                matched = matched + %s,
+                unmatched = unmatched + %s,
+                skipped = skipped + %s,
+                duplicates = duplicates + %s,
+                errors = %s,
+                updated_at = NOW()
+            WHERE id = %s
+            RETURNING *
+        """, (len(chunk), result['processed'], result['matched'], len(result['unmatched']), result['skipped'],
+              result['duplicates'] + len(chunk) - len(changed), json.dumps(errors[:CSV_JOB_MAX_ERRORS], ensure_ascii=False), job_id))
+        job = cur.fetchone()
+        conn.commit()
+        
+        if time.monotonic() >= deadline:
+            cur.close()
+            return job
+        
+        # Блокировка снята commit'ом — берём её снова, чтобы параллельный resume не взял ту же пачку
+        cur.execute("""
+            SELECT id FROM t_p25272970_courier_button_site.csv_upload_jobs
+            WHERE id = %s AND status = 'running' AND rows_done = %s
+            FOR UPDATE SKIP LOCKED
+        """, (job_id, job['rows_done']))
+        if not cur.fetchone():
+            conn.rollback()
+            cur.close()
+            return job
+    
+    refresh_courier_earnings_stats(cur)
+    cur.execute("""
+        UPDATE t_p25272970_courier_button_site.upload_batches b
+        SET processed = j.processed, skipped = j.skipped, duplicates = j.duplicates,
+            content_hash = CASE WHEN j.skipped > 0 THEN NULL ELSE b.content_hash END,
+            total_amount = COALESCE((SELECT SUM(amount) FROM t_p25272970_courier_button_site.payment_distributions WHERE batch_id = b.id), 0),
+            courier_self_total = COALESCE((SELECT SUM(amount) FROM t_p25272970_courier_button_site.payment_distributions WHERE batch_id = b.id AND recipient_type = 'courier_self'), 0),
+            referrer_total = COALESCE((SELECT SUM(amount) FROM t_p25272970_courier_button_site.payment_distributions WHERE batch_id = b.id AND recipient_type = 'courier_referrer'), 0),
+            admin_total = COALESCE((SELECT SUM(amount) FROM t_p25272970_courier_button_site.payment_distributions WHERE batch_id = b.id AND recipient_type = 'admin'), 0)
+        FROM t_p25272970_courier_button_site.csv_upload_jobs j
+        WHERE j.id = %s AND b.id = j.batch_id
+        RETURNING b.total_amount
+    """, (job_id,))
+    total_amount = cur.fetchone()['total_amount']
+    cur.execute("""
+        UPDATE t_p25272970_courier_button_site.csv_upload_jobs
+        SET status = 'done', payload = ''::bytea, finished_at = NOW(), updated_at = NOW()
+        WHERE id = %s
+        RETURNING *
+    """, (job_id,))
+    job = cur.fetchone()
+    
+    log_activity(
+        conn,
+        'csv_uploaded',
+        f"Загружен CSV файл: обработано {job['processed']} записей на сумму {float(total_amount):.2f}₽",
+        {
+            'filename': job['filename'],
+            'batch_id': job['batch_id'],
+            'job_id': job_id,
+            'processed': job['processed'],
+            'skipped': job['skipped'],
+            'duplicates': job['duplicates'],
+            'unmatched': job['unmatched'],
+            'total_amount': float(total_amount)
+        }
+    )
+    conn.commit()
+    cur.close()
+    return job
+
+
+def handle_csv_stream(event: Dict[str, Any], headers: Dict[str, str], action: str) -> Dict[str, Any]:
+    '''
+    Потоковая загрузка CSV партнёрки:
+    POST ?route=csv&action=stream&filename=... — тело: сырой CSV или gzip (isBase64Encoded), обработка начинается сразу
+    POST ?route=csv&action=resume&job_id=... — продолжить загрузку, прерванную по времени
+    GET  ?route=csv&action=progress&job_id=... — строки обработаны / сопоставлены / не сопоставлены
+    '''
+    auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
+    token_data = verify_token(auth_token) if auth_token else {'valid': False}
+    if not token_data['valid']:
+        return {
+            'statusCode': 401,
+            'headers': headers,
+            'body': json.dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+    
+    deadline = time.monotonic() + CSV_JOB_TIME_BUDGET
+    query_params = event.get('queryStringParameters') or {}
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        if action == 'stream':
+            if event.get('httpMethod') != 'POST':
+                return {'statusCode': 405, 'headers': headers, 'body': json.dumps({'error': 'Method not allowed'}), 'isBase64Encoded': False}
             
-            if not self_bonus_completed:
-                # Получаем настройки самобонуса
-                cur.execute("""
-                    SELECT self_bonus_amount, self_bonus_orders FROM t_p25272970_courier_button_site.bot_content LIMIT 1
-                """)
-                bonus_settings = cur.fetchone()
-                self_bonus_amount = float(bonus_settings['self_bonus_amount']) if bonus_settings else 5000.0
-                self_bonus_orders = int(bonus_settings['self_bonus_orders']) if bonus_settings else 150
-                
-                # Обновляем счётчики заказов
-                cur.execute("""
-                    UPDATE t_p25272970_courier_button_site.courier_self_bonus_tracking
-                    SET orders_completed = orders_completed + %s,
-                        updated_at = NOW()
-                    WHERE courier_id = %s
-                    RETURNING orders_completed, is_completed
-                """, (actual_orders, courier_id))
-                
-                updated_tracking = cur.fetchone()
-                current_orders = int(updated_tracking['orders_completed']) if updated_tracking else 0
-                already_completed = updated_tracking['is_completed'] if updated_tracking else False
-                
-                # Проверяем достижение 150 заказов для начисления 5000₽
-                if current_orders >= self_bonus_orders and not already_completed:
-                    # Начисляем 5000₽ на баланс курьера
-                    cur.execute("""
-                        UPDATE t_p25272970_courier_button_site.users
-                        SET balance = COALESCE(balance, 0) + %s,
-                            self_bonus_paid = TRUE,
-                            updated_at = NOW()
-                        WHERE id = %s
-                    """, (self_bonus_amount, courier_id))
-                    
-                    # Отмечаем самобонус как завершённый
-                    cur.execute("""
-                        UPDATE t_p25272970_courier_button_site.courier_self_bonus_tracking
-                        SET is_completed = TRUE,
-                            bonus_earned = %s,
-                            updated_at = NOW()
-                        WHERE courier_id = %s
-                    """, (self_bonus_amount, courier_id))
-                    
-                    log_activity(
-                        conn,
-                        'self_bonus_completed',
-                        f'Курьер {courier_name} выполнил {current_orders} заказов! Начислено {self_bonus_amount:.0f}₽ на баланс',
-                        {
-                            'courier_id': courier_id,
-                            'courier_name': courier_name,
-                            'bonus_amount': float(self_bonus_amount),
-                            'orders_completed': current_orders,
-                            'external_id': external_id
-                        }
-                    )
-                
-                # Проверяем достигли ли 30 заказов для стартовой выплаты
-                cur.execute("""
-                    SELECT orders_completed FROM t_p25272970_courier_button_site.courier_self_bonus_tracking
-                    WHERE courier_id = %s
-                """, (courier_id,))
-                
-                tracking = cur.fetchone()
-                if tracking and tracking['orders_completed'] >= 30:
-                    # Отмечаем что курьер достиг 30 заказов и нужно уведомить
-                    cur.execute("""
-                        UPDATE t_p25272970_courier_button_site.users
-                        SET startup_bonus_eligible_at = NOW(),
-                            startup_bonus_notified = FALSE
-                        WHERE id = %s AND startup_bonus_eligible_at IS NULL
-                    """, (courier_id,))
+            body = event.get('body') or ''
+            payload = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode('utf-8')
+            if not payload:
+                return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'No data provided'}), 'isBase64Encoded': False}
+            
+            # Первый проход: число строк и хэш содержимого, без хранения строк
+            rows_total = 0
+            
+            def counted_hashes():
+                nonlocal rows_total
+                for _, _, row_hash in iter_csv_items(payload):
+                    rows_total += 1
+                    yield row_hash
+            
+            try:
+                content_hash = csv_content_hash(counted_hashes())
+            except (OSError, UnicodeDecodeError, csv.Error) as e:
+                return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': f'Некорректный CSV: {e}'}), 'isBase64Encoded': False}
+            
+            if not rows_total:
+                return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'No data provided'}), 'isBase64Encoded': False}
+            
+            filename = query_params.get('filename', '')
+            csv_period_start, csv_period_end = parse_csv_period(filename)
             
             cur.execute("""
-                INSERT INTO t_p25272970_courier_button_site.referral_progress
-                (courier_id, referral_phone, referral_name, external_id, orders_count, reward_amount, status, last_updated)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
-                ON CONFLICT (external_id) DO UPDATE SET
-                    orders_count = %s,
-                    reward_amount = %s,
-                    status = %s,
-                    last_updated = NOW()
-            """, (courier_id, phone, referral_name, external_id, eats_order_number, reward, status,
-                  eats_order_number, reward, status))
+                INSERT INTO t_p25272970_courier_button_site.upload_batches
+                (content_hash, filename, csv_period_start, csv_period_end, rows_total, rows_new, uploaded_by)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (content_hash) DO NOTHING
+                RETURNING id
+            """, (content_hash, filename, csv_period_start, csv_period_end, rows_total, rows_total, token_data.get('username')))
+            batch = cur.fetchone()
             
-            processed += 1
+            if not batch:
+                conn.rollback()
+                cur.execute("""
+                    SELECT b.id as batch_id, j.id as job_id
+                    FROM t_p25272970_courier_button_site.upload_batches b
+                    LEFT JOIN t_p25272970_courier_button_site.csv_upload_jobs j ON j.batch_id = b.id
+                    WHERE b.content_hash = %s
+                """, (content_hash,))
+                existing = cur.fetchone()
+                return {
+                    'statusCode': 200,
+                    'headers': headers,
+                    'body': json.dumps({'success': True, 'already_uploaded': True, **(existing or {})}),
+                    'isBase64Encoded': False
+                }
             
-        except Exception as e:
-            errors.append(f"Ошибка обработки {external_id}: {str(e)}")
-            skipped += 1
+            cur.execute("""
+                INSERT INTO t_p25272970_courier_button_site.csv_upload_jobs
+                (batch_id, filename, csv_period_start, csv_period_end, payload, rows_total)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id
+            """, (batch['id'], filename, csv_period_start, csv_period_end,
+                  psycopg2.Binary(payload if payload[:2] == b'\x1f\x8b' else gzip.compress(payload)), rows_total))
+            job_id = cur.fetchone()['id']
+            conn.commit()
+        else:
+            try:
+                job_id = int(query_params.get('job_id', ''))
+            except ValueError:
+                return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': 'job_id is required'}), 'isBase64Encoded': False}
+        
+        if action in ('stream', 'resume'):
+            run_csv_job(conn, job_id, deadline)
+        
+        cur.execute("""
+            SELECT id, batch_id, status, rows_total, rows_done, processed, matched, unmatched, skipped, duplicates, errors
+            FROM t_p25272970_courier_button_site.csv_upload_jobs
+            WHERE id = %s
+        """, (job_id,))
+        job = cur.fetchone()
+        
+        if not job:
+            return {'statusCode': 404, 'headers': headers, 'body': json.dumps({'error': 'Загрузка не найдена'}), 'isBase64Encoded': False}
+        
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps({'success': True, **csv_job_progress(job)}, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+    finally:
+        cur.close()
+        conn.close()
+
+
+def preview_csv_upload(conn, csv_rows: list, csv_filename: str) -> Dict[str, Any]:
+    '''
+    dry_run загрузки CSV: тот же расчёт, что и process_csv_rows + apply_csv_row, но в памяти по одному
+    согласованному снимку (REPEATABLE READ, только чтение). Число запросов не зависит от числа строк,
+    в БД ничего не пишется
+    '''
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    parsed_rows = [parse_csv_row(row) for row in csv_rows]
+    row_hashes = [csv_row_hash(parsed) for parsed in parsed_rows]
+    external_ids = list({parsed['external_id'] for parsed in parsed_rows if parsed['external_id']})
     
     cur.execute("""
-        UPDATE t_p25272970_courier_button_site.courier_earnings
-        SET status = 'processed', processed_at = NOW()
-        WHERE status = 'pending'
-    """)
+        SELECT id FROM t_p25272970_courier_button_site.upload_batches WHERE content_hash = %s
+    """, (csv_content_hash(row_hashes),))
+    existing_batch = cur.fetchone()
     
     cur.execute("""
-        SELECT 
-            u.id,
-            u.referral_code,
-            COALESCE(SUM(pd.amount), 0) as total_pending_payment,
-            COUNT(DISTINCT ce.id) as total_earnings_records
-        FROM t_p25272970_courier_button_site.users u
-        LEFT JOIN t_p25272970_courier_button_site.payment_distributions pd 
-            ON pd.recipient_id = u.id AND pd.recipient_type = 'courier_referrer' AND pd.payment_status = 'pending'
-        LEFT JOIN t_p25272970_courier_button_site.courier_earnings ce 
-            ON ce.courier_id = u.id
-        GROUP BY u.id, u.referral_code
-        HAVING COUNT(DISTINCT ce.id) > 0
-    """)
+        SELECT external_id, row_hash FROM t_p25272970_courier_button_site.csv_row_hashes
+        WHERE external_id = ANY(%s)
+    """, (external_ids,))
+    applied_hashes = {item['external_id']: item['row_hash'] for item in cur.fetchall()}
+    
+    # Кандидаты: по external_id и по ФИО (в обоих порядках) — два запроса на весь файл
+    names = set()
+    for parsed in parsed_rows:
+        names.add(f"{parsed['first_name']} {parsed['last_name']}".strip().lower())
+        names.add(f"{parsed['last_name']} {parsed['first_name']}".strip().lower())
+    cur.execute("""
+        SELECT id, invited_by_user_id, full_name, phone, city, external_id
+        FROM t_p25272970_courier_button_site.users
+        WHERE external_id = ANY(%s) OR LOWER(full_name) = ANY(%s)
+        ORDER BY id
+    """, (external_ids, list(names)))
+    users = {user['id']: dict(user) for user in cur.fetchall()}
+    
+    def find_courier(parsed):
+        external_id = parsed['external_id']
+        city = parsed['city'].lower()
+        phone = parsed['phone']
+        last_4_digits = phone_last4(phone)
+        referral_name = f"{parsed['first_name']} {parsed['last_name']}".strip().lower()
+        reversed_name = f"{parsed['last_name']} {parsed['first_name']}".strip().lower()
+        
+        for user in users.values():
+            if user['external_id'] == external_id:
+                return user, 'external_id'
+        same_city = [u for u in users.values() if (u['city'] or '').lower() == city]
+        unlinked = [u for u in same_city if not u['external_id']]
+        if last_4_digits:
+            for user in same_city:
+                if (user['full_name'] or '').lower() == referral_name and phone_last4(user['phone']) == last_4_digits:
+                    return user, 'name_city_phone'
+        for user in unlinked:
+            if (user['full_name'] or '').lower() == referral_name:
+                return user, 'name_city'
+        if parsed['first_name'] and parsed['last_name']:
+            for user in unlinked:
+                if (user['full_name'] or '').lower() == reversed_name:
+                    return user, 'reversed_name_city'
+        return None, None
+    
+    matches = []
+    for parsed, row_hash in zip(parsed_rows, row_hashes):
+        if not parsed['external_id'] or not parsed['creator_username']:
+            matches.append((None, None, 'skipped'))
+        elif applied_hashes.get(parsed['external_id']) == row_hash:
+            matches.append((None, None, 'unchanged'))
+        else:
+            courier, method = find_courier(parsed)
+            if courier and not courier['external_id']:
+                # Загрузка сохранила бы external_id — следующие строки файла ищут уже с ним
+                courier['external_id'] = parsed['external_id']
+            matches.append((courier, method, 'matched' if courier else 'unmatched'))
     
-    stats_by_courier = cur.fetchall()
+    courier_ids = list({courier['id'] for courier, _, _ in matches if courier})
     
-    # Обновляем статистику курьеров: total_orders, total_earnings, referral_earnings
     cur.execute("""
-        SELECT 
-            courier_id,
-            SUM(orders_count) as total_orders,
-            SUM(total_amount) as total_earnings
-        FROM t_p25272970_courier_button_site.courier_earnings
-        GROUP BY courier_id
-    """)
+        SELECT courier_id, external_id, last_known_amount, last_known_orders
+        FROM t_p25272970_courier_button_site.courier_earnings_snapshot
+        WHERE courier_id = ANY(%s)
+    """, (courier_ids,))
+    snapshots = {(item['courier_id'], item['external_id']): dict(item) for item in cur.fetchall()}
+    
+    cur.execute("""
+        SELECT courier_id, orders_completed, bonus_earned, is_completed
+        FROM t_p25272970_courier_button_site.courier_self_bonus_tracking
+        WHERE courier_id = ANY(%s)
+    """, (courier_ids,))
+    tracking = {item['courier_id']: dict(item) for item in cur.fetchall()}
+    
+    cur.execute("""
+        SELECT DISTINCT courier_id FROM t_p25272970_courier_button_site.courier_earnings
+        WHERE courier_id = ANY(%s)
+    """, (courier_ids,))
+    with_earnings = {item['courier_id'] for item in cur.fetchall()}
+    
+    recipient_ids = list(set(courier_ids) | {courier['invited_by_user_id'] for courier, _, _ in matches if courier and courier['invited_by_user_id']})
+    cur.execute("""
+        SELECT id, full_name, COALESCE(balance, 0) as balance
+        FROM t_p25272970_courier_button_site.users
+        WHERE id = ANY(%s)
+    """, (recipient_ids,))
+    balances = {item['id']: {'full_name': item['full_name'], 'before': Money.of(item['balance']), 'after': Money.of(item['balance'])} for item in cur.fetchall()}
     
-    earnings_stats = cur.fetchall()
+    settings = load_distribution_settings(cur)
+    suggestion_index = CourierSuggestionIndex.load(cur) if any(status == 'unmatched' for _, _, status in matches) else None
+    conn.rollback()
+    cur.close()
+    
+    summary = {
+        'rows': len(csv_rows), 'matched': 0, 'unmatched': 0, 'unchanged': 0, 'skipped': 0, 'duplicates': 0,
+        'created': 0, 'updated': 0, 'self_bonus_completions': 0,
+        'total_amount': Money(), 'courier_self': Money(), 'referrers': Money(), 'admins': Money()
+    }
+    rows = []
     
-    for stat in earnings_stats:
-        courier_id = stat['courier_id']
-        total_orders = int(stat['total_orders'] or 0)
-        total_earnings = float(stat['total_earnings'] or 0)
+    for parsed, (courier, method, status) in zip(parsed_rows, matches):
+        item = {'external_id': parsed['external_id'], 'status': status, 'reward': parsed['reward']}
+        rows.append(item)
         
-        # Получаем сумму выплат рефереру
-        cur.execute("""
-            SELECT COALESCE(SUM(amount), 0) as referral_earnings
-            FROM t_p25272970_courier_button_site.payment_distributions
-            WHERE recipient_id = %s AND recipient_type = 'courier_referrer'
-        """, (courier_id,))
-        ref_earnings = cur.fetchone()
-        referral_earnings = float(ref_earnings['referral_earnings'] or 0)
+        if status == 'unmatched':
+            item['suggested_couriers'] = suggestion_index.suggest(
+                f"{parsed['first_name']} {parsed['last_name']}".strip(), parsed['city'], phone_last4(parsed['phone'])
+            )
+        if status != 'matched':
+            summary[status] += 1
+            continue
+        
+        summary['matched'] += 1
+        courier_id = courier['id']
+        item.update({'courier_id': courier_id, 'courier_name': courier['full_name'], 'match_method': method})
+        
+        snapshot = snapshots.get((courier_id, parsed['external_id']))
+        if snapshot:
+            actual_reward = Money.of(parsed['reward']) - Money.of(snapshot['last_known_amount'])
+            actual_orders = max(parsed['eats_order_number'] - snapshot['last_known_orders'], 0)
+            item['previous_amount'] = Money.of(snapshot['last_known_amount'])
+            if actual_reward <= 0:
+                item['status'] = 'duplicate'
+                summary['duplicates'] += 1
+                continue
+        else:
+            actual_reward = Money.of(parsed['reward'])
+            actual_orders = parsed['eats_order_number']
+        snapshots[(courier_id, parsed['external_id'])] = {'last_known_amount': parsed['reward'], 'last_known_orders': parsed['eats_order_number']}
         
-        # Проверяем достиг ли курьер 30 заказов
-        cur.execute("""
-            SELECT orders_completed, is_completed 
-            FROM t_p25272970_courier_button_site.courier_self_bonus_tracking
-            WHERE courier_id = %s
-        """, (courier_id,))
-        bonus_tracking = cur.fetchone()
-        self_orders_count = int(bonus_tracking['orders_completed']) if bonus_tracking else 0
-        self_bonus_paid = bool(bonus_tracking['is_completed']) if bonus_tracking else False
+        bonus = tracking.setdefault(courier_id, {'orders_completed': 0, 'bonus_earned': 0, 'is_completed': False})
+        self_bonus_completed = bool(bonus['is_completed'])
         
-        cur.execute("""
-            UPDATE t_p25272970_courier_button_site.users
-            SET total_orders = %s,
-                total_earnings = %s,
-                referral_earnings = %s,
-                self_orders_count = %s,
-                self_bonus_paid = %s,
-                updated_at = NOW()
-            WHERE id = %s
-        """, (total_orders, total_earnings, referral_earnings, self_orders_count, self_bonus_paid, courier_id))
+        earning_action = 'updated' if courier_id in with_earnings else 'created'
+        with_earnings.add(courier_id)
+        summary[earning_action] += 1
+        
+        distributions = plan_payment_distribution(
+            actual_reward, courier_id, courier['invited_by_user_id'], self_bonus_completed,
+            Money.of(bonus['bonus_earned']) if not self_bonus_completed else Money(), settings
+        )
+        for dist in distributions:
+            if dist['recipient_type'] in ('courier_self', 'courier_referrer') and dist['recipient_id'] in balances:
+                balances[dist['recipient_id']]['after'] += dist['amount']
+            summary_key = {'courier_self': 'courier_self', 'courier_referrer': 'referrers', 'admin': 'admins'}[dist['recipient_type']]
+            summary[summary_key] += dist['amount']
+        
+        self_bonus_paid = False
+        if not self_bonus_completed:
+            bonus['orders_completed'] = int(bonus['orders_completed'] or 0) + actual_orders
+            if bonus['orders_completed'] >= settings['self_bonus_orders']:
+                bonus['is_completed'] = True
+                bonus['bonus_earned'] = settings['self_bonus_amount']
+                balances[courier_id]['after'] += settings['self_bonus_amount']
+                summary['self_bonus_completions'] += 1
+                self_bonus_paid = True
+        
+        summary['total_amount'] += actual_reward
+        item.update({
+            'delta_amount': actual_reward,
+            'delta_orders': actual_orders,
+            'earning': earning_action,
+            'distributions': distributions,
+            'self_bonus_completed': self_bonus_paid
+        })
     
-    conn.commit()
+    balance_changes = [
+        {'user_id': user_id, 'full_name': info['full_name'], 'before': info['before'], 'after': info['after'], 'delta': info['after'] - info['before']}
+        for user_id, info in balances.items()
+        if info['after'] != info['before']
+    ]
+    
+    return {
+        'already_uploaded': bool(existing_batch),
+        'summary': summary,
+        'rows': rows,
+        'balance_changes': sorted(balance_changes, key=lambda change: -change['delta'])
+    }
+
+
+def handle_csv_upload(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    method = event.get('httpMethod', 'POST')
+    action = (event.get('queryStringParameters') or {}).get('action', '')
+    
+    if action in ('stream', 'resume', 'progress'):
+        return handle_csv_stream(event, headers, action)
+    
+    if method in ('GET', 'DELETE'):
+        return handle_csv_unmatched(event, headers)
+    
+    if method != 'POST':
+        return {
+            'statusCode': 405,
+            'headers': headers,
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+    
+    auth_token = event.get('headers', {}).get('X-Auth-Token') or event.get('headers', {}).get('x-auth-token')
+    
+    if not auth_token:
+        return {
+            'statusCode': 401,
+            'headers': headers,
+            'body': json.dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+    
+    token_data = verify_token(auth_token)
+    if not token_data['valid']:
+        return {
+            'statusCode': 401,
+            'headers': headers,
+            'body': json.dumps({'error': 'Invalid token'}),
+            'isBase64Encoded': False
+        }
+    
+    body_data = json.loads(event.get('body', '{}'))
+    csv_rows = body_data.get('rows', [])
+    csv_filename = body_data.get('filename', '')
+    
+    if not csv_rows:
+        return {
+            'statusCode': 400,
+            'headers': headers,
+            'body': json.dumps({'error': 'No data provided'}),
+            'isBase64Encoded': False
+        }
     
+    if body_data.get('dry_run') or (event.get('queryStringParameters') or {}).get('dry_run') in ('1', 'true'):
+        conn = get_db_connection()
+        try:
+            preview = preview_csv_upload(conn, csv_rows, csv_filename)
+        finally:
+            conn.close()
+        metrics = getattr(_request_metrics, 'current', None)
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': json.dumps(convert_decimals({
+                'success': True,
+                'dry_run': True,
+                **preview,
+                'queries': metrics['queries'] if metrics else None
+            }), ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+    
+    csv_period_start, csv_period_end = parse_csv_period(csv_filename)
+    
+    parsed_rows = [parse_csv_row(row) for row in csv_rows]
+    row_hashes = [csv_row_hash(parsed) for parsed in parsed_rows]
+    content_hash = csv_content_hash(row_hashes)
+    
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    # Тот же файл уже загружали: ничего не пишем, отдаём итоги той загрузки
+    cur.execute("""
+        SELECT id, processed, skipped, duplicates, total_amount, courier_self_total, referrer_total, admin_total
+        FROM t_p25272970_courier_button_site.upload_batches
+        WHERE content_hash = %s
+    """, (content_hash,))
+    existing_batch = cur.fetchone()
+    
+    if existing_batch:
+        cur.close()
+        conn.close()
+        return csv_upload_response(headers, existing_batch['id'], 0, 0, len(csv_rows), [], [], existing_batch,
+                                   unchanged_rows=len(csv_rows), already_uploaded=True)
+    
+    # Строки, уже проведённые в точно такой же версии, пропускаются без запросов по строке
+    cur.execute("""
+        SELECT external_id, row_hash FROM t_p25272970_courier_button_site.csv_row_hashes
+        WHERE external_id = ANY(%s)
+    """, (list({parsed['external_id'] for parsed in parsed_rows}),))
+    applied_hashes = {item['external_id']: item['row_hash'] for item in cur.fetchall()}
+    
+    new_rows = [
+        (row, parsed, row_hash)
+        for row, parsed, row_hash in zip(csv_rows, parsed_rows, row_hashes)
+        if applied_hashes.get(parsed['external_id']) != row_hash
+    ]
+    unchanged_rows = len(csv_rows) - len(new_rows)
+    
+    if not new_rows:
+        cur.close()
+        conn.close()
+        return csv_upload_response(headers, None, 0, 0, unchanged_rows, [], [], {}, unchanged_rows=unchanged_rows)
+    
+    cur.execute("""
+        INSERT INTO t_p25272970_courier_button_site.upload_batches
+        (content_hash, filename, csv_period_start, csv_period_end, rows_total, rows_new, uploaded_by)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (content_hash) DO NOTHING
+        RETURNING id
+    """, (content_hash, csv_filename, csv_period_start, csv_period_end, len(csv_rows), len(new_rows), token_data.get('username')))
+    batch = cur.fetchone()
+    
+    if not batch:
+        # Этот же файл прямо сейчас загружается параллельным запросом
+        conn.rollback()
+        cur.close()
+        conn.close()
+        return csv_upload_response(headers, None, 0, 0, len(csv_rows), [], [], {},
+                                   unchanged_rows=len(csv_rows), already_uploaded=True)
+    
+    batch_id = batch['id']
+    result = process_csv_rows(conn, cur, new_rows, batch_id, csv_filename, csv_period_start, csv_period_end)
+    processed = result['processed']
+    skipped = result['skipped']
+    duplicates = unchanged_rows + result['duplicates']
+    errors = result['errors']
+    unmatched = result['unmatched']
+    refresh_courier_earnings_stats(cur)
+    
+    # Итоги ровно этой загрузки — по распределениям с batch_id: начисление курьера накопительное
+    # и переходит к последней загрузке, а распределения дельт в сумме дают ровно начисленное этой загрузкой
     cur.execute("""
         SELECT 
-            SUM(total_amount) as total_uploaded,
-            SUM(CASE WHEN recipient_type = 'courier_self' THEN amount ELSE 0 END) as courier_self_total,
-            SUM(CASE WHEN recipient_type = 'courier_referrer' THEN amount ELSE 0 END) as referrer_total,
-            SUM(CASE WHEN recipient_type = 'admin' THEN amount ELSE 0 END) as admin_total
-        FROM t_p25272970_courier_button_site.courier_earnings ce
-        LEFT JOIN t_p25272970_courier_button_site.payment_distributions pd ON pd.earning_id = ce.id
-        WHERE ce.upload_date >= NOW() - INTERVAL '5 minutes'
-    """)
+            COALESCE(SUM(amount), 0) as total_amount,
+            COALESCE(SUM(CASE WHEN recipient_type = 'courier_self' THEN amount ELSE 0 END), 0) as courier_self_total,
+            COALESCE(SUM(CASE WHEN recipient_type = 'courier_referrer' THEN amount ELSE 0 END), 0) as referrer_total,
+            COALESCE(SUM(CASE WHEN recipient_type = 'admin' THEN amount ELSE 0 END), 0) as admin_total
+        FROM t_p25272970_courier_button_site.payment_distributions
+        WHERE batch_id = %s
+    """, (batch_id,))
     
     summary = cur.fetchone()
     
+    # Строки с ошибками или пропущенные: хэш файла освобождается, чтобы повторная загрузка их переобработала
+    cur.execute("""
+        UPDATE t_p25272970_courier_button_site.upload_batches
+        SET processed = %s, skipped = %s, duplicates = %s,
+            total_amount = %s, courier_self_total = %s, referrer_total = %s, admin_total = %s,
+            content_hash = CASE WHEN %s > 0 THEN NULL ELSE content_hash END
+        WHERE id = %s
+    """, (processed, skipped, duplicates, summary['total_amount'], summary['courier_self_total'],
+          summary['referrer_total'], summary['admin_total'], skipped, batch_id))
+    
+    conn.commit()
+    
     # Логируем итоги загрузки CSV
     if processed > 0:
         log_activity(
             conn,
             'csv_uploaded',
-            f'Загружен CSV файл: обработано {processed} записей на сумму {float(summary["total_uploaded"] or 0):.2f}₽',
+            f'Загружен CSV файл: обработано {processed} записей на сумму {float(summary["total_amount"]):.2f}₽',
             {
                 'filename': csv_filename,
+                'batch_id': batch_id,
                 'processed': processed,
                 'skipped': skipped,
                 'duplicates': duplicates,
-                'total_amount': float(summary['total_uploaded'] or 0),
-                'courier_self': float(summary['courier_self_total'] or 0),
-                'referrers': float(summary['referrer_total'] or 0),
-                'admins': float(summary['admin_total'] or 0),
+                'total_amount': float(summary['total_amount']),
+                'courier_self': float(summary['courier_self_total']),
+                'referrers': float(summary['referrer_total']),
+                'admins': float(summary['admin_total']),
                 'period_start': csv_period_start,
                 'period_end': csv_period_end
             }
@@ -3390,21 +5479,31 @@ def handle_csv_upload(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
     cur.close()
     conn.close()
     
+    return csv_upload_response(headers, batch_id, processed, skipped, duplicates, errors, unmatched, summary,
+                               unchanged_rows=unchanged_rows)
+
+
+def csv_upload_response(headers: Dict[str, str], batch_id, processed: int, skipped: int, duplicates: int,
+                        errors: list, unmatched: list, summary: Dict[str, Any],
+                        unchanged_rows: int = 0, already_uploaded: bool = False) -> Dict[str, Any]:
     return {
         'statusCode': 200,
         'headers': headers,
         'body': json.dumps(convert_decimals({
             'success': True,
+            'batch_id': batch_id,
+            'already_uploaded': already_uploaded,
             'processed': processed,
             'skipped': skipped,
             'duplicates': duplicates,
+            'unchanged_rows': unchanged_rows,
             'errors': errors,
             'unmatched': unmatched if unmatched else None,
             'summary': {
-                'total_amount': float(summary['total_uploaded'] or 0),
-                'courier_self': float(summary['courier_self_total'] or 0),
-                'referrers': float(summary['referrer_total'] or 0),
-                'admins': float(summary['admin_total'] or 0)
+                'total_amount': float(summary.get('total_amount') or 0),
+                'courier_self': float(summary.get('courier_self_total') or 0),
+                'referrers': float(summary.get('referrer_total') or 0),
+                'admins': float(summary.get('admin_total') or 0)
             }
         })),
         'isBase64Encoded': False
@@ -3456,7 +5555,7 @@ def handle_link_courier(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     # Проверка 1: не занят ли этот external_id другим курьером
@@ -3509,12 +5608,14 @@ def handle_link_courier(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[
     
     conn.commit()
     cur.close()
+    
+    pending_row = apply_pending_csv_row(conn, courier_id, external_id)
     conn.close()
     
     return {
         'statusCode': 200,
         'headers': headers,
-        'body': json.dumps({'success': True, 'message': 'Курьер успешно связан с external_id'}),
+        'body': json.dumps({'success': True, 'message': 'Курьер успешно связан с external_id', 'pending_row': pending_row}),
         'isBase64Encoded': False
     }
 
@@ -3564,7 +5665,7 @@ def handle_update_external_id(event: Dict[str, Any], headers: Dict[str, str]) ->
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     # Если new_external_id пустой, то просто очищаем
@@ -3629,12 +5730,18 @@ def handle_update_external_id(event: Dict[str, Any], headers: Dict[str, str]) ->
     
     conn.commit()
     cur.close()
+    
+    pending_row = apply_pending_csv_row(conn, courier_id, new_external_id)
     conn.close()
     
     return {
         'statusCode': 200,
         'headers': headers,
-        'body': json.dumps({'success': True, 'message': f'External ID обновлён для {updated["full_name"]}'}),
+        'body': json.dumps({
+            'success': True,
+            'message': f'External ID обновлён для {updated["full_name"]}',
+            'pending_row': pending_row
+        }),
         'isBase64Encoded': False
     }
 
@@ -3666,7 +5773,7 @@ def handle_payments(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     if action == 'stats':
@@ -3843,7 +5950,7 @@ def handle_payments(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
         query = f"""
             UPDATE t_p25272970_courier_button_site.payment_distributions
             SET payment_status = 'paid', paid_at = NOW()
-            WHERE earning_id IN ({placeholders})
+            WHERE earning_id IN ({placeholders}) AND payment_status <> 'paid'
         """
         cur.execute(query, tuple(earning_ids))
         
@@ -3892,7 +5999,7 @@ def handle_withdrawal(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
         user_id = int(user_id_header)
         body_data = json.loads(event.get('body', '{}'))
         
-        amount = float(body_data.get('amount', 0))
+        amount = Money.of(body_data.get('amount', 0))
         sbp_phone = body_data.get('sbp_phone', '').strip()
         sbp_bank_name = body_data.get('sbp_bank_name', '').strip()
         
@@ -3912,20 +6019,43 @@ def handle_withdrawal(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        # Проверяем текущий баланс курьера
-        cur.execute("""
-            SELECT COALESCE(balance, 0) as balance
-            FROM t_p25272970_courier_button_site.users
-            WHERE id = %s
-        """, (user_id,))
+        # Одним запросом: списание только при достаточном балансе, реквизиты СБП в профиль, заявка и запись журнала.
+        # Между проверкой и списанием нет окна — параллельные заявки не уводят баланс в минус
+        cur.execute(f"""
+            WITH debit AS (
+                UPDATE {USERS_TABLE}
+                SET balance = balance - %(amount)s,
+                    sbp_phone = %(sbp_phone)s,
+                    sbp_bank_name = %(sbp_bank_name)s,
+                    updated_at = NOW()
+                WHERE id = %(user_id)s AND balance >= %(amount)s
+                RETURNING id
+            ), request AS (
+                INSERT INTO t_p25272970_courier_button_site.withdrawal_requests
+                (courier_id, amount, sbp_phone, sbp_bank_name, status, created_at)
+                SELECT id, %(amount)s, %(sbp_phone)s, %(sbp_bank_name)s, 'pending', NOW() FROM debit
+                RETURNING id, courier_id
+            ), entry AS (
+                INSERT INTO {LEDGER_TABLE} (user_id, amount, entry_type, source_table, source_id, description)
+                SELECT courier_id, 0 - %(amount)s, 'withdrawal', 'withdrawal_requests', id, 'Заявка на вывод' FROM request
+            )
+            SELECT id FROM request
+        """, {'amount': amount, 'sbp_phone': sbp_phone, 'sbp_bank_name': sbp_bank_name, 'user_id': user_id})
         
-        user_balance = cur.fetchone()
-        available = float(user_balance['balance']) if user_balance else 0
+        created = cur.fetchone()
         
-        if amount > available:
+        if not created:
+            conn.rollback()
+            cur.execute("""
+                SELECT COALESCE(balance, 0) as balance
+                FROM t_p25272970_courier_button_site.users
+                WHERE id = %s
+            """, (user_id,))
+            user_balance = cur.fetchone()
+            available = Money.of(user_balance['balance']) if user_balance else Money()
             cur.close()
             conn.close()
             return {
@@ -3935,29 +6065,7 @@ def handle_withdrawal(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
                 'isBase64Encoded': False
             }
         
-        # Сохраняем реквизиты СБП в профиль
-        cur.execute("""
-            UPDATE t_p25272970_courier_button_site.users
-            SET sbp_phone = %s, sbp_bank_name = %s, updated_at = NOW()
-            WHERE id = %s
-        """, (sbp_phone, sbp_bank_name, user_id))
-        
-        # Списываем сумму с баланса курьера
-        cur.execute("""
-            UPDATE t_p25272970_courier_button_site.users
-            SET balance = balance - %s, updated_at = NOW()
-            WHERE id = %s
-        """, (amount, user_id))
-        
-        # Создаём заявку
-        cur.execute("""
-            INSERT INTO t_p25272970_courier_button_site.withdrawal_requests
-            (courier_id, amount, sbp_phone, sbp_bank_name, status, created_at)
-            VALUES (%s, %s, %s, %s, 'pending', NOW())
-            RETURNING id
-        """, (user_id, amount, sbp_phone, sbp_bank_name))
-        
-        request_id = cur.fetchone()['id']
+        request_id = created['id']
         
         log_activity(conn, 'request_created', f'Новая заявка на вывод: {amount}₽', {'request_id': request_id, 'user_id': user_id, 'amount': float(amount)})
         
@@ -3996,7 +6104,7 @@ def handle_withdrawal(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
         if action == 'list':
@@ -4119,7 +6227,7 @@ def handle_withdrawal(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
         # При отклонении заявки - возвращаем деньги на баланс
@@ -4135,12 +6243,9 @@ def handle_withdrawal(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
                 courier_id = request_info['courier_id']
                 amount_to_return = float(request_info['amount'])
                 
-                # Возвращаем деньги на баланс
-                cur.execute("""
-                    UPDATE t_p25272970_courier_button_site.users
-                    SET balance = balance + %s, updated_at = NOW()
-                    WHERE id = %s
-                """, (amount_to_return, courier_id))
+                # Возвращаем деньги на баланс (повторное отклонение той же заявки второй раз не вернёт)
+                post_balance_entries(cur, [(courier_id, Money.of(request_info['amount']), 'withdrawal_refund', 'withdrawal_requests',
+                                            request_id, 'Возврат отклонённой заявки на вывод')])
                 
                 log_activity(
                     conn,
@@ -4186,14 +6291,9 @@ def handle_withdrawal(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
             WHERE id = %s
         """, (new_status, admin_comment, token_data['user_id'], request_id))
         
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        # Отправляем уведомление в Telegram (если у курьера есть telegram_id)
+        # Уведомление в Telegram (если у курьера есть telegram_id) — через outbox в той же транзакции
         if courier_info and courier_info.get('telegram_id'):
             telegram_id = courier_info['telegram_id']
-            courier_name = courier_info.get('full_name', 'Курьер')
             amount = float(courier_info['amount'])
             
             # Формируем текст уведомления в зависимости от статуса
@@ -4222,7 +6322,11 @@ def handle_withdrawal(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[st
                 notification_text = None
             
             if notification_text:
-                send_telegram_notification(telegram_id, notification_text)
+                enqueue_telegram_notification(cur, telegram_id, notification_text, f'withdrawal_{new_status}')
+        
+        conn.commit()
+        cur.close()
+        conn.close()
         
         return {
             'statusCode': 200,
@@ -4290,7 +6394,7 @@ def handle_main(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor()
             
             cur.execute("SELECT id, password_hash FROM t_p25272970_courier_button_site.admins WHERE id = %s", 
@@ -4342,7 +6446,7 @@ def handle_main(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor()
             
             cur.execute("SELECT id, username, created_at, last_login FROM t_p25272970_courier_button_site.admins ORDER BY created_at DESC")
@@ -4405,7 +6509,7 @@ def handle_main(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor()
             
             cur.execute("SELECT id FROM t_p25272970_courier_button_site.admins WHERE username = %s", (username,))
@@ -4468,7 +6572,7 @@ def handle_main(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor()
             
             cur.execute("SELECT COUNT(*) FROM t_p25272970_courier_button_site.admins")
@@ -4541,7 +6645,7 @@ def handle_main(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor()
             
             cur.execute("""
@@ -4578,7 +6682,7 @@ def handle_main(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor()
             
             cur.execute("""
@@ -4606,7 +6710,7 @@ def handle_main(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
     
     elif method == 'GET':
         # Убрана проверка токена - для обратной совместимости со старым API
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor()
         
         cur.execute("""
@@ -4674,7 +6778,7 @@ def handle_main(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor()
         
         cur.execute("""
@@ -4707,7 +6811,7 @@ def handle_main(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor()
         
         cur.execute("DELETE FROM t_p25272970_courier_button_site.payout_requests WHERE id = %s", (request_id,))
@@ -4744,7 +6848,7 @@ def handle_admin(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, An
         
         if action == 'activity':
             # Возвращаем события из activity_log
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
             cur.execute("""
@@ -4787,7 +6891,7 @@ def handle_admin(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, An
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
             # Получаем все payment_distributions с информацией о получателях и курьерах
@@ -4885,7 +6989,7 @@ def handle_admin(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, An
         
         record_login_attempt(username)
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor()
         
         cur.execute("""
@@ -4974,7 +7078,7 @@ def handle_admin(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, An
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor()
         
         cur.execute("""
@@ -5046,7 +7150,7 @@ def handle_admin(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, An
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor()
         
         # Проверяем, не существует ли уже такой пользователь
@@ -5123,7 +7227,7 @@ def handle_admin(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, An
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor()
         
         # Проверяем количество администраторов
@@ -5208,7 +7312,7 @@ def handle_game(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
     if action == 'leaderboard':
         limit = int(query_params.get('limit', '50'))
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
         cur.execute("""
@@ -5278,7 +7382,7 @@ def handle_game(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
         cur = None
         
         try:
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
             cur.execute("""
@@ -5388,7 +7492,7 @@ def handle_game(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
         cur.execute("""
@@ -5486,7 +7590,7 @@ def handle_reset_admin_password(event: Dict[str, Any], headers: Dict[str, str])
     
     new_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute("""
@@ -5556,7 +7660,7 @@ def handle_startup_payout(event: Dict[str, Any], headers: Dict[str, str]) -> Dic
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
             if courier_id:
@@ -5638,7 +7742,7 @@ def handle_startup_payout(event: Dict[str, Any], headers: Dict[str, str]) -> Dic
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
             cur.execute("""
@@ -5699,7 +7803,7 @@ def handle_startup_payout(event: Dict[str, Any], headers: Dict[str, str]) -> Dic
             
             courier_id = int(user_id_header)
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
             cur.execute("""
@@ -5740,7 +7844,7 @@ def handle_startup_payout(event: Dict[str, Any], headers: Dict[str, str]) -> Dic
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn = get_db_connection()
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
             cur.execute("""
@@ -5805,7 +7909,7 @@ def handle_startup_notification(event: Dict[str, Any], headers: Dict[str, str])
         
         user_id = int(user_id_header)
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
         cur.execute("""
@@ -5881,7 +7985,7 @@ def handle_startup_notification(event: Dict[str, Any], headers: Dict[str, str])
         
         user_id = int(user_id_header)
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor()
         
         cur.execute("""
@@ -5927,7 +8031,7 @@ def handle_news(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
         cur.execute("""
@@ -5956,6 +8060,58 @@ def handle_news(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
     }
 
 
+ACTIVITY_FEED_MAX_LIMIT = 500
+
+
+def fetch_activity_feed(cur, query_params: Dict[str, Any], default_limit: int = 50) -> tuple:
+    """
+    Страница ленты activity_log с keyset-пагинацией по (created_at, id).
+    Параметры: limit, before (next_cursor предыдущей страницы), event_type, courier_id (из data).
+    Возвращает (строки, next_cursor); next_cursor = None на последней странице
+    """
+    try:
+        limit = min(max(int(query_params.get('limit') or default_limit), 1), ACTIVITY_FEED_MAX_LIMIT)
+    except ValueError:
+        raise ValueError('Неверный limit')
+    
+    conditions = []
+    params = []
+    
+    before = query_params.get('before')
+    if before:
+        try:
+            before_ts, before_id = before.rsplit('_', 1)
+            params.extend([datetime.fromisoformat(before_ts), int(before_id)])
+        except ValueError:
+            raise ValueError('Неверный курсор')
+        conditions.append('(created_at, id) < (%s, %s)')
+    
+    if query_params.get('event_type'):
+        conditions.append('event_type = %s')
+        params.append(query_params['event_type'])
+    
+    if query_params.get('courier_id'):
+        conditions.append("data ? 'courier_id' AND data->>'courier_id' = %s")
+        params.append(str(query_params['courier_id']))
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cur.execute(f"""
+        SELECT id, event_type, message, data, created_at
+        FROM t_p25272970_courier_button_site.activity_log
+        {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+    """, params + [limit + 1])
+    
+    rows = cur.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['created_at'].isoformat()}_{rows[-1]['id']}"
+    
+    return rows, next_cursor
+
+
 def handle_admin(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
     """Обработка запросов админ-панели"""
     method = event.get('httpMethod', 'GET')
@@ -5984,17 +8140,21 @@ def handle_admin(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, An
         }
     
     if method == 'GET' and action == 'activity':
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        cur.execute("""
-            SELECT id, event_type, message, data, created_at
-            FROM t_p25272970_courier_button_site.activity_log
-            ORDER BY created_at DESC
-            LIMIT 100
-        """)
+        try:
+            activities, next_cursor = fetch_activity_feed(cur, query_params, default_limit=100)
+        except ValueError as e:
+            cur.close()
+            conn.close()
+            return {
+                'statusCode': 400,
+                'headers': headers,
+                'body': json.dumps({'error': str(e)}),
+                'isBase64Encoded': False
+            }
         
-        activities = cur.fetchall()
         cur.close()
         conn.close()
         
@@ -6003,7 +8163,8 @@ def handle_admin(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, An
             'headers': headers,
             'body': json.dumps({
                 'success': True,
-                'activities': convert_decimals([dict(a) for a in activities])
+                'activities': convert_decimals([dict(a) for a in activities]),
+                'next_cursor': next_cursor
             }),
             'isBase64Encoded': False
         }
@@ -6046,7 +8207,7 @@ def handle_company_stats(event: Dict[str, Any], headers: Dict[str, str]) -> Dict
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     cur.execute("""
@@ -6128,7 +8289,7 @@ def handle_content(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
         }
     
     try:
-        conn = psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=RealDictCursor)
+        conn = get_db_connection(cursor_factory=RealDictCursor)
         cur = conn.cursor()
         
         cur.execute("""
@@ -6238,7 +8399,7 @@ def handle_bonus_users(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[s
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     # Получаем курьеров с выплаченным самобонусом
@@ -6353,7 +8514,7 @@ def handle_content(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
                 'isBase64Encoded': False
             }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
@@ -6569,7 +8730,7 @@ def handle_profile(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str,
     
     user_id = int(user_id_header)
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
@@ -6677,7 +8838,7 @@ def handle_game(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any
     query_params = event.get('queryStringParameters') or {}
     action = query_params.get('action', 'leaderboard')
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
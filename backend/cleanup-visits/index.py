@@ -1,14 +1,16 @@
 '''
-Business: Clean up old data - page visits (older than 90 days) and archived users
+Business: Clean up old data - page_visits and activity_log partitions past retention (dropped whole), archived users;
+builds visit analytics sketches via visit-tracking
 Args: event with httpMethod; context with request_id
 Returns: HTTP response with cleanup statistics
 '''
 
 import json
 import os
+import urllib.request
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 from typing import Dict, Any
 
 def get_db_connection():
@@ -17,6 +19,122 @@ def get_db_connection():
         raise ValueError('DATABASE_URL not set')
     return psycopg2.connect(dsn)
 
+SCHEMA = 't_p25272970_courier_button_site'
+VISITS_RETENTION_DAYS = 90
+VISITS_DAYS_AHEAD = 7
+ACTIVITY_LOG_RETENTION_MONTHS = int(os.environ.get('ACTIVITY_LOG_RETENTION_MONTHS', '12'))
+ACTIVITY_LOG_MONTHS_AHEAD = 2
+# Скетчи аналитики визитов строит сама visit-tracking (код скетчей живёт там): запускаем её обслуживание
+VISIT_TRACKING_URL = 'https://functions.poehali.dev/f52e1a9a-d1cb-41bf-a68f-5a795c41833c'
+SKETCHES_TIMEOUT_SECONDS = 28
+
+# Партиции называются {table}_p<суффикс>: activity_log_p2025_01 (месяц), page_visits_p2025_01_31 (день)
+PARTITION_SUFFIX_FORMATS = {'month': '%Y_%m', 'day': '%Y_%m_%d'}
+
+def add_months(month_start: date, months: int) -> date:
+    month_index = month_start.year * 12 + month_start.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+def period_start(day: date, period: str) -> date:
+    return day.replace(day=1) if period == 'month' else day
+
+def shift_period(start: date, period: str, count: int) -> date:
+    return add_months(start, count) if period == 'month' else start + timedelta(days=count)
+
+def ensure_partitions(cur, table: str, column: str, period: str, ahead: int) -> list:
+    """
+    Создаёт партиции {table} по column на текущий период и ahead периодов вперёд.
+    Строки за этот период, успевшие попасть в {table}_default, переносятся в новую партицию
+    """
+    created = []
+    current = period_start(date.today(), period)
+    
+    for offset in range(ahead + 1):
+        range_start = shift_period(current, period, offset)
+        range_end = shift_period(range_start, period, 1)
+        partition = f"{table}_p{range_start.strftime(PARTITION_SUFFIX_FORMATS[period])}"
+        
+        cur.execute('SELECT to_regclass(%s)', (f'{SCHEMA}.{partition}',))
+        if cur.fetchone()[0]:
+            continue
+        
+        cur.execute(f'CREATE TABLE {SCHEMA}.{partition} (LIKE {SCHEMA}.{table} INCLUDING DEFAULTS)')
+        cur.execute(f'''
+            WITH moved AS (
+                DELETE FROM {SCHEMA}.{table}_default
+                WHERE {column} >= %s AND {column} < %s
+                RETURNING *
+            )
+            INSERT INTO {SCHEMA}.{partition} SELECT * FROM moved
+        ''', (range_start, range_end))
+        cur.execute(f'''
+            ALTER TABLE {SCHEMA}.{table} ATTACH PARTITION {SCHEMA}.{partition}
+            FOR VALUES FROM (%s) TO (%s)
+        ''', (range_start, range_end))
+        created.append(partition)
+    
+    return created
+
+def drop_expired_partitions(cur, table: str, column: str, period: str, cutoff: date) -> Dict[str, Any]:
+    """
+    Удаляет целиком партиции {table}, закончившиеся до cutoff, и чистит старые строки в {table}_default.
+    Число удалённых строк — оценка по pg_class.reltuples, без сканирования партиций
+    """
+    cur.execute('''
+        SELECT child.relname, GREATEST(child.reltuples, 0)::bigint
+        FROM pg_inherits i
+        JOIN pg_class child ON child.oid = i.inhrelid
+        JOIN pg_class parent ON parent.oid = i.inhparent
+        JOIN pg_namespace n ON n.oid = parent.relnamespace
+        WHERE n.nspname = %s AND parent.relname = %s
+    ''', (SCHEMA, table))
+    
+    dropped = []
+    dropped_rows = 0
+    prefix = f'{table}_p'
+    for partition, estimated_rows in cur.fetchall():
+        if not partition.startswith(prefix):
+            continue
+        try:
+            range_start = datetime.strptime(partition[len(prefix):], PARTITION_SUFFIX_FORMATS[period]).date()
+        except ValueError:
+            continue
+        if shift_period(range_start, period, 1) <= cutoff:
+            cur.execute(f'DROP TABLE {SCHEMA}.{partition}')
+            dropped.append(partition)
+            dropped_rows += estimated_rows
+    
+    cur.execute(f'DELETE FROM {SCHEMA}.{table}_default WHERE {column} < %s', (cutoff,))
+    dropped_rows += cur.rowcount
+    
+    return {'partitions': sorted(dropped), 'rows': dropped_rows}
+
+def estimate_rows(cur, table: str) -> int:
+    cur.execute('''
+        SELECT COALESCE(SUM(GREATEST(child.reltuples, 0)), 0)::bigint
+        FROM pg_inherits i
+        JOIN pg_class child ON child.oid = i.inhrelid
+        JOIN pg_class parent ON parent.oid = i.inhparent
+        JOIN pg_namespace n ON n.oid = parent.relnamespace
+        WHERE n.nspname = %s AND parent.relname = %s
+    ''', (SCHEMA, table))
+    return cur.fetchone()[0]
+
+def refresh_visit_sketches(auth_token: str) -> Dict[str, Any]:
+    """POST visit-tracking ?action=sketches: суточные скетчи строятся здесь, а не в GET аналитики"""
+    req = urllib.request.Request(
+        f'{VISIT_TRACKING_URL}?action=sketches',
+        data=b'{}',
+        headers={'Content-Type': 'application/json', 'X-Auth-Token': auth_token},
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=SKETCHES_TIMEOUT_SECONDS) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except Exception as e:
+        print(f'Error refreshing visit sketches: {e}')
+        return {'success': False, 'error': str(e)}
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
@@ -76,28 +194,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Invalid token'})
         }
     
-    # 1. Cleanup старых визитов (старше 90 дней)
-    cutoff_date = datetime.now() - timedelta(days=90)
-    
-    cur.execute('''
-        SELECT COUNT(*) FROM t_p25272970_courier_button_site.page_visits
-        WHERE created_at < %s
-    ''', (cutoff_date,))
-    
-    old_visits_count = cur.fetchone()[0]
-    
-    cur.execute('''
-        DELETE FROM t_p25272970_courier_button_site.page_visits
-        WHERE created_at < %s
-    ''', (cutoff_date,))
-    
-    deleted_visits = cur.rowcount
+    # 1. Партиции page_visits: создаём на неделю вперёд, старше 90 дней удаляем целиком (без DELETE и VACUUM)
+    cutoff_date = date.today() - timedelta(days=VISITS_RETENTION_DAYS)
+    created_visit_partitions = ensure_partitions(cur, 'page_visits', 'visit_date', 'day', VISITS_DAYS_AHEAD)
+    dropped_visits = drop_expired_partitions(cur, 'page_visits', 'visit_date', 'day', cutoff_date)
     conn.commit()
     
-    cur.execute('''
-        SELECT COUNT(*) FROM t_p25272970_courier_button_site.page_visits
-    ''')
-    remaining_visits = cur.fetchone()[0]
+    remaining_visits = estimate_rows(cur, 'page_visits')
     
     # 2. Cleanup архивированных пользователей с истёкшим сроком
     cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -114,15 +217,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     deleted_users_count = len(expired_users)
     
     if deleted_users_count > 0:
-        for user in expired_users:
-            # Удаляем связанные данные
-            cur.execute('DELETE FROM t_p25272970_courier_button_site.messenger_connections WHERE courier_id = %s', (user['id'],))
-            cur.execute('DELETE FROM t_p25272970_courier_button_site.courier_game_leaderboard WHERE user_id = %s', (user['id'],))
-            cur.execute('UPDATE t_p25272970_courier_button_site.users SET invited_by_user_id = NULL WHERE invited_by_user_id = %s', (user['id'],))
-            cur.execute('DELETE FROM t_p25272970_courier_button_site.referrals WHERE referrer_id = %s OR referee_id = %s', (user['id'], user['id']))
-            cur.execute('DELETE FROM t_p25272970_courier_button_site.withdrawal_requests WHERE user_id = %s', (user['id'],))
-            cur.execute('DELETE FROM t_p25272970_courier_button_site.story_views WHERE user_id = %s', (user['id'],))
-            cur.execute('DELETE FROM t_p25272970_courier_button_site.users WHERE id = %s', (user['id'],))
+        # Удаляем связанные данные сразу для всех профилей: число запросов не зависит от количества пользователей
+        user_ids = [user['id'] for user in expired_users]
+        cur.execute('DELETE FROM t_p25272970_courier_button_site.messenger_connections WHERE courier_id = ANY(%s)', (user_ids,))
+        cur.execute('DELETE FROM t_p25272970_courier_button_site.courier_game_leaderboard WHERE user_id = ANY(%s)', (user_ids,))
+        cur.execute('UPDATE t_p25272970_courier_button_site.users SET invited_by_user_id = NULL WHERE invited_by_user_id = ANY(%s)', (user_ids,))
+        cur.execute('DELETE FROM t_p25272970_courier_button_site.referrals WHERE referrer_id = ANY(%s) OR referee_id = ANY(%s)', (user_ids, user_ids))
+        cur.execute('DELETE FROM t_p25272970_courier_button_site.withdrawal_requests WHERE user_id = ANY(%s)', (user_ids,))
+        cur.execute('DELETE FROM t_p25272970_courier_button_site.story_views WHERE user_id = ANY(%s)', (user_ids,))
+        cur.execute('DELETE FROM t_p25272970_courier_button_site.users WHERE id = ANY(%s)', (user_ids,))
         
         conn.commit()
         
@@ -138,9 +241,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         ))
         conn.commit()
     
+    # 3. Партиции activity_log: создаём наперёд, старше срока хранения удаляем целиком
+    cur = conn.cursor()
+    created_partitions = ensure_partitions(cur, 'activity_log', 'created_at', 'month', ACTIVITY_LOG_MONTHS_AHEAD)
+    activity_cutoff = add_months(date.today().replace(day=1), -ACTIVITY_LOG_RETENTION_MONTHS)
+    dropped_activity = drop_expired_partitions(cur, 'activity_log', 'created_at', 'month', activity_cutoff)
+    conn.commit()
+    
     cur.close()
     conn.close()
     
+    # 4. Суточные скетчи аналитики визитов: закрытые дни без скетча и сегодняшний день
+    sketches = refresh_visit_sketches(auth_token)
+    
     return {
         'statusCode': 200,
         'headers': {
@@ -151,13 +264,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         'body': json.dumps({
             'success': True,
             'visits': {
-                'deleted_count': deleted_visits,
+                'deleted_count': dropped_visits['rows'],
                 'remaining_count': remaining_visits,
+                'counts_estimated': True,
                 'cutoff_date': cutoff_date.isoformat(),
-                'days_kept': 90
+                'days_kept': VISITS_RETENTION_DAYS,
+                'created_partitions': created_visit_partitions,
+                'dropped_partitions': dropped_visits['partitions']
             },
             'users': {
                 'deleted_archived_count': deleted_users_count
-            }
+            },
+            'activity_log': {
+                'created_partitions': created_partitions,
+                'dropped_partitions': dropped_activity['partitions'],
+                'cutoff_date': activity_cutoff.isoformat(),
+                'retention_months': ACTIVITY_LOG_RETENTION_MONTHS
+            },
+            'sketches': sketches
         })
     }
\ No newline at end of file
@@ -0,0 +1,215 @@
+"""
+Отправка уведомлений из notification_outbox
+API пишет уведомления в outbox в одной транзакции с бизнес-изменением, а эта функция (по cron)
+забирает их пачками, отправляет в Telegram и планирует повторы с экспоненциальной задержкой.
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+import requests
+
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+
+SCHEMA = 't_p25272970_courier_button_site'
+
+BATCH_SIZE = 100
+SEND_CONCURRENCY = 8
+MAX_ATTEMPTS = 8
+BASE_BACKOFF_SECONDS = 15
+MAX_BACKOFF_SECONDS = 3600
+# Пока пачка в работе, её записи «спрятаны» от параллельных вызовов на это время
+CLAIM_LEASE_SECONDS = 120
+TIME_BUDGET_SECONDS = float(os.environ.get('OUTBOX_TIME_BUDGET', '25'))
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Max-Age': '86400'
+}
+
+
+def get_db_connection():
+    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+
+
+def response(status: int, body: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', **CORS_HEADERS},
+        'body': json.dumps(body, default=str),
+        'isBase64Encoded': False
+    }
+
+
+_session = None
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=SEND_CONCURRENCY))
+    return _session
+
+
+def send_telegram(item: Dict[str, Any]) -> tuple:
+    """Возвращает (outcome, error, retry_after): outcome — sent / retry / dead"""
+    if not TELEGRAM_BOT_TOKEN:
+        return 'retry', 'TELEGRAM_BOT_TOKEN не настроен', None
+
+    try:
+        resp = get_session().post(
+            f'https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage',
+            json={'chat_id': item['recipient'], 'text': item['message_text'], 'parse_mode': 'HTML'},
+            timeout=10
+        )
+    except requests.RequestException as e:
+        return 'retry', str(e), None
+
+    if resp.status_code == 200:
+        return 'sent', None, None
+    if resp.status_code == 429:
+        retry_after = (resp.json().get('parameters') or {}).get('retry_after')
+        return 'retry', resp.text[:300], retry_after
+    if resp.status_code >= 500:
+        return 'retry', resp.text[:300], None
+    # 400/403: чат не найден или бот заблокирован — повтор не поможет
+    return 'dead', resp.text[:300], None
+
+
+def claim_batch(conn) -> list:
+    cur = conn.cursor()
+    cur.execute(f"""
+        UPDATE {SCHEMA}.notification_outbox
+        SET attempts = attempts + 1,
+            next_attempt_at = NOW() + make_interval(secs => %s)
+        WHERE id IN (
+            SELECT id FROM {SCHEMA}.notification_outbox
+            WHERE status = 'pending' AND next_attempt_at <= NOW()
+            ORDER BY next_attempt_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, recipient, message_text, attempts
+    """, (CLAIM_LEASE_SECONDS, BATCH_SIZE))
+    batch = cur.fetchall()
+    conn.commit()
+    cur.close()
+    return batch
+
+
+def record_results(conn, batch: list, results: list) -> Dict[str, int]:
+    """Один bulk UPDATE на пачку: отправленные, отложенные с backoff и окончательно упавшие"""
+    rows = []
+    counts = {'sent': 0, 'retry': 0, 'failed': 0}
+    for item, (outcome, error, retry_after) in zip(batch, results):
+        if outcome == 'sent':
+            rows.append((item['id'], 'sent', 0, None))
+            counts['sent'] += 1
+        elif outcome == 'retry' and item['attempts'] < MAX_ATTEMPTS:
+            delay = retry_after or min(BASE_BACKOFF_SECONDS * 2 ** (item['attempts'] - 1), MAX_BACKOFF_SECONDS)
+            rows.append((item['id'], 'pending', delay, error))
+            counts['retry'] += 1
+        else:
+            rows.append((item['id'], 'failed', 0, error))
+            counts['failed'] += 1
+
+    cur = conn.cursor()
+    execute_values(cur, f"""
+        UPDATE {SCHEMA}.notification_outbox o
+        SET status = v.status,
+            last_error = v.error,
+            next_attempt_at = NOW() + make_interval(secs => v.delay),
+            sent_at = CASE WHEN v.status = 'sent' THEN NOW() ELSE o.sent_at END
+        FROM (VALUES %s) AS v(id, status, delay, error)
+        WHERE o.id = v.id
+    """, rows, template='(%s, %s, %s::int, %s)')
+    conn.commit()
+    cur.close()
+    return counts
+
+
+def drain(conn) -> Dict[str, Any]:
+    deadline = time.monotonic() + TIME_BUDGET_SECONDS
+    totals = {'sent': 0, 'retry': 0, 'failed': 0, 'batches': 0}
+
+    with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY) as pool:
+        while time.monotonic() < deadline:
+            batch = claim_batch(conn)
+            if not batch:
+                break
+            results = list(pool.map(send_telegram, batch))
+            counts = record_results(conn, batch, results)
+            for key, value in counts.items():
+                totals[key] += value
+            totals['batches'] += 1
+
+    return totals
+
+
+def get_queue_status(conn) -> Dict[str, Any]:
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT
+            COUNT(*) AS depth,
+            COUNT(*) FILTER (WHERE next_attempt_at <= NOW()) AS due,
+            COUNT(*) FILTER (WHERE attempts > 0) AS retrying,
+            COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(created_at)), 0) AS lag_seconds
+        FROM {SCHEMA}.notification_outbox
+        WHERE status = 'pending'
+    """)
+    queue = dict(cur.fetchone())
+
+    cur.execute(f"""
+        SELECT
+            COUNT(*) FILTER (WHERE status = 'sent') AS sent_last_hour,
+            COUNT(*) FILTER (WHERE status = 'failed') AS failed_last_hour,
+            COALESCE(AVG(EXTRACT(EPOCH FROM sent_at - created_at)) FILTER (WHERE status = 'sent'), 0) AS avg_delivery_seconds
+        FROM {SCHEMA}.notification_outbox
+        WHERE created_at >= NOW() - INTERVAL '1 hour'
+    """)
+    queue.update(cur.fetchone())
+    cur.close()
+
+    queue['lag_seconds'] = round(float(queue['lag_seconds']), 1)
+    queue['avg_delivery_seconds'] = round(float(queue['avg_delivery_seconds']), 1)
+    return queue
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    action=drain (по умолчанию, вызывается по cron) — отправка накопившихся уведомлений
+    action=status — глубина очереди, лаг и статистика доставки за час
+    """
+    method = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {'statusCode': 200, 'headers': CORS_HEADERS, 'body': '', 'isBase64Encoded': False}
+
+    query_params = event.get('queryStringParameters') or {}
+    action = query_params.get('action', 'drain')
+
+    conn = get_db_connection()
+
+    try:
+        if action == 'status':
+            return response(200, {'success': True, 'queue': get_queue_status(conn)})
+
+        if action == 'drain':
+            return response(200, {'success': True, **drain(conn)})
+
+        return response(400, {'error': f'Неизвестное действие: {action}'})
+
+    except Exception as e:
+        print(f'Error in notification-outbox: {e}')
+        conn.rollback()
+        return response(500, {'error': str(e)})
+    finally:
+        conn.close()
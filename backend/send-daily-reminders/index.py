@@ -136,7 +136,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         couriers = cursor.fetchall()
         
-        sent_count = 0
+        sent_telegram_ids = []
         failed_count = 0
         
         for courier in couriers:
@@ -145,16 +145,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 result = send_telegram_message(courier['telegram_id'], message)
                 
                 if result and result.get('ok'):
-                    # Обновляем время последнего напоминания в users
-                    cursor.execute("""
-                        UPDATE t_p25272970_courier_button_site.users u
-                        SET last_reminder_sent = NOW()
-                        FROM t_p25272970_courier_button_site.messenger_connections mc
-                        WHERE mc.courier_id = u.id
-                          AND mc.messenger_type = 'telegram'
-                          AND mc.messenger_user_id = %s
-                    """, (courier['telegram_id'],))
-                    sent_count += 1
+                    sent_telegram_ids.append(courier['telegram_id'])
                 else:
                     failed_count += 1
                     
@@ -162,6 +153,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 print(f"Error sending reminder to courier {courier['telegram_id']}: {e}")
                 failed_count += 1
         
+        sent_count = len(sent_telegram_ids)
+        
+        if sent_telegram_ids:
+            # Время последнего напоминания — одним UPDATE для всех, кому сообщение ушло
+            cursor.execute("""
+                UPDATE t_p25272970_courier_button_site.users u
+                SET last_reminder_sent = NOW()
+                FROM t_p25272970_courier_button_site.messenger_connections mc
+                WHERE mc.courier_id = u.id
+                  AND mc.messenger_type = 'telegram'
+                  AND mc.messenger_user_id = ANY(%s)
+            """, (sent_telegram_ids,))
+        
         conn.commit()
         
         return {
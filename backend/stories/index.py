@@ -345,18 +345,71 @@ def delete_story(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, An
         'isBase64Encoded': False
     }
 
+ACTIVITY_FEED_MAX_LIMIT = 500
+
+def fetch_activity_feed(cursor, query_params: Dict[str, Any], default_limit: int = 50) -> tuple:
+    """
+    Страница ленты activity_log с keyset-пагинацией по (created_at, id).
+    Параметры: limit, before (next_cursor предыдущей страницы), event_type, courier_id (из data)
+    """
+    try:
+        limit = min(max(int(query_params.get('limit') or default_limit), 1), ACTIVITY_FEED_MAX_LIMIT)
+    except ValueError:
+        raise ValueError('Неверный limit')
+    
+    conditions = []
+    params = []
+    
+    before = query_params.get('before')
+    if before:
+        try:
+            before_ts, before_id = before.rsplit('_', 1)
+            params.extend([datetime.fromisoformat(before_ts), int(before_id)])
+        except ValueError:
+            raise ValueError('Неверный курсор')
+        conditions.append('(created_at, id) < (%s, %s)')
+    
+    if query_params.get('event_type'):
+        conditions.append('event_type = %s')
+        params.append(query_params['event_type'])
+    
+    if query_params.get('courier_id'):
+        conditions.append("data ? 'courier_id' AND data->>'courier_id' = %s")
+        params.append(str(query_params['courier_id']))
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cursor.execute(f"""
+        SELECT id, event_type, message, data, created_at
+        FROM t_p25272970_courier_button_site.activity_log
+        {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+    """, params + [limit + 1])
+    
+    rows = cursor.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['created_at'].isoformat()}_{rows[-1]['id']}"
+    
+    return rows, next_cursor
+
 def get_activity(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute("""
-        SELECT id, event_type, message, data, created_at
-        FROM t_p25272970_courier_button_site.activity_log
-        ORDER BY created_at DESC
-        LIMIT 50
-    """)
+    try:
+        activities, next_cursor = fetch_activity_feed(cursor, event.get('queryStringParameters') or {})
+    except ValueError as e:
+        cursor.close()
+        conn.close()
+        return {
+            'statusCode': 400,
+            'headers': headers,
+            'body': json.dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
     
-    activities = cursor.fetchall()
     cursor.close()
     conn.close()
     
@@ -373,6 +426,6 @@ def get_activity(event: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, An
     return {
         'statusCode': 200,
         'headers': headers,
-        'body': json.dumps({'activities': activities_list}),
+        'body': json.dumps({'activities': activities_list, 'next_cursor': next_cursor}),
         'isBase64Encoded': False
     }
\ No newline at end of file
@@ -8,22 +8,103 @@ import os
 from typing import Dict, Any, Optional
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+import http.client
+import urllib.parse
 import urllib.request
 import hashlib
 import secrets
+import math
+import re
+import time
+import threading
 
 DATABASE_URL = os.environ.get('DATABASE_URL', '')
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
 YANDEX_GPT_API_KEY = os.environ.get('YANDEX_GPT_API_KEY', '')
 YANDEX_FOLDER_ID = os.environ.get('YANDEX_FOLDER_ID', '')
 WEBSITE_URL = 'https://stuey-go.ru'
 
+AI_FALLBACK_TEXT = "Извини, сейчас не могу ответить. Попробуй позже или задай вопрос в поддержке на сайте! 🙏"
+
+_db_pool = None
+_http_local = threading.local()
+
+
+class PooledConnection:
+    """Соединение из пула: close() возвращает его в пул вместо закрытия"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.rollback()
+            self._pool.putconn(self._conn)
+        except Exception:
+            self._pool.putconn(self._conn, close=True)
+        self._conn = None
+
+
+def enable_connection_pool(minconn: int, maxconn: int):
+    """Включает пул соединений с БД для долгоживущего процесса (long-polling режим)"""
+    global _db_pool
+    _db_pool = ThreadedConnectionPool(minconn, maxconn, DATABASE_URL, cursor_factory=RealDictCursor)
+
+
 def get_db_connection():
+    if _db_pool is not None:
+        return PooledConnection(_db_pool, _db_pool.getconn())
     return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
 
-def send_telegram_message(chat_id: int, text: str, parse_mode: str = 'HTML', reply_markup: Optional[Dict] = None):
-    url = f'https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage'
+
+def telegram_api_call(api_method: str, data: Dict[str, Any], timeout: float = 10.0,
+                      return_errors: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Вызов Bot API через keep-alive соединение, своё для каждого потока.
+    Ответ не 200 — None, а с return_errors — тело ошибки Bot API ({'ok': False, 'error_code': ...})
+    """
+    parsed = urllib.parse.urlsplit(TELEGRAM_API_URL)
+    body = json.dumps(data).encode('utf-8')
+    path = f'{parsed.path.rstrip("/")}/bot{TELEGRAM_BOT_TOKEN}/{api_method}'
     
+    for attempt in range(2):
+        conn = getattr(_http_local, 'conn', None)
+        if conn is None:
+            connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+            conn = connection_class(parsed.netloc, timeout=timeout)
+            _http_local.conn = conn
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        try:
+            conn.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            payload = response.read()
+            if response.status != 200:
+                print(f'Telegram API {api_method} error: {response.status} {payload[:200]!r}')
+                if not return_errors:
+                    return None
+                try:
+                    return json.loads(payload.decode('utf-8'))
+                except ValueError:
+                    return {'ok': False, 'error_code': response.status, 'description': payload[:200].decode('utf-8', 'replace')}
+            return json.loads(payload.decode('utf-8'))
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            _http_local.conn = None
+            if attempt == 1:
+                raise e
+    return None
+
+def send_telegram_message(chat_id: int, text: str, parse_mode: str = 'HTML', reply_markup: Optional[Dict] = None):
     data = {
         'chat_id': chat_id,
         'text': text,
@@ -33,22 +114,13 @@ def send_telegram_message(chat_id: int, text: str, parse_mode: str = 'HTML', rep
     if reply_markup:
         data['reply_markup'] = reply_markup
     
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(data).encode('utf-8'),
-        headers={'Content-Type': 'application/json'}
-    )
-    
     try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode('utf-8'))
+        return telegram_api_call('sendMessage', data)
     except Exception as e:
         print(f'Error sending message: {e}')
         return None
 
 def edit_telegram_message(chat_id: int, message_id: int, text: str, parse_mode: str = 'HTML', reply_markup: Optional[Dict] = None):
-    url = f'https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/editMessageText'
-    
     data = {
         'chat_id': chat_id,
         'message_id': message_id,
@@ -59,36 +131,20 @@ def edit_telegram_message(chat_id: int, message_id: int, text: str, parse_mode:
     if reply_markup:
         data['reply_markup'] = reply_markup
     
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(data).encode('utf-8'),
-        headers={'Content-Type': 'application/json'}
-    )
-    
     try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode('utf-8'))
+        return telegram_api_call('editMessageText', data)
     except Exception as e:
         print(f'Error editing message: {e}')
         return None
 
 def answer_callback_query(callback_query_id: str, text: str = None, show_alert: bool = False):
-    url = f'https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/answerCallbackQuery'
-    
     data = {'callback_query_id': callback_query_id}
     if text:
         data['text'] = text
         data['show_alert'] = show_alert
     
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(data).encode('utf-8'),
-        headers={'Content-Type': 'application/json'}
-    )
-    
     try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode('utf-8'))
+        return telegram_api_call('answerCallbackQuery', data)
     except Exception as e:
         print(f'Error answering callback: {e}')
         return None
@@ -237,24 +293,260 @@ FAQ_ANSWERS = {
 🔥 Берём всех, кто готов работать!"""
 }
 
+# Вопросы-подсказки для статических ответов: индексируются вместе с текстом ответа
+FAQ_QUESTIONS = {
+    'заработок_час': 'Сколько можно заработать за час? Какой доход и зарплата курьера, сколько платят в день',
+    'выплаты': 'Когда выплаты? Как получить деньги, перевод на карту, ежедневные выплаты',
+    'регистрация': 'Как зарегистрироваться и устроиться курьером? Как начать работать, подать анкету',
+    'требования': 'Какие требования и условия? Что нужно, с какого возраста можно работать, нужен ли опыт'
+}
+
+FAQ_BOT_CONTENT_FIELDS = {
+    'faq_earnings': 'Из чего складывается заработок и доход',
+    'faq_withdrawal': 'Как и когда происходят выплаты, минимальная сумма вывода',
+    'faq_support': 'Как связаться с поддержкой, контакты и время работы',
+    'bonus_conditions': 'Условия получения самобонуса: как получить бонус за первые заказы',
+    'referral_conditions': 'Условия реферальной программы, бонус за друга'
+}
+
+# Ключевые слова документа: индексируются вместе с его текстом, и совпадения по одному такому слову
+# достаточно для ответа («выплаты», «как зарегистрироваться»). Остальным вопросам нужно FAQ_MIN_MATCHED_TOKENS слов
+FAQ_KEYWORDS = {
+    'static:заработок_час': 'зарплата',
+    'static:выплаты': 'выплаты вывести',
+    'static:регистрация': 'зарегистрироваться регистрация',
+    'static:требования': 'требования',
+    'bot_content:faq_support': 'поддержка',
+    'bot_content:bonus_conditions': 'самобонус'
+}
+
+FAQ_STOPWORDS = {
+    'а', 'в', 'во', 'и', 'к', 'ко', 'на', 'не', 'ни', 'о', 'об', 'от', 'по', 'с', 'со', 'у', 'за', 'из',
+    'для', 'до', 'же', 'ли', 'бы', 'то', 'это', 'как', 'что', 'я', 'ты', 'вы', 'мы', 'мне', 'меня',
+    'тебя', 'нас', 'вас', 'мой', 'твой', 'или', 'но', 'да', 'нет', 'там', 'тут', 'так', 'уже', 'еще',
+    'ещё', 'можно', 'нужно', 'надо', 'есть', 'быть', 'будет', 'привет', 'подскажи', 'скажи',
+    'подскажите', 'скажите', 'пожалуйста', 'какой', 'какая', 'какие', 'какое', 'каких', 'какого',
+    'хочу', 'чего', 'почему', 'зачем'
+}
+
+FAQ_SUFFIXES = (
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ешь', 'ете', 'ите',
+    'ать', 'ять', 'ить', 'еть', 'ться', 'ется', 'ются', 'ах', 'ях', 'ам', 'ям', 'ом', 'ем',
+    'ов', 'ев', 'ых', 'их', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ой', 'ей', 'ий', 'ый',
+    'ет', 'ют', 'ут', 'ит', 'ат', 'ят', 'ть', 'ся', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й'
+)
+
+FAQ_MIN_CONFIDENCE = 0.5
+# Совпадение по одному обычному слову («город», «бонус») не отличает вопрос от случайного упоминания в тексте ответа
+FAQ_MIN_MATCHED_TOKENS = 2
+FAQ_MIN_SCORE = 1.0
+FAQ_BM25_K1 = 1.2
+FAQ_BM25_B = 0.75
+
+# Офлайн-набор для оценки: (вопрос, ожидаемый ключ документа или None если нужен LLM)
+FAQ_EVAL_SET = [
+    ('Сколько можно заработать за час?', 'static:заработок_час'),
+    ('какая зарплата в час у вело курьера', 'static:заработок_час'),
+    ('Сколько платят в день?', 'static:заработок_час'),
+    ('Когда приходят выплаты?', 'static:выплаты'),
+    ('как получить деньги на карту', 'static:выплаты'),
+    ('Как зарегистрироваться курьером?', 'static:регистрация'),
+    ('хочу устроиться, с чего начать', 'static:регистрация'),
+    ('Какие требования к курьерам?', 'static:требования'),
+    ('с какого возраста можно работать', 'static:требования'),
+    ('нужен ли опыт работы', 'static:требования'),
+    ('Как связаться с поддержкой?', 'bot_content:faq_support'),
+    ('Сколько платят за приглашённого друга?', 'entry:1'),
+    ('Какая погода завтра в Казани?', None),
+    ('Посоветуй хороший фильм', None),
+    ('Почему приложение Яндекс.Про вылетает на айфоне?', None),
+    ('Как пройти медосмотр?', None),
+    ('как получить бонус', 'bot_content:bonus_conditions'),
+    ('какой у тебя город', None),
+    ('в каком городе ты работаешь', None),
+    ('бонус', None),
+    ('а деньги?', None),
+    ('выплаты', 'static:выплаты'),
+    ('зарплата', 'static:заработок_час'),
+    ('требования', 'static:требования'),
+    ('как зарегистрироваться', 'static:регистрация'),
+    ('хочу вывести деньги', 'static:выплаты')
+]
+
+_faq_index = None
+
+
+def normalize_faq_tokens(text: str) -> list:
+    """Нормализация текста для FAQ-поиска: регистр, ё→е, стоп-слова и лёгкий стемминг окончаний"""
+    tokens = []
+    cleaned = ''.join(ch if ch.isalnum() else ' ' for ch in text.lower().replace('ё', 'е'))
+    for word in cleaned.split():
+        if word in FAQ_STOPWORDS or len(word) < 2:
+            continue
+        for suffix in FAQ_SUFFIXES:
+            if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+                word = word[:-len(suffix)]
+                break
+        tokens.append(word[:6])
+    return tokens
+
+
+class FaqIndex:
+    """In-memory BM25-индекс по FAQ. Строится один раз на тёплый контейнер"""
+
+    def __init__(self, documents: list):
+        self.documents = documents
+        self.postings = {}
+        self.doc_lengths = []
+        self.keywords = []
+        for doc_id, doc in enumerate(documents):
+            keywords = set(normalize_faq_tokens(FAQ_KEYWORDS.get(doc['key'], '')))
+            self.keywords.append(keywords)
+            tokens = normalize_faq_tokens(doc['text']) + list(keywords)
+            self.doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                self.postings.setdefault(token, []).append((doc_id, tf))
+
+        total_docs = len(documents) or 1
+        self.avg_length = (sum(self.doc_lengths) / total_docs) or 1.0
+        self.idf = {
+            token: math.log(1 + (total_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for token, posting in self.postings.items()
+        }
+        self.max_idf = math.log(1 + (total_docs + 0.5) / 0.5)
+
+    def search(self, question: str) -> Optional[Dict[str, Any]]:
+        """
+        Возвращает лучший документ с BM25-скором, уверенностью 0..1 (доля idf-массы запроса, найденная в документе)
+        и числом совпавших слов запроса, из них — ключевых слов документа
+        """
+        tokens = set(normalize_faq_tokens(question))
+        if not tokens:
+            return None
+
+        scores = {}
+        matched_idf = {}
+        matched_tokens = {}
+        matched_keywords = {}
+        for token in tokens:
+            idf = self.idf.get(token)
+            if idf is None:
+                continue
+            for doc_id, tf in self.postings[token]:
+                norm = FAQ_BM25_K1 * (1 - FAQ_BM25_B + FAQ_BM25_B * self.doc_lengths[doc_id] / self.avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (FAQ_BM25_K1 + 1) / (tf + norm)
+                matched_idf[doc_id] = matched_idf.get(doc_id, 0.0) + idf
+                matched_tokens[doc_id] = matched_tokens.get(doc_id, 0) + 1
+                if token in self.keywords[doc_id]:
+                    matched_keywords[doc_id] = matched_keywords.get(doc_id, 0) + 1
+
+        if not scores:
+            return None
+
+        best_id = max(scores, key=scores.get)
+        query_idf = sum(self.idf.get(token, self.max_idf) for token in tokens)
+        return {
+            'key': self.documents[best_id]['key'],
+            'answer': self.documents[best_id]['answer'],
+            'score': scores[best_id],
+            'confidence': matched_idf[best_id] / query_idf,
+            'matched_tokens': matched_tokens[best_id],
+            'matched_keywords': matched_keywords.get(best_id, 0)
+        }
+
+
+def load_faq_documents() -> list:
+    """Собирает документы индекса: статичные FAQ_ANSWERS, тексты bot_content и таблица bot_faq_entries"""
+    documents = [
+        {'key': f'static:{key}', 'text': f"{FAQ_QUESTIONS.get(key, '')} {answer}", 'answer': answer}
+        for key, answer in FAQ_ANSWERS.items()
+    ]
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute(f"""
+            SELECT {', '.join(FAQ_BOT_CONTENT_FIELDS)}
+            FROM t_p25272970_courier_button_site.bot_content
+            WHERE id = 1
+        """)
+        content = cursor.fetchone()
+        if content:
+            for field, hint in FAQ_BOT_CONTENT_FIELDS.items():
+                if content[field]:
+                    documents.append({'key': f'bot_content:{field}', 'text': f'{hint} {content[field]}', 'answer': content[field]})
+
+        cursor.execute("""
+            SELECT id, question, answer
+            FROM t_p25272970_courier_button_site.bot_faq_entries
+            WHERE is_active = true
+        """)
+        for row in cursor.fetchall():
+            documents.append({'key': f"entry:{row['id']}", 'text': f"{row['question']} {row['question']} {row['answer']}", 'answer': row['answer']})
+    finally:
+        cursor.close()
+        conn.close()
+
+    return documents
+
+
+def get_faq_index() -> 'FaqIndex':
+    """Возвращает закэшированный индекс; при недоступной БД строит временный индекс только по FAQ_ANSWERS"""
+    global _faq_index
+
+    if _faq_index is None:
+        try:
+            _faq_index = FaqIndex(load_faq_documents())
+        except Exception as e:
+            print(f'Error loading FAQ documents: {e}')
+            return FaqIndex([
+                {'key': f'static:{key}', 'text': f"{FAQ_QUESTIONS.get(key, '')} {answer}", 'answer': answer}
+                for key, answer in FAQ_ANSWERS.items()
+            ])
+
+    return _faq_index
+
+
+def faq_match_accepted(match: Optional[Dict[str, Any]]) -> bool:
+    """
+    Ответ индекса принимается: ключевое слово документа или минимум FAQ_MIN_MATCHED_TOKENS совпавших слов,
+    затем пороги уверенности и скора
+    """
+    return bool(match) and (match['matched_keywords'] > 0 or match['matched_tokens'] >= FAQ_MIN_MATCHED_TOKENS) \
+        and match['confidence'] >= FAQ_MIN_CONFIDENCE and match['score'] >= FAQ_MIN_SCORE
+
+
 def get_faq_answer(question: str) -> Optional[str]:
-    """Проверяет вопрос на совпадение с FAQ"""
-    q_lower = question.lower()
-    
-    if any(word in q_lower for word in ['час', 'заработок', 'зарплат', 'сколько', 'платят', 'доход']):
-        if 'час' in q_lower or 'заработать' in q_lower:
-            return FAQ_ANSWERS['заработок_час']
-    
-    if any(word in q_lower for word in ['выплат', 'деньги', 'получ', 'когда', 'перевод']):
-        return FAQ_ANSWERS['выплаты']
-    
-    if any(word in q_lower for word in ['регистр', 'устроиться', 'начать', 'подать']):
-        return FAQ_ANSWERS['регистрация']
-    
-    if any(word in q_lower for word in ['требован', 'нужно', 'условия', 'возраст']):
-        return FAQ_ANSWERS['требования']
-    
-    return None
+    """Ищет ответ в локальном FAQ-индексе. None — совпадение слабое, вопрос уходит в LLM"""
+    match = get_faq_index().search(question)
+    return match['answer'] if faq_match_accepted(match) else None
+
+
+def evaluate_faq_index(index: 'FaqIndex' = None) -> Dict[str, Any]:
+    """Офлайн-оценка на FAQ_EVAL_SET: точность ответов индекса и доля вопросов, не дошедших до LLM"""
+    index = index or get_faq_index()
+    answered = correct = 0
+    started = time.perf_counter()
+
+    for question, expected_key in FAQ_EVAL_SET:
+        match = index.search(question)
+        if faq_match_accepted(match):
+            answered += 1
+            if match['key'] == expected_key:
+                correct += 1
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    return {
+        'questions': len(FAQ_EVAL_SET),
+        'answered': answered,
+        'precision': correct / answered if answered else 0.0,
+        'llm_call_reduction': answered / len(FAQ_EVAL_SET),
+        'avg_latency_ms': elapsed_ms / len(FAQ_EVAL_SET)
+    }
 
 def search_web(query: str, chat_id: int) -> tuple[str, Dict]:
     """Поиск в интернете через Yandex с красивой кнопкой"""
@@ -279,33 +571,293 @@ def search_web(query: str, chat_id: int) -> tuple[str, Dict]:
     except:
         return "Не могу выполнить поиск, попробуй загуглить самостоятельно 🙏", {}
 
-def detect_city_in_text(text: str) -> Optional[str]:
-    """Определяет название города в тексте"""
-    common_cities = [
-        'москва', 'санкт-петербург', 'петербург', 'спб', 'новосибирск', 'екатеринбург',
-        'казань', 'нижний новгород', 'челябинск', 'самара', 'омск', 'ростов', 'уфа',
-        'красноярск', 'воронеж', 'пермь', 'волгоград', 'краснодар', 'саратов', 'тюмень',
-        'тольятти', 'ижевск', 'барнаул', 'ульяновск', 'иркутск', 'хабаровск', 'ярославль',
-        'владивосток', 'махачкала', 'томск', 'оренбург', 'кемерово', 'новокузнецк', 'рязань',
-        'астрахань', 'пенза', 'киров', 'липецк', 'чебоксары', 'калининград', 'тула', 'курск',
-        'сочи', 'ставрополь', 'севастополь', 'тверь', 'магнитогорск', 'иваново', 'брянск',
-        'белгород', 'сургут', 'владимир', 'архангельск', 'чита', 'калуга', 'смоленск', 'волжский'
-    ]
+CITY_NAMES = [
+    'Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург', 'Казань', 'Нижний Новгород',
+    'Челябинск', 'Самара', 'Омск', 'Ростов-на-Дону', 'Уфа', 'Красноярск', 'Воронеж', 'Пермь',
+    'Волгоград', 'Краснодар', 'Саратов', 'Тюмень', 'Тольятти', 'Ижевск', 'Барнаул', 'Ульяновск',
+    'Иркутск', 'Хабаровск', 'Ярославль', 'Владивосток', 'Махачкала', 'Томск', 'Оренбург', 'Кемерово',
+    'Новокузнецк', 'Рязань', 'Астрахань', 'Пенза', 'Киров', 'Липецк', 'Чебоксары', 'Калининград',
+    'Тула', 'Курск', 'Сочи', 'Ставрополь', 'Севастополь', 'Тверь', 'Магнитогорск', 'Иваново',
+    'Брянск', 'Белгород', 'Сургут', 'Владимир', 'Архангельск', 'Чита', 'Калуга', 'Смоленск', 'Волжский'
+]
+
+CITY_ALIASES = {
+    'спб': 'Санкт-Петербург',
+    'питер': 'Санкт-Петербург',
+    'петербург': 'Санкт-Петербург',
+    'мск': 'Москва',
+    'екб': 'Екатеринбург',
+    'нск': 'Новосибирск',
+    'нн': 'Нижний Новгород',
+    'ростов': 'Ростов-на-Дону'
+}
+
+# Падежные окончания, допустимые после основы названия ("в Казани", "из Москвы", "в Нижнем Новгороде")
+CITY_INFLECTIONS = '(?:а|у|е|ы|и|о|ой|ом|ою|ю|ью|я|ь)?'
+CITY_ADJECTIVE_INFLECTIONS = '(?:ий|ый|ем|ом|его|ого|ему|ому|им|ым)'
+
+# Короткие и несклоняемые формы ищем только целым словом, без окончаний
+CITY_EXACT_MAX_LENGTH = 3
+
+# Корпус реальных сообщений боту: (текст, ожидаемый город или None)
+CITY_EVAL_CORPUS = [
+    ('Москва', 'Москва'),
+    ('я из москвы', 'Москва'),
+    ('Живу в Санкт-Петербурге', 'Санкт-Петербург'),
+    ('спб', 'Санкт-Петербург'),
+    ('Питер', 'Санкт-Петербург'),
+    ('в нижнем новгороде', 'Нижний Новгород'),
+    ('Нижний-Новгород', 'Нижний Новгород'),
+    ('Ростов на Дону', 'Ростов-на-Дону'),
+    ('где арендовать велосипед в казани', 'Казань'),
+    ('город Уфа', 'Уфа'),
+    ('Сочи', 'Сочи'),
+    ('Екб', 'Екатеринбург'),
+    ('Тюмень', 'Тюмень'),
+    ('Привет', None),
+    ('Ок спасибо', None),
+    ('Сколько платят?', None),
+    ('Термокороб нужен?', None),
+    ('Хочу работать', None),
+    ('Доставка в выходные', None),
+    ('какой график', None),
+    ('омские новости', None),
+    ('туларемия', None),
+    ('Прувет как дела', None)
+]
+
+_city_matcher = None
+
+
+def normalize_city_text(text: str) -> str:
+    """Нормализация для сопоставления городов: регистр, ё→е, дефисы и точки как пробелы"""
+    text = text.lower().replace('ё', 'е')
+    text = re.sub(r'[-‐–—.]', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def city_name_pattern(normalized_name: str) -> str:
+    """Регулярка для одного названия: каждое слово — основа плюс необязательное падежное окончание"""
+    parts = []
+    for word in normalized_name.split(' '):
+        if len(word) <= CITY_EXACT_MAX_LENGTH or word in ('на', 'дону'):
+            parts.append(re.escape(word))
+            continue
+        if word.endswith(('ий', 'ый')):
+            parts.append(re.escape(word[:-2]) + CITY_ADJECTIVE_INFLECTIONS)
+        elif word[-1] in 'аеиоуыюяьй':
+            parts.append(re.escape(word[:-1]) + CITY_INFLECTIONS)
+        else:
+            parts.append(re.escape(word) + CITY_INFLECTIONS)
+    return r'\s'.join(parts)
+
+
+class CityMatcher:
+    """Газеттир городов, скомпилированный в одну регулярку с границами слов"""
+
+    def __init__(self, names: list, aliases: Dict[str, str]):
+        self.canonical = {}
+        for name in names:
+            self.canonical.setdefault(normalize_city_text(name), name)
+        for alias, name in aliases.items():
+            self.canonical.setdefault(normalize_city_text(alias), name)
+
+        self.patterns = {}
+        for normalized in sorted(self.canonical, key=len, reverse=True):
+            self.patterns.setdefault(city_name_pattern(normalized), normalized)
+
+        self.group_names = {}
+        alternatives = []
+        for i, (pattern, normalized) in enumerate(self.patterns.items()):
+            self.group_names[f'c{i}'] = normalized
+            alternatives.append(f'(?P<c{i}>{pattern})')
+        self.regex = re.compile(r'\b(?:' + '|'.join(alternatives) + r')\b') if alternatives else None
+
+    def find(self, text: str) -> Optional[str]:
+        if not self.regex:
+            return None
+        match = self.regex.search(normalize_city_text(text))
+        if not match:
+            return None
+        return self.canonical[self.group_names[match.lastgroup]]
+
+
+def load_known_cities() -> list:
+    """Города из профилей курьеров (users.city) — дополняют статичный список"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("""
+            SELECT DISTINCT TRIM(city) AS city
+            FROM t_p25272970_courier_button_site.users
+            WHERE city IS NOT NULL AND LENGTH(TRIM(city)) BETWEEN 3 AND 40
+        """)
+        return [row['city'] for row in cursor.fetchall() if not any(ch.isdigit() for ch in row['city'])]
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def get_city_matcher() -> CityMatcher:
+    """Возвращает газеттир, собранный один раз на тёплый контейнер; без БД — только по статичному списку"""
+    global _city_matcher
     
-    text_lower = text.lower().strip()
+    if _city_matcher is None:
+        try:
+            _city_matcher = CityMatcher(CITY_NAMES + load_known_cities(), CITY_ALIASES)
+        except Exception as e:
+            print(f'Error loading known cities: {e}')
+            return CityMatcher(CITY_NAMES, CITY_ALIASES)
+    
+    return _city_matcher
+
+
+def detect_city_in_text(text: str) -> Optional[str]:
+    """Определяет название города в тексте одним проходом скомпилированного газеттира"""
+    return get_city_matcher().find(text)
+
+
+def evaluate_city_matcher(matcher: CityMatcher = None, rounds: int = 1000) -> Dict[str, Any]:
+    """Точность на CITY_EVAL_CORPUS и средняя стоимость одного сопоставления"""
+    matcher = matcher or get_city_matcher()
+    correct = sum(1 for text, expected in CITY_EVAL_CORPUS if matcher.find(text) == expected)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text, _expected in CITY_EVAL_CORPUS:
+            matcher.find(text)
+    elapsed_us = (time.perf_counter() - started) * 1_000_000
+
+    return {
+        'messages': len(CITY_EVAL_CORPUS),
+        'accuracy': correct / len(CITY_EVAL_CORPUS),
+        'avg_match_us': elapsed_us / (rounds * len(CITY_EVAL_CORPUS))
+    }
+
+class OutboundGuard:
+    """Защита исходящего вызова: дедлайн, single-flight для одинаковых запросов, circuit breaker и метрики"""
+
+    def __init__(self, name: str, timeout: float, failure_threshold: int = 3, reset_after: float = 30.0):
+        self.name = name
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.metrics = {
+            'calls': 0, 'successes': 0, 'failures': 0, 'short_circuited': 0,
+            'coalesced': 0, 'total_latency_ms': 0.0, 'max_latency_ms': 0.0
+        }
+
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return 'half_open'
+        return 'open'
+
+    def call(self, key: str, func, fallback):
+        """Выполняет func(timeout) или возвращает fallback, если зависимость деградировала.
+        Одинаковые по key запросы, пришедшие пока первый в полёте, получают его результат"""
+        leader = False
+        with self.lock:
+            state = self.state()
+            if state == 'open' or (state == 'half_open' and self.probe_in_flight):
+                self.metrics['short_circuited'] += 1
+                return fallback
+
+            flight = self.in_flight.get(key)
+            if flight:
+                self.metrics['coalesced'] += 1
+            else:
+                flight = {'event': threading.Event(), 'result': fallback}
+                self.in_flight[key] = flight
+                if state == 'half_open':
+                    self.probe_in_flight = True
+                leader = True
+        if not leader:
+            flight['event'].wait(self.timeout)
+            return flight['result']
+
+        started = time.monotonic()
+        ok = False
+        try:
+            flight['result'] = func(self.timeout)
+            ok = True
+        except Exception as e:
+            print(f'Outbound {self.name} error: {e}')
+        finally:
+            elapsed_ms = (time.monotonic() - started) * 1000
+            with self.lock:
+                self.metrics['calls'] += 1
+                self.metrics['total_latency_ms'] += elapsed_ms
+                self.metrics['max_latency_ms'] = max(self.metrics['max_latency_ms'], elapsed_ms)
+                self.probe_in_flight = False
+                if ok:
+                    self.metrics['successes'] += 1
+                    self.consecutive_failures = 0
+                    self.opened_at = None
+                else:
+                    self.metrics['failures'] += 1
+                    self.consecutive_failures += 1
+                    if self.consecutive_failures >= self.failure_threshold:
+                        self.opened_at = time.monotonic()
+                        print(f'Outbound {self.name}: circuit opened after {self.consecutive_failures} failures')
+                del self.in_flight[key]
+            flight['event'].set()
+
+        return flight['result']
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            calls = self.metrics['calls']
+            return {
+                **self.metrics,
+                'state': self.state(),
+                'consecutive_failures': self.consecutive_failures,
+                'avg_latency_ms': self.metrics['total_latency_ms'] / calls if calls else 0.0
+            }
+
+
+# Дедлайн LLM держим заметно ниже таймаута вебхука, чтобы ответ уходил даже при деградации YandexGPT
+yandex_gpt_guard = OutboundGuard('yandex_gpt', timeout=8.0, failure_threshold=3, reset_after=30.0)
+
+
+def request_yandex_gpt(system_prompt: str, user_message: str, timeout: float) -> str:
+    url = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Api-Key {YANDEX_GPT_API_KEY}',
+        'x-folder-id': YANDEX_FOLDER_ID
+    }
     
-    # Проверяем прямое совпадение
-    for city in common_cities:
-        if city in text_lower:
-            return city.capitalize()
+    data = {
+        'modelUri': f'gpt://{YANDEX_FOLDER_ID}/yandexgpt-lite',
+        'completionOptions': {
+            'stream': False,
+            'temperature': 0.3,
+            'maxTokens': 800
+        },
+        'messages': [
+            {'role': 'system', 'text': system_prompt},
+            {'role': 'user', 'text': user_message}
+        ]
+    }
     
-    # Если текст короткий (до 30 символов) и без вопросительных слов - возможно это город
-    if len(text_lower) < 30 and not any(q in text_lower for q in ['где', 'как', 'что', 'когда', 'почему', 'зачем', 'сколько']):
-        words = text_lower.split()
-        if len(words) <= 3:  # Город обычно 1-2 слова
-            return text.strip().title()
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(data).encode('utf-8'),
+        headers=headers
+    )
     
-    return None
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        result = json.loads(response.read().decode('utf-8'))
+        return result['result']['alternatives'][0]['message']['text']
+
 
 def ask_ai_assistant(question: str, is_registered: bool = False, user_city: str = None, telegram_id: int = None, chat_id: int = None) -> tuple[str, Optional[str], Optional[Dict]]:
     """AI помощник на основе YandexGPT с FAQ и веб-поиском. Возвращает (ответ, новый_город, keyboard)"""
@@ -371,45 +923,22 @@ def ask_ai_assistant(question: str, is_registered: bool = False, user_city: str
 ОТВЕЧАЙ КОНКРЕТНО НА ВОПРОС! Если спрашивают про час — говори про час, если про день — про день.
 Используй эмодзи и будь полезным! 🚀"""
 
-        url = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Api-Key {YANDEX_GPT_API_KEY}',
-            'x-folder-id': YANDEX_FOLDER_ID
-        }
-        
         user_message = question
         if user_city:
             user_message = f"Город пользователя: {user_city}. Вопрос: {question}"
         
-        data = {
-            'modelUri': f'gpt://{YANDEX_FOLDER_ID}/yandexgpt-lite',
-            'completionOptions': {
-                'stream': False,
-                'temperature': 0.3,
-                'maxTokens': 800
-            },
-            'messages': [
-                {'role': 'system', 'text': system_prompt},
-                {'role': 'user', 'text': user_message}
-            ]
-        }
-        
-        req = urllib.request.Request(
-            url,
-            data=json.dumps(data).encode('utf-8'),
-            headers=headers
+        flight_key = hashlib.sha256(f'{is_registered}|{user_message}'.encode('utf-8')).hexdigest()
+        answer = yandex_gpt_guard.call(
+            flight_key,
+            lambda timeout: request_yandex_gpt(system_prompt, user_message, timeout),
+            AI_FALLBACK_TEXT
         )
-        
-        with urllib.request.urlopen(req, timeout=30) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            answer = result['result']['alternatives'][0]['message']['text']
-            return answer, None, None
+        return answer, None, None
     except Exception as e:
         print(f'AI Assistant error: {e}')
         import traceback
         traceback.print_exc()
-        return "Извини, сейчас не могу ответить. Попробуй позже или задай вопрос в поддержке на сайте! 🙏", None, None
+        return AI_FALLBACK_TEXT, None, None
 
 def start_linking_process(telegram_id: int, username: str = None) -> str:
     """Создаёт временную запись для привязки и возвращает уникальный link_token"""
@@ -970,53 +1499,34 @@ def handle_registered_callbacks(callback_data: str, courier_id: int) -> tuple[st
     
     return "", {}
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    """
-    Главный обработчик webhook от Telegram
-    """
-    method = event.get('httpMethod', 'POST')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    try:
-        body = json.loads(event.get('body', '{}'))
+def process_update(body: Dict[str, Any]):
+    """Обработка одного update от Telegram. Общая для webhook и long-polling режима"""
+    if 'message' in body:
+        message = body['message']
+        chat_id = message['chat']['id']
+        telegram_id = message['from']['id']
+        username = message['from'].get('username')
+        first_name = message['from'].get('first_name')
+        text = message.get('text', '')
         
-        if 'message' in body:
-            message = body['message']
-            chat_id = message['chat']['id']
-            telegram_id = message['from']['id']
-            username = message['from'].get('username')
-            first_name = message['from'].get('first_name')
-            text = message.get('text', '')
-            
-            if text.startswith('/start'):
-                # Проверяем есть ли параметр привязки
-                if ' link' in text:
-                    courier = get_courier_by_telegram(telegram_id)
-                    if courier:
-                        # Уже привязан
-                        send_telegram_message(chat_id, "✅ <b>Твой Telegram уже привязан!</b>\n\nНажми /start для главного меню.")
-                    else:
-                        # Генерируем токен для привязки
-                        link_token = start_linking_process(telegram_id, username)
-                        if link_token:
-                            link_url = f'{WEBSITE_URL}/auth/telegram-link?token={link_token}'
-                            link_keyboard = {
-                                'inline_keyboard': [
-                                    [{'text': '🔗 Привязать аккаунт', 'url': link_url}]
-                                ]
-                            }
-                            link_message = f"""🔗 <b>ПРИВЯЗКА TELEGRAM К АККАУНТУ</b>
+        if text.startswith('/start'):
+            # Проверяем есть ли параметр привязки
+            if ' link' in text:
+                courier = get_courier_by_telegram(telegram_id)
+                if courier:
+                    # Уже привязан
+                    send_telegram_message(chat_id, "✅ <b>Твой Telegram уже привязан!</b>\n\nНажми /start для главного меню.")
+                else:
+                    # Генерируем токен для привязки
+                    link_token = start_linking_process(telegram_id, username)
+                    if link_token:
+                        link_url = f'{WEBSITE_URL}/auth/telegram-link?token={link_token}'
+                        link_keyboard = {
+                            'inline_keyboard': [
+                                [{'text': '🔗 Привязать аккаунт', 'url': link_url}]
+                            ]
+                        }
+                        link_message = f"""🔗 <b>ПРИВЯЗКА TELEGRAM К АККАУНТУ</b>
 
 <b>Шаг 1:</b> Нажми кнопку ниже
 <b>Шаг 2:</b> Войди в свой аккаунт на сайте (если ещё не вошёл)
@@ -1029,65 +1539,60 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 • Статус выплат 💰
 • Статистика в боте 📊
 • Быстрый доступ к функциям ⚡"""
-                            send_telegram_message(chat_id, link_message, reply_markup=link_keyboard)
-                        else:
-                            send_telegram_message(chat_id, "❌ Ошибка создания ссылки. Попробуй /start снова.")
-                    return {
-                        'statusCode': 200,
-                        'headers': {'Content-Type': 'application/json'},
-                        'body': json.dumps({'ok': True}),
-                        'isBase64Encoded': False
-                    }
-                
-                # Обычный /start
-                response_text, inline_keyboard = handle_start_command(telegram_id, username, first_name)
-                courier = get_courier_by_telegram(telegram_id)
-                reply_keyboard = get_reply_keyboard(is_registered=bool(courier))
-                
-                # Отправляем сообщение с reply keyboard
-                send_telegram_message(chat_id, response_text, reply_markup=reply_keyboard)
-                # Отправляем inline кнопки отдельным сообщением если есть
-                if inline_keyboard:
-                    send_telegram_message(chat_id, "Быстрые действия:", reply_markup=inline_keyboard)
+                        send_telegram_message(chat_id, link_message, reply_markup=link_keyboard)
+                    else:
+                        send_telegram_message(chat_id, "❌ Ошибка создания ссылки. Попробуй /start снова.")
+                return
             
-            else:
-                courier = get_courier_by_telegram(telegram_id)
-                
-                # Список кнопок меню, которые НЕ должны идти в AI
-                registered_menu_buttons = [
-                    '📊 Статистика',
-                    '💰 Реферальная ссылка',
-                    '💸 Заработок',
-                    '🎮 Игры',
-                    '⚙️ Настройки',
-                    '🤖 AI Помощник',
-                    '❓ Помощь'
-                ]
-                
-                # Обработка текстовых команд из reply keyboard
-                if courier:
-                    if text == '📊 Статистика':
-                        response_text, keyboard = handle_registered_callbacks('stats', courier['courier_id'])
-                        send_telegram_message(chat_id, response_text, reply_markup=keyboard)
-                    elif text == '💰 Реферальная ссылка':
-                        response_text, keyboard = handle_registered_callbacks('referral', courier['courier_id'])
-                        send_telegram_message(chat_id, response_text, reply_markup=keyboard)
-                    elif text == '💸 Заработок':
-                        response_text, keyboard = handle_registered_callbacks('earnings_detail', courier['courier_id'])
-                        send_telegram_message(chat_id, response_text, reply_markup=keyboard)
-                    elif text == '🎮 Игры':
-                        games_keyboard = {
-                            'inline_keyboard': [
-                                [{'text': '🎮 Открыть игры', 'url': f'{WEBSITE_URL}/dashboard?tab=game'}],
-                                [{'text': '◀️ Назад', 'callback_data': 'menu'}]
-                            ]
-                        }
-                        send_telegram_message(chat_id, "🎮 <b>ИГРЫ И РАЗВЛЕЧЕНИЯ</b>\n\nОткрой мини-игры на сайте! 🎁", reply_markup=games_keyboard)
-                    elif text == '⚙️ Настройки':
-                        response_text, keyboard = handle_registered_callbacks('settings', courier['courier_id'])
-                        send_telegram_message(chat_id, response_text, reply_markup=keyboard)
-                    elif text == '🤖 AI Помощник':
-                        ai_text = """🤖 <b>AI ПОМОЩНИК</b>
+            # Обычный /start
+            response_text, inline_keyboard = handle_start_command(telegram_id, username, first_name)
+            courier = get_courier_by_telegram(telegram_id)
+            reply_keyboard = get_reply_keyboard(is_registered=bool(courier))
+            
+            # Отправляем сообщение с reply keyboard
+            send_telegram_message(chat_id, response_text, reply_markup=reply_keyboard)
+            # Отправляем inline кнопки отдельным сообщением если есть
+            if inline_keyboard:
+                send_telegram_message(chat_id, "Быстрые действия:", reply_markup=inline_keyboard)
+        
+        else:
+            courier = get_courier_by_telegram(telegram_id)
+            
+            # Список кнопок меню, которые НЕ должны идти в AI
+            registered_menu_buttons = [
+                '📊 Статистика',
+                '💰 Реферальная ссылка',
+                '💸 Заработок',
+                '🎮 Игры',
+                '⚙️ Настройки',
+                '🤖 AI Помощник',
+                '❓ Помощь'
+            ]
+            
+            # Обработка текстовых команд из reply keyboard
+            if courier:
+                if text == '📊 Статистика':
+                    response_text, keyboard = handle_registered_callbacks('stats', courier['courier_id'])
+                    send_telegram_message(chat_id, response_text, reply_markup=keyboard)
+                elif text == '💰 Реферальная ссылка':
+                    response_text, keyboard = handle_registered_callbacks('referral', courier['courier_id'])
+                    send_telegram_message(chat_id, response_text, reply_markup=keyboard)
+                elif text == '💸 Заработок':
+                    response_text, keyboard = handle_registered_callbacks('earnings_detail', courier['courier_id'])
+                    send_telegram_message(chat_id, response_text, reply_markup=keyboard)
+                elif text == '🎮 Игры':
+                    games_keyboard = {
+                        'inline_keyboard': [
+                            [{'text': '🎮 Открыть игры', 'url': f'{WEBSITE_URL}/dashboard?tab=game'}],
+                            [{'text': '◀️ Назад', 'callback_data': 'menu'}]
+                        ]
+                    }
+                    send_telegram_message(chat_id, "🎮 <b>ИГРЫ И РАЗВЛЕЧЕНИЯ</b>\n\nОткрой мини-игры на сайте! 🎁", reply_markup=games_keyboard)
+                elif text == '⚙️ Настройки':
+                    response_text, keyboard = handle_registered_callbacks('settings', courier['courier_id'])
+                    send_telegram_message(chat_id, response_text, reply_markup=keyboard)
+                elif text == '🤖 AI Помощник':
+                    ai_text = """🤖 <b>AI ПОМОЩНИК</b>
 
 Привет! Я твой интеллектуальный помощник!
 
@@ -1103,49 +1608,49 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 • "Как вывести деньги?"
 • "Сколько платят за реферала?"
 • "Как работать в Яндекс.Еде?"""
-                        send_telegram_message(chat_id, ai_text)
-                    elif text == '❓ Помощь':
-                        response_text, keyboard = handle_registered_callbacks('help', telegram_id)
-                        send_telegram_message(chat_id, response_text, reply_markup=keyboard)
-                    
-                    elif text in registered_menu_buttons:
-                        # Если нажата кнопка меню, но не обработана выше - игнорируем
-                        send_telegram_message(chat_id, "⚠️ Эта кнопка в разработке. Попробуй другие функции!")
+                    send_telegram_message(chat_id, ai_text)
+                elif text == '❓ Помощь':
+                    response_text, keyboard = handle_registered_callbacks('help', telegram_id)
+                    send_telegram_message(chat_id, response_text, reply_markup=keyboard)
+                
+                elif text in registered_menu_buttons:
+                    # Если нажата кнопка меню, но не обработана выше - игнорируем
+                    send_telegram_message(chat_id, "⚠️ Эта кнопка в разработке. Попробуй другие функции!")
 
-                    else:
-                        # Проверка на обновление профиля (ФИО из 3 слов)
-                        words = text.strip().split()
-                        if len(words) >= 2 and all(word[0].isupper() for word in words if word):
-                            # Похоже на ФИО - обновляем профиль
-                            full_name = ' '.join(words)
+                else:
+                    # Проверка на обновление профиля (ФИО из 3 слов)
+                    words = text.strip().split()
+                    if len(words) >= 2 and all(word[0].isupper() for word in words if word):
+                        # Похоже на ФИО - обновляем профиль
+                        full_name = ' '.join(words)
+                        
+                        try:
+                            # Обновляем профиль через API
+                            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+                            cursor = conn.cursor()
                             
-                            try:
-                                # Обновляем профиль через API
-                                conn = psycopg2.connect(os.environ['DATABASE_URL'])
-                                cursor = conn.cursor()
-                                
-                                cursor.execute("""
+                            cursor.execute("""
                                     UPDATE t_p25272970_courier_button_site.users
                                     SET full_name = %s
                                     WHERE id = %s
                                     RETURNING full_name, phone, city
                                 """, (full_name, courier['courier_id']))
-                                
-                                updated = cursor.fetchone()
-                                
-                                # Обновляем имя в лидерборде игр
-                                cursor.execute("""
+                            
+                            updated = cursor.fetchone()
+                            
+                            # Обновляем имя в лидерборде игр
+                            cursor.execute("""
                                     UPDATE t_p25272970_courier_button_site.courier_game_leaderboard
                                     SET player_name = %s
                                     WHERE user_id = %s
                                 """, (full_name, courier['courier_id']))
-                                
-                                conn.commit()
-                                cursor.close()
-                                conn.close()
-                                
-                                if updated:
-                                    success_text = f"""✅ <b>ПРОФИЛЬ ОБНОВЛЁН!</b>
+                            
+                            conn.commit()
+                            cursor.close()
+                            conn.close()
+                            
+                            if updated:
+                                success_text = f"""✅ <b>ПРОФИЛЬ ОБНОВЛЁН!</b>
 
 <b>📝 Новые данные:</b>
 • Имя: {updated[0]}
@@ -1154,73 +1659,73 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
 <b>💡 Чтобы изменить телефон или город:</b>
 Зайди в личный кабинет на сайте!"""
-                                    
-                                    keyboard = {
-                                        'inline_keyboard': [
-                                            [{'text': '📱 Личный кабинет', 'url': f'{WEBSITE_URL}/dashboard'}],
-                                            [{'text': '⚙️ Настройки', 'callback_data': 'settings'}]
-                                        ]
-                                    }
-                                    send_telegram_message(chat_id, success_text, reply_markup=keyboard)
-                                else:
-                                    send_telegram_message(chat_id, "❌ Ошибка обновления профиля. Попробуй ещё раз!")
-                            except Exception as e:
-                                print(f'Error updating profile: {e}')
-                                send_telegram_message(chat_id, "❌ Ошибка обновления профиля. Попробуй ещё раз!")
-                        
-                        else:
-                            # Любой другой текст (НЕ кнопка меню, НЕ ФИО) = вопрос к AI
-                            thinking_msg = send_telegram_message(chat_id, "🤖 Думаю...")
-                            thinking_msg_id = thinking_msg.get('result', {}).get('message_id') if thinking_msg else None
-                            
-                            # Получаем город курьера из БД
-                            stats = get_courier_stats(courier['courier_id'])
-                            user_city = stats.get('city') if stats.get('city') != 'Не указан' else None
-                            
-                            # Если нет города из профиля, пытаемся взять из контекста
-                            if not user_city:
-                                user_city = get_user_city(telegram_id)
-                            
-                            answer, new_city, keyboard = ask_ai_assistant(text, is_registered=True, user_city=user_city, telegram_id=telegram_id, chat_id=chat_id)
-                            
-                            # Сохраняем новый город если определили
-                            if new_city:
-                                save_user_city(telegram_id, new_city)
-                            
-                            # Редактируем сообщение "Думаю..." вместо отправки нового
-                            if thinking_msg_id:
-                                edit_telegram_message(chat_id, thinking_msg_id, f"🤖 <b>AI Помощник:</b>\n\n{answer}", reply_markup=keyboard)
+                                
+                                keyboard = {
+                                    'inline_keyboard': [
+                                        [{'text': '📱 Личный кабинет', 'url': f'{WEBSITE_URL}/dashboard'}],
+                                        [{'text': '⚙️ Настройки', 'callback_data': 'settings'}]
+                                    ]
+                                }
+                                send_telegram_message(chat_id, success_text, reply_markup=keyboard)
                             else:
-                                send_telegram_message(chat_id, f"🤖 <b>AI Помощник:</b>\n\n{answer}", reply_markup=keyboard)
-                else:
-                    # Незарегистрированные - обработка кнопок меню
-                    # Список кнопок меню, которые НЕ должны идти в AI
-                    menu_buttons = [
-                        '📊 Статистика',
-                        '💰 Реферальная ссылка',
-                        '💸 Заработок',
-                        '🎮 Игры',
-                        '⚙️ Настройки',
-                        '❓ Помощь',
-                        '🚀 Зарегистрироваться',
-                        '💰 Заработок',
-                        '💰 Сколько можно заработать?',
-                        '📋 Требования',
-                        '🎁 Реферальная программа',
-                        '🎮 Игры и бонусы',
-                        '🔗 Привязать аккаунт',
-                        '🤖 AI Помощник',
-                        '❓ FAQ'
-                    ]
+                                send_telegram_message(chat_id, "❌ Ошибка обновления профиля. Попробуй ещё раз!")
+                        except Exception as e:
+                            print(f'Error updating profile: {e}')
+                            send_telegram_message(chat_id, "❌ Ошибка обновления профиля. Попробуй ещё раз!")
                     
-                    if text == '🚀 Быстрая регистрация в боте':
-                        # Регистрация прямо в боте
-                        reg_msg = send_telegram_message(chat_id, "⏳ Создаю твой аккаунт...")
+                    else:
+                        # Любой другой текст (НЕ кнопка меню, НЕ ФИО) = вопрос к AI
+                        thinking_msg = send_telegram_message(chat_id, "🤖 Думаю...")
+                        thinking_msg_id = thinking_msg.get('result', {}).get('message_id') if thinking_msg else None
+                        
+                        # Получаем город курьера из БД
+                        stats = get_courier_stats(courier['courier_id'])
+                        user_city = stats.get('city') if stats.get('city') != 'Не указан' else None
+                        
+                        # Если нет города из профиля, пытаемся взять из контекста
+                        if not user_city:
+                            user_city = get_user_city(telegram_id)
                         
-                        result = register_via_bot(telegram_id, username, first_name)
+                        answer, new_city, keyboard = ask_ai_assistant(text, is_registered=True, user_city=user_city, telegram_id=telegram_id, chat_id=chat_id)
                         
-                        if result.get('success'):
-                            success_text = f"""🎉 <b>РЕГИСТРАЦИЯ ЗАВЕРШЕНА!</b>
+                        # Сохраняем новый город если определили
+                        if new_city:
+                            save_user_city(telegram_id, new_city)
+                        
+                        # Редактируем сообщение "Думаю..." вместо отправки нового
+                        if thinking_msg_id:
+                            edit_telegram_message(chat_id, thinking_msg_id, f"🤖 <b>AI Помощник:</b>\n\n{answer}", reply_markup=keyboard)
+                        else:
+                            send_telegram_message(chat_id, f"🤖 <b>AI Помощник:</b>\n\n{answer}", reply_markup=keyboard)
+            else:
+                # Незарегистрированные - обработка кнопок меню
+                # Список кнопок меню, которые НЕ должны идти в AI
+                menu_buttons = [
+                    '📊 Статистика',
+                    '💰 Реферальная ссылка',
+                    '💸 Заработок',
+                    '🎮 Игры',
+                    '⚙️ Настройки',
+                    '❓ Помощь',
+                    '🚀 Зарегистрироваться',
+                    '💰 Заработок',
+                    '💰 Сколько можно заработать?',
+                    '📋 Требования',
+                    '🎁 Реферальная программа',
+                    '🎮 Игры и бонусы',
+                    '🔗 Привязать аккаунт',
+                    '🤖 AI Помощник',
+                    '❓ FAQ'
+                ]
+                
+                if text == '🚀 Быстрая регистрация в боте':
+                    # Регистрация прямо в боте
+                    reg_msg = send_telegram_message(chat_id, "⏳ Создаю твой аккаунт...")
+                    
+                    result = register_via_bot(telegram_id, username, first_name)
+                    
+                    if result.get('success'):
+                        success_text = f"""🎉 <b>РЕГИСТРАЦИЯ ЗАВЕРШЕНА!</b>
 
 Добро пожаловать в Stuey.Go, {result.get('full_name')}!
 
@@ -1240,20 +1745,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
    40,000-165,000₽/месяц + бонусы от рефералов
 
 <b>💡 Используй меню бота для управления аккаунтом!</b>"""
-                            
-                            success_keyboard = {
-                                'inline_keyboard': [
-                                    [{'text': '🚀 Подать заявку в Яндекс.Еду', 'url': 'https://reg.eda.yandex.ru/?advertisement_campaign=forms_for_agents&user_invite_code=f123426cfad648a1afadad700e3a6b6b&utm_content=blank'}],
-                                    [{'text': '📱 Личный кабинет', 'url': f'{WEBSITE_URL}/dashboard'}]
-                                ]
-                            }
-                            send_telegram_message(chat_id, success_text, reply_markup=success_keyboard)
-                            
-                            # Обновляем клавиатуру на зарегистрированную
-                            reply_keyboard = get_reply_keyboard(is_registered=True)
-                            send_telegram_message(chat_id, "Теперь используй меню ниже! 👇", reply_markup=reply_keyboard)
-                        else:
-                            error_text = f"""❌ <b>Ошибка регистрации</b>
+                        
+                        success_keyboard = {
+                            'inline_keyboard': [
+                                [{'text': '🚀 Подать заявку в Яндекс.Еду', 'url': 'https://reg.eda.yandex.ru/?advertisement_campaign=forms_for_agents&user_invite_code=f123426cfad648a1afadad700e3a6b6b&utm_content=blank'}],
+                                [{'text': '📱 Личный кабинет', 'url': f'{WEBSITE_URL}/dashboard'}]
+                            ]
+                        }
+                        send_telegram_message(chat_id, success_text, reply_markup=success_keyboard)
+                        
+                        # Обновляем клавиатуру на зарегистрированную
+                        reply_keyboard = get_reply_keyboard(is_registered=True)
+                        send_telegram_message(chat_id, "Теперь используй меню ниже! 👇", reply_markup=reply_keyboard)
+                    else:
+                        error_text = f"""❌ <b>Ошибка регистрации</b>
 
 {result.get('error', 'Неизвестная ошибка')}
 
@@ -1261,17 +1766,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 • Если ты уже зарегистрирован - нажми /start
 • Попробуй зарегистрироваться на сайте
 • Напиши в поддержку @StueyGoBot"""
-                            
-                            error_keyboard = {
-                                'inline_keyboard': [
-                                    [{'text': '🌐 Регистрация на сайте', 'url': WEBSITE_URL}]
-                                ]
-                            }
-                            send_telegram_message(chat_id, error_text, reply_markup=error_keyboard)
-                    
-                    elif text == '🚀 Зарегистрироваться':
-                        reg_keyboard = {'inline_keyboard': [[{'text': '🚀 Перейти на сайт', 'url': WEBSITE_URL}]]}
-                        reg_text = f"""🚀 <b>РЕГИСТРАЦИЯ КУРЬЕРА</b>
+                        
+                        error_keyboard = {
+                            'inline_keyboard': [
+                                [{'text': '🌐 Регистрация на сайте', 'url': WEBSITE_URL}]
+                            ]
+                        }
+                        send_telegram_message(chat_id, error_text, reply_markup=error_keyboard)
+                
+                elif text == '🚀 Зарегистрироваться':
+                    reg_keyboard = {'inline_keyboard': [[{'text': '🚀 Перейти на сайт', 'url': WEBSITE_URL}]]}
+                    reg_text = f"""🚀 <b>РЕГИСТРАЦИЯ КУРЬЕРА</b>
 
 <b>Что тебя ждёт:</b>
 ✅ Заработок 40,000-165,000₽/месяц
@@ -1282,18 +1787,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 <b>📝 Регистрация занимает 10 минут!</b>
 
 Нажми кнопку ниже и начни зарабатывать сегодня! 👇"""
-                        send_telegram_message(chat_id, reg_text, reply_markup=reg_keyboard)
-                    elif text in ['💰 Заработок', '💰 Сколько можно заработать?']:
-                        response_text, keyboard = handle_newbie_callbacks('earnings')
-                        send_telegram_message(chat_id, response_text, reply_markup=keyboard)
-                    elif text == '📋 Требования':
-                        response_text, keyboard = handle_newbie_callbacks('requirements')
-                        send_telegram_message(chat_id, response_text, reply_markup=keyboard)
-                    elif text == '🎁 Реферальная программа':
-                        response_text, keyboard = handle_newbie_callbacks('referral_info')
-                        send_telegram_message(chat_id, response_text, reply_markup=keyboard)
-                    elif text == '🎮 Игры и бонусы':
-                        games_text = """🎮 <b>ИГРЫ И БОНУСЫ</b>
+                    send_telegram_message(chat_id, reg_text, reply_markup=reg_keyboard)
+                elif text in ['💰 Заработок', '💰 Сколько можно заработать?']:
+                    response_text, keyboard = handle_newbie_callbacks('earnings')
+                    send_telegram_message(chat_id, response_text, reply_markup=keyboard)
+                elif text == '📋 Требования':
+                    response_text, keyboard = handle_newbie_callbacks('requirements')
+                    send_telegram_message(chat_id, response_text, reply_markup=keyboard)
+                elif text == '🎁 Реферальная программа':
+                    response_text, keyboard = handle_newbie_callbacks('referral_info')
+                    send_telegram_message(chat_id, response_text, reply_markup=keyboard)
+                elif text == '🎮 Игры и бонусы':
+                    games_text = """🎮 <b>ИГРЫ И БОНУСЫ</b>
 
 <b>После регистрации тебе станут доступны:</b>
 
@@ -1312,20 +1817,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 За твои первые 150 заказов!
 
 <b>Регистрируйся и получи доступ ко всем играм! 👇</b>"""
-                        games_keyboard = {'inline_keyboard': [[{'text': '🚀 Зарегистрироваться', 'url': WEBSITE_URL}]]}
-                        send_telegram_message(chat_id, games_text, reply_markup=games_keyboard)
-                    elif text == '🔗 Привязать аккаунт':
-                        # Генерируем токен для привязки
-                        link_token = start_linking_process(telegram_id, username)
-                        if link_token:
-                            link_url = f'{WEBSITE_URL}/auth/telegram-link?token={link_token}'
-                            link_keyboard = {
-                                'inline_keyboard': [
-                                    [{'text': '🔗 Привязать аккаунт', 'url': link_url}],
-                                    [{'text': '🚀 Регистрация', 'url': WEBSITE_URL}]
-                                ]
-                            }
-                            text_msg = f"""🔗 <b>ПРИВЯЗКА TELEGRAM</b>
+                    games_keyboard = {'inline_keyboard': [[{'text': '🚀 Зарегистрироваться', 'url': WEBSITE_URL}]]}
+                    send_telegram_message(chat_id, games_text, reply_markup=games_keyboard)
+                elif text == '🔗 Привязать аккаунт':
+                    # Генерируем токен для привязки
+                    link_token = start_linking_process(telegram_id, username)
+                    if link_token:
+                        link_url = f'{WEBSITE_URL}/auth/telegram-link?token={link_token}'
+                        link_keyboard = {
+                            'inline_keyboard': [
+                                [{'text': '🔗 Привязать аккаунт', 'url': link_url}],
+                                [{'text': '🚀 Регистрация', 'url': WEBSITE_URL}]
+                            ]
+                        }
+                        text_msg = f"""🔗 <b>ПРИВЯЗКА TELEGRAM</b>
 
 <b>Уже зарегистрирован?</b>
 Нажми кнопку "Привязать аккаунт" ниже!
@@ -1337,11 +1842,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
 <b>Ещё не зарегистрирован?</b>
 Сначала пройди регистрацию! 👇"""
-                            send_telegram_message(chat_id, text_msg, reply_markup=link_keyboard)
-                        else:
-                            send_telegram_message(chat_id, "❌ Ошибка создания ссылки. Попробуй ещё раз!")
-                    elif text == '🤖 AI Помощник':
-                        ai_text = """🤖 <b>AI ПОМОЩНИК</b>
+                        send_telegram_message(chat_id, text_msg, reply_markup=link_keyboard)
+                    else:
+                        send_telegram_message(chat_id, "❌ Ошибка создания ссылки. Попробуй ещё раз!")
+                elif text == '🤖 AI Помощник':
+                    ai_text = """🤖 <b>AI ПОМОЩНИК</b>
 
 Привет! Я твой интеллектуальный помощник!
 
@@ -1357,51 +1862,51 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 • "Как вывести деньги?"
 • "Сколько платят за реферала?"
 • "Как работать в Яндекс.Еде?"""
-                        send_telegram_message(chat_id, ai_text)
-                    elif text == '❓ FAQ':
-                        response_text, keyboard = handle_newbie_callbacks('faq')
-                        send_telegram_message(chat_id, response_text, reply_markup=keyboard)
-                    
-                    elif text in menu_buttons:
-                        # Если нажата кнопка меню, но не обработана выше - сообщаем что нужна регистрация
-                        send_telegram_message(
-                            chat_id,
-                            "⚠️ Эта функция доступна только после регистрации!\n\n" +
-                            "Нажми /start чтобы зарегистрироваться."
-                        )
+                    send_telegram_message(chat_id, ai_text)
+                elif text == '❓ FAQ':
+                    response_text, keyboard = handle_newbie_callbacks('faq')
+                    send_telegram_message(chat_id, response_text, reply_markup=keyboard)
+                
+                elif text in menu_buttons:
+                    # Если нажата кнопка меню, но не обработана выше - сообщаем что нужна регистрация
+                    send_telegram_message(
+                        chat_id,
+                        "⚠️ Эта функция доступна только после регистрации!\n\n" +
+                        "Нажми /start чтобы зарегистрироваться."
+                    )
 
+                else:
+                    # Любой другой текст (НЕ кнопка меню) = вопрос к AI
+                    thinking_msg = send_telegram_message(chat_id, "🤖 Думаю...")
+                    thinking_msg_id = thinking_msg.get('result', {}).get('message_id') if thinking_msg else None
+                    
+                    # Получаем город из контекста
+                    user_city = get_user_city(telegram_id)
+                    
+                    answer, new_city, keyboard = ask_ai_assistant(text, is_registered=False, user_city=user_city, telegram_id=telegram_id, chat_id=chat_id)
+                    
+                    # Сохраняем новый город если определили
+                    if new_city:
+                        save_user_city(telegram_id, new_city)
+                    
+                    # Редактируем сообщение "Думаю..." вместо отправки нового
+                    if thinking_msg_id:
+                        edit_telegram_message(chat_id, thinking_msg_id, f"🤖 <b>AI Помощник:</b>\n\n{answer}", reply_markup=keyboard)
                     else:
-                        # Любой другой текст (НЕ кнопка меню) = вопрос к AI
-                        thinking_msg = send_telegram_message(chat_id, "🤖 Думаю...")
-                        thinking_msg_id = thinking_msg.get('result', {}).get('message_id') if thinking_msg else None
-                        
-                        # Получаем город из контекста
-                        user_city = get_user_city(telegram_id)
-                        
-                        answer, new_city, keyboard = ask_ai_assistant(text, is_registered=False, user_city=user_city, telegram_id=telegram_id, chat_id=chat_id)
-                        
-                        # Сохраняем новый город если определили
-                        if new_city:
-                            save_user_city(telegram_id, new_city)
-                        
-                        # Редактируем сообщение "Думаю..." вместо отправки нового
-                        if thinking_msg_id:
-                            edit_telegram_message(chat_id, thinking_msg_id, f"🤖 <b>AI Помощник:</b>\n\n{answer}", reply_markup=keyboard)
-                        else:
-                            send_telegram_message(chat_id, f"🤖 <b>AI Помощник:</b>\n\n{answer}", reply_markup=keyboard)
+                        send_telegram_message(chat_id, f"🤖 <b>AI Помощник:</b>\n\n{answer}", reply_markup=keyboard)
+    
+    elif 'callback_query' in body:
+        callback_query = body['callback_query']
+        callback_id = callback_query['id']
+        chat_id = callback_query['message']['chat']['id']
+        message_id = callback_query['message']['message_id']
+        telegram_id = callback_query['from']['id']
+        callback_data = callback_query['data']
         
-        elif 'callback_query' in body:
-            callback_query = body['callback_query']
-            callback_id = callback_query['id']
-            chat_id = callback_query['message']['chat']['id']
-            message_id = callback_query['message']['message_id']
-            telegram_id = callback_query['from']['id']
-            callback_data = callback_query['data']
-            
-            courier = get_courier_by_telegram(telegram_id)
-            
-            if callback_data == 'link_account':
-                text = f"""🔗 <b>ПРИВЯЗКА TELEGRAM К АККАУНТУ</b>
+        courier = get_courier_by_telegram(telegram_id)
+        
+        if callback_data == 'link_account':
+            text = f"""🔗 <b>ПРИВЯЗКА TELEGRAM К АККАУНТУ</b>
 
 Если ты уже зарегистрирован на stuey-go.ru, сделай следующее:
 
@@ -1416,24 +1921,55 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
 <b>Ещё не зарегистрирован?</b>
 Сначала пройди регистрацию! 👇"""
-                keyboard = {
-                    'inline_keyboard': [
-                        [{'text': '🌐 Открыть личный кабинет', 'url': f'{WEBSITE_URL}/dashboard'}],
-                        [{'text': '◀️ Назад', 'callback_data': 'menu'}]
-                    ]
-                }
-                edit_telegram_message(chat_id, message_id, text, reply_markup=keyboard)
-                answer_callback_query(callback_id, "Сгенерируй код в личном кабинете и отправь его мне!")
-            
+            keyboard = {
+                'inline_keyboard': [
+                    [{'text': '🌐 Открыть личный кабинет', 'url': f'{WEBSITE_URL}/dashboard'}],
+                    [{'text': '◀️ Назад', 'callback_data': 'menu'}]
+                ]
+            }
+            edit_telegram_message(chat_id, message_id, text, reply_markup=keyboard)
+            answer_callback_query(callback_id, "Сгенерируй код в личном кабинете и отправь его мне!")
+        
+        else:
+            if courier:
+                response_text, keyboard = handle_registered_callbacks(callback_data, courier['courier_id'])
             else:
-                if courier:
-                    response_text, keyboard = handle_registered_callbacks(callback_data, courier['courier_id'])
-                else:
-                    response_text, keyboard = handle_newbie_callbacks(callback_data)
-                
-                if response_text:
-                    edit_telegram_message(chat_id, message_id, response_text, reply_markup=keyboard)
-                    answer_callback_query(callback_id)
+                response_text, keyboard = handle_newbie_callbacks(callback_data)
+            
+            if response_text:
+                edit_telegram_message(chat_id, message_id, response_text, reply_markup=keyboard)
+                answer_callback_query(callback_id)
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Главный обработчик webhook от Telegram
+    """
+    method = event.get('httpMethod', 'POST')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    if method == 'GET':
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'outbound': {yandex_gpt_guard.name: yandex_gpt_guard.snapshot()}}),
+            'isBase64Encoded': False
+        }
+    
+    try:
+        body = json.loads(event.get('body', '{}'))
+        
+        process_update(body)
         
         return {
             'statusCode': 200,
@@ -0,0 +1,254 @@
+"""
+Long-polling режим Telegram бота (альтернатива webhook)
+Получает updates через getUpdates и обрабатывает их пулом воркеров с той же логикой, что и webhook.
+Updates одного чата всегда попадают в один воркер, поэтому порядок сообщений в чате сохраняется.
+
+Запуск:
+    python polling.py --workers 8
+Нагрузочный тест против фейкового Bot API:
+    python polling.py --fake-api --load-test 5000 --chats 200 --workers 8
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional
+
+POLL_TIMEOUT_SECONDS = 25
+QUEUE_SIZE_PER_WORKER = 100
+# Пауза после неудачного getUpdates: удваивается до потолка, сбрасывается первым успешным ответом
+POLL_BACKOFF_INITIAL_SECONDS = 1.0
+POLL_BACKOFF_MAX_SECONDS = 60.0
+# Повтор не поможет: 401 — неверный токен, 409 — у бота установлен webhook (или запущен второй poller)
+POLL_FATAL_ERROR_CODES = {401, 409}
+
+
+def get_update_chat_id(update: Dict[str, Any]) -> int:
+    """Ключ шардирования: id чата, а для служебных updates — сам update_id"""
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update and 'message' in update['callback_query']:
+        return update['callback_query']['message']['chat']['id']
+    return update['update_id']
+
+
+class PollingRunner:
+    """getUpdates-цикл + пул воркеров, шардированный по chat_id"""
+
+    def __init__(self, bot, workers: int = 8):
+        self.bot = bot
+        self.queues = [queue.Queue(maxsize=QUEUE_SIZE_PER_WORKER) for _ in range(workers)]
+        self.threads = []
+        self.offset = None
+        self.backoff = 0.0
+        self.retry_after = 0.0
+        self.fatal_error = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {'received': 0, 'processed': 0, 'failed': 0, 'total_latency_ms': 0.0}
+
+    def start_workers(self):
+        for i, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self.worker_loop, args=(worker_queue,), name=f'bot-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def worker_loop(self, worker_queue: queue.Queue):
+        while True:
+            update = worker_queue.get()
+            if update is None:
+                worker_queue.task_done()
+                return
+            started = time.perf_counter()
+            ok = True
+            try:
+                self.bot.process_update(update)
+            except Exception as e:
+                ok = False
+                print(f'Error processing update {update.get("update_id")}: {e}')
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.stats['processed' if ok else 'failed'] += 1
+                self.stats['total_latency_ms'] += elapsed_ms
+            worker_queue.task_done()
+
+    def dispatch(self, update: Dict[str, Any]):
+        """Блокирует, если очередь воркера заполнена — естественный backpressure для getUpdates"""
+        shard = get_update_chat_id(update) % len(self.queues)
+        self.queues[shard].put(update)
+        with self.lock:
+            self.stats['received'] += 1
+
+    def fetch_updates(self) -> Optional[list]:
+        """Новые updates; None — getUpdates не удался (ошибка Bot API или сети), при фатальной ошибке цикл останавливается"""
+        data = {'timeout': POLL_TIMEOUT_SECONDS, 'allowed_updates': ['message', 'callback_query']}
+        if self.offset is not None:
+            data['offset'] = self.offset
+        try:
+            result = self.bot.telegram_api_call('getUpdates', data, timeout=POLL_TIMEOUT_SECONDS + 10, return_errors=True)
+        except Exception as e:
+            print(f'getUpdates error: {e}')
+            return None
+        if result and result.get('ok'):
+            return result.get('result', [])
+
+        error_code = result.get('error_code') if result else None
+        if error_code in POLL_FATAL_ERROR_CODES:
+            self.fatal_error = f"{error_code} {result.get('description', '')}".strip()
+            print(f'getUpdates: {self.fatal_error}, остановка')
+            self.stopping.set()
+        else:
+            self.retry_after = float((result or {}).get('parameters', {}).get('retry_after') or 0)
+        return None
+
+    def wait_backoff(self):
+        """Экспоненциальная пауза перед повтором getUpdates (не меньше retry_after от Bot API); прерывается остановкой"""
+        self.backoff = min(max(self.backoff * 2, POLL_BACKOFF_INITIAL_SECONDS), POLL_BACKOFF_MAX_SECONDS)
+        delay, self.retry_after = max(self.backoff, self.retry_after), 0.0
+        print(f'getUpdates: повтор через {delay:.0f} с')
+        self.stopping.wait(delay)
+
+    def run(self, max_updates: Optional[int] = None):
+        self.start_workers()
+        try:
+            while not self.stopping.is_set():
+                updates = self.fetch_updates()
+                if updates is None:
+                    if not self.stopping.is_set():
+                        self.wait_backoff()
+                    continue
+                self.backoff = 0.0
+                for update in updates:
+                    self.dispatch(update)
+                    self.offset = update['update_id'] + 1
+                if max_updates is not None and self.stats['received'] >= max_updates:
+                    break
+        except KeyboardInterrupt:
+            print('Остановка по Ctrl+C...')
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def summary(self) -> Dict[str, Any]:
+        done = self.stats['processed'] + self.stats['failed']
+        return {
+            **self.stats,
+            'avg_latency_ms': self.stats['total_latency_ms'] / done if done else 0.0
+        }
+
+
+class FakeBotApi:
+    """Фейковый Bot API для нагрузочного теста: отдаёт синтетические updates и принимает ответы бота"""
+
+    def __init__(self, total_updates: int, chats: int, batch_size: int = 100):
+        self.pending = [self.make_update(i, 100000 + i % chats) for i in range(1, total_updates + 1)]
+        self.batch_size = batch_size
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+
+    @staticmethod
+    def make_update(update_id: int, chat_id: int) -> Dict[str, Any]:
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'from': {'id': chat_id, 'first_name': 'Нагрузка'},
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': '❓ FAQ'
+            }
+        }
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def handle(self, api_method: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        with self.lock:
+            self.calls[api_method] = self.calls.get(api_method, 0) + 1
+            if api_method == 'getUpdates':
+                offset = data.get('offset') or 0
+                self.pending = [u for u in self.pending if u['update_id'] >= offset]
+                return {'ok': True, 'result': self.pending[:self.batch_size]}
+            return {'ok': True, 'result': {'message_id': 1}}
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                api_method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                data = json.loads(self.rfile.read(length) or b'{}')
+                payload = json.dumps(api.handle(api_method, data)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Long-polling режим Telegram бота')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--db-pool', type=int, default=0, help='Размер пула соединений с БД (по умолчанию = workers)')
+    parser.add_argument('--delete-webhook', action='store_true', help='Снять webhook перед запуском (getUpdates с ним не работает)')
+    parser.add_argument('--fake-api', action='store_true', help='Запустить против встроенного фейкового Bot API')
+    parser.add_argument('--load-test', type=int, default=0, help='Количество синтетических updates для фейкового API')
+    parser.add_argument('--chats', type=int, default=100)
+    args = parser.parse_args()
+
+    fake_api = None
+    if args.fake_api:
+        fake_api = FakeBotApi(args.load_test or 1000, args.chats)
+        fake_api.start()
+        os.environ['TELEGRAM_API_URL'] = fake_api.url
+        os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'fake')
+
+    import index as bot
+
+    if os.environ.get('DATABASE_URL'):
+        bot.enable_connection_pool(1, args.db_pool or args.workers)
+
+    if args.delete_webhook and not fake_api:
+        print(f'deleteWebhook: {bot.telegram_api_call("deleteWebhook", {"drop_pending_updates": False})}')
+
+    runner = PollingRunner(bot, workers=args.workers)
+    started = time.perf_counter()
+    runner.run(max_updates=args.load_test or None)
+    elapsed = time.perf_counter() - started
+
+    summary = runner.summary()
+    summary['elapsed_s'] = round(elapsed, 2)
+    summary['updates_per_s'] = round(summary['received'] / elapsed, 1) if elapsed else 0.0
+    if runner.fatal_error:
+        summary['fatal_error'] = runner.fatal_error
+    if fake_api:
+        summary['api_calls'] = fake_api.calls
+        fake_api.stop()
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+"""
+Массовая рассылка в Telegram всем привязанным курьерам
+Аудитория фиксируется снимком при создании задания, отправка идёт пачками с ограниченной параллельностью
+и лимитом Bot API. После каждой пачки прогресс коммитится, поэтому вызов, упёршийся в таймаут функции,
+следующий запуск (cron или admin) продолжает с места остановки.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+import jwt
+import requests
+
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+JWT_SECRET = os.environ.get('JWT_SECRET', '')
+JWT_ALGORITHM = 'HS256'
+
+SCHEMA = 't_p25272970_courier_button_site'
+
+# Bot API допускает ~30 сообщений/с на бота; оставляем запас
+SEND_RATE_PER_SECOND = float(os.environ.get('BROADCAST_RATE_PER_SECOND', '25'))
+SEND_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '16'))
+BATCH_SIZE = 500
+# Сколько секунд одного вызова тратить на отправку (меньше таймаута функции)
+TIME_BUDGET_SECONDS = float(os.environ.get('BROADCAST_TIME_BUDGET', '50'))
+LEASE_SECONDS = 120
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, x-auth-token',
+    'Access-Control-Max-Age': '86400'
+}
+
+
+def get_db_connection():
+    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+
+
+def response(status: int, body: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', **CORS_HEADERS},
+        'body': json.dumps(body, default=str, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+
+def verify_admin(event: Dict[str, Any]) -> Optional[str]:
+    """Проверяет JWT админа, возвращает username или None"""
+    headers = event.get('headers') or {}
+    token = headers.get('X-Auth-Token') or headers.get('x-auth-token')
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        return payload.get('username') or str(payload.get('user_id'))
+    except jwt.InvalidTokenError:
+        return None
+
+
+class RateLimiter:
+    """Token bucket, общий для всех потоков отправки"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_session = None
+
+
+def get_session() -> requests.Session:
+    """Keep-alive сессия с пулом соединений под параллельность отправки"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SEND_CONCURRENCY)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def send_one(limiter: RateLimiter, telegram_id: str, text: str, parse_mode: str) -> tuple:
+    """Отправляет одно сообщение. Возвращает (status, error)"""
+    url = f'https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage'
+    payload = {'chat_id': telegram_id, 'text': text, 'parse_mode': parse_mode}
+
+    for attempt in range(3):
+        limiter.acquire()
+        try:
+            resp = get_session().post(url, json=payload, timeout=10)
+        except requests.RequestException as e:
+            error = str(e)
+            continue
+
+        if resp.status_code == 200:
+            return 'sent', None
+        if resp.status_code == 429:
+            retry_after = (resp.json().get('parameters') or {}).get('retry_after', 1)
+            error = f'429 retry_after={retry_after}'
+            time.sleep(min(retry_after, 10))
+            continue
+        if resp.status_code == 403:
+            return 'blocked', resp.text[:200]
+        if resp.status_code >= 500:
+            error = f'{resp.status_code} {resp.text[:200]}'
+            continue
+        return 'failed', f'{resp.status_code} {resp.text[:200]}'
+
+    return 'failed', error
+
+
+def create_job(conn, message_text: str, parse_mode: str, created_by: str) -> Dict[str, Any]:
+    """Создаёт задание и одним запросом снимает аудиторию (verified Telegram-связки)"""
+    cur = conn.cursor()
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.broadcast_jobs (message_text, parse_mode, created_by)
+        VALUES (%s, %s, %s)
+        RETURNING id
+    """, (message_text, parse_mode, created_by))
+    job_id = cur.fetchone()['id']
+
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.broadcast_recipients (job_id, seq, telegram_id, courier_id)
+        SELECT %s, ROW_NUMBER() OVER (ORDER BY telegram_id), telegram_id, courier_id
+        FROM (
+            SELECT DISTINCT ON (mc.messenger_user_id) mc.messenger_user_id AS telegram_id, mc.courier_id
+            FROM {SCHEMA}.messenger_connections mc
+            WHERE mc.messenger_type = 'telegram'
+              AND mc.is_verified = true
+              AND mc.blocked_at IS NULL
+              AND mc.messenger_user_id IS NOT NULL
+            ORDER BY mc.messenger_user_id, mc.id
+        ) audience
+    """, (job_id,))
+    total = cur.rowcount
+
+    cur.execute(f"UPDATE {SCHEMA}.broadcast_jobs SET total_recipients = %s WHERE id = %s", (total, job_id))
+    conn.commit()
+    cur.close()
+    return {'job_id': job_id, 'total_recipients': total}
+
+
+def acquire_job(conn, job_id: Optional[int]) -> Optional[Dict[str, Any]]:
+    """Берёт задание в работу под lease, чтобы два вызова не слали одно и то же параллельно"""
+    cur = conn.cursor()
+    cur.execute(f"""
+        UPDATE {SCHEMA}.broadcast_jobs
+        SET status = 'running',
+            started_at = COALESCE(started_at, NOW()),
+            locked_until = NOW() + make_interval(secs => %s)
+        WHERE id = (
+            SELECT id FROM {SCHEMA}.broadcast_jobs
+            WHERE status IN ('pending', 'running')
+              AND (locked_until IS NULL OR locked_until < NOW())
+              AND (%s::int IS NULL OR id = %s::int)
+            ORDER BY created_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, message_text, parse_mode
+    """, (LEASE_SECONDS, job_id, job_id))
+    job = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return job
+
+
+def run_job(conn, job: Dict[str, Any], deadline: float) -> Dict[str, Any]:
+    """Отправляет пачками до исчерпания аудитории или бюджета времени; каждая пачка — чекпоинт"""
+    limiter = RateLimiter(SEND_RATE_PER_SECOND)
+    cur = conn.cursor()
+    totals = {'sent': 0, 'failed': 0, 'blocked': 0}
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY) as pool:
+        while time.monotonic() < deadline:
+            cur.execute(f"SELECT status FROM {SCHEMA}.broadcast_jobs WHERE id = %s", (job['id'],))
+            if cur.fetchone()['status'] == 'cancelled':
+                break
+
+            # Пачка не больше, чем успеем отправить до дедлайна при текущем лимите
+            room = int((deadline - time.monotonic()) * SEND_RATE_PER_SECOND)
+            limit = max(1, min(BATCH_SIZE, room))
+            cur.execute(f"""
+                SELECT seq, telegram_id, courier_id
+                FROM {SCHEMA}.broadcast_recipients
+                WHERE job_id = %s AND status = 'pending'
+                ORDER BY seq
+                LIMIT %s
+            """, (job['id'], limit))
+            batch = cur.fetchall()
+            if not batch:
+                cur.execute(f"""
+                    UPDATE {SCHEMA}.broadcast_jobs
+                    SET status = 'completed', finished_at = NOW(), locked_until = NULL
+                    WHERE id = %s AND status = 'running'
+                """, (job['id'],))
+                conn.commit()
+                break
+
+            results = list(pool.map(
+                lambda r: send_one(limiter, r['telegram_id'], job['message_text'], job['parse_mode']),
+                batch
+            ))
+
+            rows = [(job['id'], r['seq'], status, error) for r, (status, error) in zip(batch, results)]
+            execute_values(cur, f"""
+                UPDATE {SCHEMA}.broadcast_recipients br
+                SET status = v.status, error = v.error, sent_at = NOW()
+                FROM (VALUES %s) AS v(job_id, seq, status, error)
+                WHERE br.job_id = v.job_id AND br.seq = v.seq
+            """, rows)
+
+            counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+            for status, _error in results:
+                counts[status] += 1
+            for key in totals:
+                totals[key] += counts[key]
+
+            blocked_ids = [r['telegram_id'] for r, (status, _e) in zip(batch, results) if status == 'blocked']
+            if blocked_ids:
+                cur.execute(f"""
+                    UPDATE {SCHEMA}.messenger_connections
+                    SET blocked_at = NOW()
+                    WHERE messenger_type = 'telegram' AND messenger_user_id = ANY(%s)
+                """, (blocked_ids,))
+
+            cur.execute(f"""
+                UPDATE {SCHEMA}.broadcast_jobs
+                SET sent_count = sent_count + %s,
+                    failed_count = failed_count + %s,
+                    blocked_count = blocked_count + %s,
+                    last_progress_at = NOW(),
+                    locked_until = NOW() + make_interval(secs => %s)
+                WHERE id = %s
+            """, (counts['sent'], counts['failed'], counts['blocked'], LEASE_SECONDS, job['id']))
+            conn.commit()
+
+    # Освобождаем lease, чтобы следующий вызов мог сразу продолжить
+    cur.execute(f"""
+        UPDATE {SCHEMA}.broadcast_jobs SET locked_until = NULL
+        WHERE id = %s AND status = 'running'
+    """, (job['id'],))
+    conn.commit()
+    cur.close()
+
+    elapsed = time.monotonic() - started
+    processed = sum(totals.values())
+    return {
+        'job_id': job['id'],
+        **totals,
+        'elapsed_s': round(elapsed, 2),
+        'messages_per_s': round(processed / elapsed, 1) if elapsed else 0.0
+    }
+
+
+def get_job_status(conn, job_id: int) -> Optional[Dict[str, Any]]:
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT id, status, total_recipients, sent_count, failed_count, blocked_count, created_by,
+               created_at, started_at, last_progress_at, finished_at,
+               EXTRACT(EPOCH FROM (COALESCE(finished_at, last_progress_at) - started_at)) AS active_seconds
+        FROM {SCHEMA}.broadcast_jobs
+        WHERE id = %s
+    """, (job_id,))
+    job = cur.fetchone()
+    cur.close()
+    if not job:
+        return None
+
+    job = dict(job)
+    processed = job['sent_count'] + job['failed_count'] + job['blocked_count']
+    active_seconds = float(job.pop('active_seconds') or 0)
+    rate = processed / active_seconds if active_seconds > 0 else 0.0
+    remaining = job['total_recipients'] - processed
+    job['processed'] = processed
+    job['completion_percent'] = round(100.0 * processed / job['total_recipients'], 1) if job['total_recipients'] else 100.0
+    job['messages_per_s'] = round(rate, 1)
+    job['eta_seconds'] = round(remaining / rate) if rate > 0 and remaining > 0 else None
+    return job
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Admin API рассылок: create / status / list / cancel (JWT админа) и run (cron или admin)
+    """
+    method = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {'statusCode': 200, 'headers': CORS_HEADERS, 'body': '', 'isBase64Encoded': False}
+
+    query_params = event.get('queryStringParameters') or {}
+    body_data = json.loads(event.get('body') or '{}') if method == 'POST' else {}
+    action = body_data.get('action') or query_params.get('action', 'run')
+
+    admin = verify_admin(event)
+    if action != 'run' and not admin:
+        return response(401, {'error': 'Требуется авторизация'})
+
+    conn = get_db_connection()
+
+    try:
+        if action == 'create' and method == 'POST':
+            message_text = (body_data.get('message') or '').strip()
+            if not message_text:
+                return response(400, {'error': 'Текст рассылки пустой'})
+            if len(message_text) > 4096:
+                return response(400, {'error': 'Сообщение длиннее 4096 символов'})
+            job = create_job(conn, message_text, body_data.get('parse_mode', 'HTML'), admin)
+            return response(200, {'success': True, **job})
+
+        if action == 'status':
+            job = get_job_status(conn, int(query_params.get('job_id') or body_data.get('job_id') or 0))
+            if not job:
+                return response(404, {'error': 'Рассылка не найдена'})
+            return response(200, {'success': True, 'job': job})
+
+        if action == 'list':
+            cur = conn.cursor()
+            cur.execute(f"SELECT id FROM {SCHEMA}.broadcast_jobs ORDER BY created_at DESC LIMIT 20")
+            job_ids = [row['id'] for row in cur.fetchall()]
+            cur.close()
+            return response(200, {'success': True, 'jobs': [get_job_status(conn, job_id) for job_id in job_ids]})
+
+        if action == 'cancel' and method == 'POST':
+            cur = conn.cursor()
+            cur.execute(f"""
+                UPDATE {SCHEMA}.broadcast_jobs
+                SET status = 'cancelled', finished_at = NOW()
+                WHERE id = %s AND status IN ('pending', 'running')
+            """, (int(body_data.get('job_id') or 0),))
+            cancelled = cur.rowcount
+            conn.commit()
+            cur.close()
+            return response(200, {'success': bool(cancelled)})
+
+        if action == 'run':
+            deadline = time.monotonic() + TIME_BUDGET_SECONDS
+            job_id = query_params.get('job_id') or body_data.get('job_id')
+            runs = []
+            while time.monotonic() < deadline:
+                job = acquire_job(conn, int(job_id) if job_id else None)
+                if not job:
+                    break
+                runs.append(run_job(conn, job, deadline))
+                if job_id:
+                    break
+            return response(200, {'success': True, 'runs': runs})
+
+        return response(400, {'error': f'Неизвестное действие: {action}'})
+
+    except Exception as e:
+        print(f'Error in telegram-broadcast: {e}')
+        conn.rollback()
+        return response(500, {'error': str(e)})
+    finally:
+        conn.close()
@@ -5,9 +5,11 @@ API для регистрации новых курьеров через Telegra
 
 import json
 import os
+import re
+from datetime import datetime
 from typing import Dict, Any, Optional
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 
 DATABASE_URL = os.environ.get('DATABASE_URL', '')
 
@@ -25,6 +27,138 @@ def generate_referral_code(user_id: int) -> str:
     
     return f'TG{user_id}{random_part}'
 
+# Поиск вероятных дубликатов при регистрации — те же правила и пороги, что в api
+# (normalize_person_name, dedup_name_key, score_duplicate_pair, flag_probable_duplicates): меняются вместе
+NAME_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c', 'ч': 'ch', 'ш': 'sh', 'щ': 'sh',
+    'ъ': '', 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'iu', 'я': 'ia'
+})
+NAME_LATIN_FOLDS = (('shch', 'sh'), ('sch', 'sh'), ('kh', 'h'), ('ts', 'c'), ('tz', 'c'), ('ph', 'f'), ('w', 'v'), ('x', 'ks'), ('y', 'i'), ('j', 'i'))
+MATCH_NAME_THRESHOLD = 0.5
+DEDUP_MIN_SCORE = 45
+DEDUP_NAME_ONLY_MAX_SCORE = 40
+DEDUP_MAX_BLOCK = 50
+
+def normalize_person_name(name: str) -> str:
+    """ФИО в одной латинской форме: ё→е, транслит кириллицы, свёртка вариантов латиницы, без знаков и повторов букв"""
+    normalized = (name or '').lower().translate(NAME_TRANSLIT)
+    for variant, canonical in NAME_LATIN_FOLDS:
+        normalized = normalized.replace(variant, canonical)
+    normalized = re.sub(r'[^a-z]+', ' ', normalized)
+    normalized = re.sub(r'(.)\1+', r'\1', normalized)
+    return ' '.join(normalized.split())
+
+def name_trigrams(normalized: str) -> set:
+    """Триграммы по словам, как в pg_trgm: порядок слов не влияет на похожесть"""
+    trigrams = set()
+    for word in normalized.split():
+        padded = f'  {word} '
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+def dedup_name_key(full_name: str):
+    """Ключ блокировки «похожее звучание»: первые два слова ФИО без гласных после первой буквы, по алфавиту"""
+    words = normalize_person_name(full_name).split()[:2]
+    if not words:
+        return None
+    return ' '.join(sorted(re.sub(r'(.)\1+', r'\1', word[0] + re.sub(r'[aeiou]', '', word[1:])) for word in words))
+
+def score_duplicate_pair(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Оценка пары: телефон 50 (разные телефоны −25), email 50, похожесть ФИО по триграммам до 35, город 15.
+    Без совпадения телефона или email — не выше DEDUP_NAME_ONLY_MAX_SCORE. Оставить предлагается более старый аккаунт
+    """
+    score = 0
+    reasons = []
+    contact_match = False
+    
+    if a.get('phone_e164') and a.get('phone_e164') == b.get('phone_e164'):
+        score += 50
+        contact_match = True
+        reasons.append('Телефон')
+    elif a.get('phone_e164') and b.get('phone_e164'):
+        score -= 25
+    
+    if a.get('email') and b.get('email') and a['email'].strip().lower() == b['email'].strip().lower():
+        score += 50
+        contact_match = True
+        reasons.append('Email')
+    
+    name_a = name_trigrams(normalize_person_name(a.get('full_name')))
+    name_b = name_trigrams(normalize_person_name(b.get('full_name')))
+    if name_a and name_b:
+        similarity = len(name_a & name_b) / len(name_a | name_b)
+        if similarity >= MATCH_NAME_THRESHOLD:
+            score += similarity * 35
+            reasons.append(f'ФИО ({int(similarity * 100)}%)')
+    
+    if a.get('city') and b.get('city') and a['city'].strip().lower() == b['city'].strip().lower():
+        score += 15
+        reasons.append('Город')
+    
+    if a.get('oauth_provider') != b.get('oauth_provider'):
+        reasons.append(f"{a.get('oauth_provider') or '—'} / {b.get('oauth_provider') or '—'}")
+    
+    if not contact_match:
+        score = min(score, DEDUP_NAME_ONLY_MAX_SCORE)
+    
+    keep = min((a, b), key=lambda user: (user.get('created_at') or datetime.max, user['id']))
+    return {'score': max(min(int(score), 100), 0), 'reasons': reasons, 'keep_user_id': keep['id']}
+
+def flag_probable_duplicates(cursor, user_id: int) -> int:
+    """
+    Записывает name_key нового курьера и ставит в очередь проверки пары с тем же телефоном, email
+    или похожим ФИО в том же городе. Регистрацию не блокирует; полный поиск — api, route=duplicates
+    """
+    cursor.execute("""
+        SELECT id, full_name, email, phone_e164, city, oauth_provider, created_at
+        FROM t_p25272970_courier_button_site.users
+        WHERE id = %s
+    """, (user_id,))
+    user = dict(cursor.fetchone())
+    user['name_key'] = dedup_name_key(user['full_name'])
+    
+    cursor.execute("""
+        UPDATE t_p25272970_courier_button_site.users SET name_key = %s WHERE id = %s
+    """, (user['name_key'], user_id))
+    
+    email = user['email'].strip().lower() if user['email'] and '@' in user['email'] else None
+    cursor.execute("""
+        SELECT id, full_name, email, phone_e164, city, oauth_provider, created_at
+        FROM t_p25272970_courier_button_site.users
+        WHERE id <> %s
+        AND archived_at IS NULL
+        AND (
+            phone_e164 = %s
+            OR LOWER(email) = %s
+            OR (name_key = %s AND LOWER(city) = LOWER(%s))
+        )
+        LIMIT %s
+    """, (user_id, user['phone_e164'], email, user['name_key'], user['city'], DEDUP_MAX_BLOCK))
+    
+    candidates = []
+    for other in cursor.fetchall():
+        result = score_duplicate_pair(user, dict(other))
+        if result['score'] >= DEDUP_MIN_SCORE:
+            candidates.append((min(user_id, other['id']), max(user_id, other['id']), result['keep_user_id'],
+                               result['score'], json.dumps(result['reasons'], ensure_ascii=False), 'registration'))
+    
+    if candidates:
+        execute_values(cursor, """
+            INSERT INTO t_p25272970_courier_button_site.user_duplicate_candidates
+            (user_id, duplicate_user_id, keep_user_id, score, reasons, source)
+            VALUES %s
+            ON CONFLICT (user_id, duplicate_user_id) DO UPDATE SET
+                keep_user_id = EXCLUDED.keep_user_id,
+                score = EXCLUDED.score,
+                reasons = EXCLUDED.reasons,
+                updated_at = NOW()
+            WHERE user_duplicate_candidates.status = 'pending'
+        """, candidates)
+    return len(candidates)
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     API для регистрации курьера через Telegram
@@ -152,6 +286,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 WHERE id = %s
             """, (referral_code, user_id))
             
+            flag_probable_duplicates(cursor, user_id)
+            
             # Привязываем Telegram
             cursor.execute("""
                 INSERT INTO t_p25272970_courier_button_site.messenger_connections
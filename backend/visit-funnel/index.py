@@ -0,0 +1,382 @@
+"""
+Инкрементальная воронка сайта: сессионизация page_visits, атрибуция регистраций к сессиям и суточная
+таблица funnel_daily (визиты → реальные визиты → регистрации → первые начисления по CSV).
+Каждый шаг читает только строки после своего водяного знака и коммитит результат вместе с новым знаком,
+поэтому повторный запуск (cron) ничего не считает дважды, а время работы не зависит от объёма истории.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, date
+from typing import Dict, Any, Optional
+from urllib.parse import urlparse
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+import jwt
+
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+JWT_SECRET = os.environ.get('JWT_SECRET', '')
+JWT_ALGORITHM = 'HS256'
+
+SCHEMA = 't_p25272970_courier_button_site'
+
+SESSION_GAP = timedelta(minutes=30)
+# Визит обновляется, пока открыта вкладка; строки моложе этого возраста ещё не обрабатываем
+SETTLE_LAG = timedelta(minutes=30)
+# Регистрация относится к сессии, закончившейся не раньше чем за это время до неё
+ATTRIBUTION_WINDOW = timedelta(minutes=30)
+BATCH_SIZE = 20000
+TIME_BUDGET_SECONDS = float(os.environ.get('FUNNEL_TIME_BUDGET', '25'))
+
+FUNNEL_COUNTERS = ('visits', 'real_visits', 'sessions', 'registrations', 'attributed_registrations', 'first_earnings')
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, x-auth-token',
+    'Access-Control-Max-Age': '86400'
+}
+
+
+def get_db_connection():
+    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+
+
+def response(status: int, body: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', **CORS_HEADERS},
+        'body': json.dumps(body, default=str, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+
+def verify_admin(event: Dict[str, Any]) -> Optional[str]:
+    """Проверяет JWT админа, возвращает username или None"""
+    headers = event.get('headers') or {}
+    token = headers.get('X-Auth-Token') or headers.get('x-auth-token')
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        return payload.get('username') or str(payload.get('user_id'))
+    except jwt.InvalidTokenError:
+        return None
+
+
+def visitor_hash(ip_address: Optional[str], user_agent: Optional[str]) -> str:
+    return hashlib.md5(f'{ip_address or ""}|{user_agent or ""}'.encode('utf-8')).hexdigest()
+
+
+def lock_watermark(cur, name: str) -> Dict[str, Any]:
+    """FOR UPDATE сериализует параллельные запуски одного шага до коммита пачки"""
+    cur.execute(f"""
+        SELECT watermark, last_id FROM {SCHEMA}.pipeline_watermarks
+        WHERE name = %s
+        FOR UPDATE
+    """, (name,))
+    return cur.fetchone()
+
+
+def save_watermark(cur, name: str, watermark: datetime, last_id: int):
+    cur.execute(f"""
+        UPDATE {SCHEMA}.pipeline_watermarks
+        SET watermark = %s, last_id = %s, updated_at = NOW()
+        WHERE name = %s
+    """, (watermark, last_id, name))
+
+
+def add_funnel_deltas(cur, deltas: Dict[date, Dict[str, int]]):
+    if not deltas:
+        return
+    rows = [(day, *(counters.get(name, 0) for name in FUNNEL_COUNTERS)) for day, counters in deltas.items()]
+    increments = ', '.join(f'{name} = funnel_daily.{name} + EXCLUDED.{name}' for name in FUNNEL_COUNTERS)
+    execute_values(cur, f"""
+        INSERT INTO {SCHEMA}.funnel_daily (day, {', '.join(FUNNEL_COUNTERS)})
+        VALUES %s
+        ON CONFLICT (day) DO UPDATE SET {increments}, updated_at = NOW()
+    """, rows)
+
+
+def process_visits(conn) -> int:
+    """Следующая пачка page_visits после водяного знака: продление открытых сессий или новые сессии"""
+    cur = conn.cursor()
+    mark = lock_watermark(cur, 'funnel_visits')
+    cur.execute(f"""
+        SELECT id, created_at, ip_address, user_agent, page_url, referrer, is_real_visit, is_suspected_bot
+        FROM {SCHEMA}.page_visits
+        WHERE visit_date >= %s
+        AND (created_at, id) > (%s, %s)
+        AND created_at < NOW() - %s
+        ORDER BY created_at, id
+        LIMIT %s
+    """, (mark['watermark'].date(), mark['watermark'], mark['last_id'], SETTLE_LAG, BATCH_SIZE))
+    visits = cur.fetchall()
+    if not visits:
+        conn.rollback()
+        cur.close()
+        return 0
+
+    for visit in visits:
+        visit['visitor_hash'] = visitor_hash(visit['ip_address'], visit['user_agent'])
+
+    # Последняя сессия каждого посетителя, которую ещё может продолжить визит из пачки
+    cur.execute(f"""
+        SELECT DISTINCT ON (visitor_hash) id, visitor_hash, ended_at
+        FROM {SCHEMA}.visit_sessions
+        WHERE visitor_hash = ANY(%s) AND ended_at >= %s
+        ORDER BY visitor_hash, ended_at DESC
+    """, (list({v['visitor_hash'] for v in visits}), visits[0]['created_at'] - SESSION_GAP))
+    current = {row['visitor_hash']: {**row, 'visits': 0, 'real_visits': 0, 'human': False, 'visited_auth': False}
+               for row in cur.fetchall()}
+    existing = list(current.values())
+
+    new_sessions = []
+    deltas = defaultdict(lambda: defaultdict(int))
+    for visit in visits:
+        is_human = not visit['is_suspected_bot']
+        is_real = bool(visit['is_real_visit']) and is_human
+        session = current.get(visit['visitor_hash'])
+        if not session or visit['created_at'] - session['ended_at'] > SESSION_GAP:
+            session = {
+                'id': None, 'visitor_hash': visit['visitor_hash'],
+                'ip_address': visit['ip_address'], 'user_agent': visit['user_agent'],
+                'started_at': visit['created_at'], 'ended_at': visit['created_at'],
+                'visits': 0, 'real_visits': 0, 'human': False, 'visited_auth': False,
+                'landing_page': visit['page_url'], 'referrer': visit['referrer']
+            }
+            current[visit['visitor_hash']] = session
+            new_sessions.append(session)
+            deltas[visit['created_at'].date()]['sessions'] += 1
+        session['ended_at'] = max(session['ended_at'], visit['created_at'])
+        session['visits'] += 1
+        session['real_visits'] += int(is_real)
+        session['human'] = session['human'] or is_human
+        session['visited_auth'] = session['visited_auth'] or (visit['page_url'] or '').startswith('/auth')
+        deltas[visit['created_at'].date()]['visits'] += 1
+        deltas[visit['created_at'].date()]['real_visits'] += int(is_real)
+
+    extended = [s for s in existing if s['visits']]
+    if extended:
+        execute_values(cur, f"""
+            UPDATE {SCHEMA}.visit_sessions s
+            SET ended_at = v.ended_at,
+                visits = s.visits + v.visits,
+                real_visits = s.real_visits + v.real_visits,
+                is_bot = s.is_bot AND NOT v.human,
+                visited_auth = s.visited_auth OR v.visited_auth,
+                updated_at = NOW()
+            FROM (VALUES %s) AS v(id, ended_at, visits, real_visits, human, visited_auth)
+            WHERE s.id = v.id
+        """, [(s['id'], s['ended_at'], s['visits'], s['real_visits'], s['human'], s['visited_auth']) for s in extended],
+            template='(%s, %s::timestamp, %s, %s, %s, %s)')
+
+    if new_sessions:
+        execute_values(cur, f"""
+            INSERT INTO {SCHEMA}.visit_sessions
+            (visitor_hash, ip_address, user_agent, started_at, ended_at, visits, real_visits,
+             is_bot, landing_page, referrer, visited_auth)
+            VALUES %s
+        """, [(s['visitor_hash'], s['ip_address'], s['user_agent'], s['started_at'], s['ended_at'],
+               s['visits'], s['real_visits'], not s['human'], s['landing_page'], s['referrer'], s['visited_auth'])
+              for s in new_sessions])
+
+    add_funnel_deltas(cur, deltas)
+    save_watermark(cur, 'funnel_visits', visits[-1]['created_at'], visits[-1]['id'])
+    conn.commit()
+    cur.close()
+    return len(visits)
+
+
+def process_registrations(conn) -> int:
+    """
+    Новые пользователи после водяного знака, но не позже уже сессионизированных визитов.
+    IP и UA при регистрации не сохраняются, поэтому атрибуция по времени: человеческая сессия, идущая
+    в момент регистрации или закончившаяся за ATTRIBUTION_WINDOW до неё; при нескольких кандидатах
+    выигрывает сессия с заходом на /auth, затем ближайшая по времени
+    """
+    cur = conn.cursor()
+    mark = lock_watermark(cur, 'funnel_registrations')
+    cur.execute(f"SELECT watermark FROM {SCHEMA}.pipeline_watermarks WHERE name = 'funnel_visits'")
+    visits_mark = cur.fetchone()['watermark']
+    cur.execute(f"""
+        SELECT id, created_at FROM {SCHEMA}.users
+        WHERE (created_at, id) > (%s, %s) AND created_at <= %s
+        ORDER BY created_at, id
+        LIMIT %s
+    """, (mark['watermark'], mark['last_id'], visits_mark, BATCH_SIZE))
+    users = cur.fetchall()
+    if not users:
+        conn.rollback()
+        cur.close()
+        return 0
+
+    cur.execute(f"""
+        SELECT u.id AS user_id, s.id AS session_id
+        FROM unnest(%s::int[], %s::timestamp[]) AS u(id, registered_at)
+        JOIN LATERAL (
+            SELECT id FROM {SCHEMA}.visit_sessions s
+            WHERE s.registered_user_id IS NULL AND s.is_bot = FALSE
+            AND s.ended_at >= u.registered_at - %s
+            AND s.started_at <= u.registered_at
+            ORDER BY s.visited_auth DESC, ABS(EXTRACT(EPOCH FROM (u.registered_at - s.ended_at)))
+            LIMIT 1
+        ) s ON true
+    """, ([u['id'] for u in users], [u['created_at'] for u in users], ATTRIBUTION_WINDOW))
+    attributed = {}
+    claimed = set()
+    for row in cur.fetchall():
+        if row['session_id'] not in claimed:
+            claimed.add(row['session_id'])
+            attributed[row['user_id']] = row['session_id']
+
+    if attributed:
+        execute_values(cur, f"""
+            UPDATE {SCHEMA}.visit_sessions s
+            SET registered_user_id = v.user_id, updated_at = NOW()
+            FROM (VALUES %s) AS v(session_id, user_id)
+            WHERE s.id = v.session_id
+        """, [(session_id, user_id) for user_id, session_id in attributed.items()])
+
+    deltas = defaultdict(lambda: defaultdict(int))
+    for user in users:
+        deltas[user['created_at'].date()]['registrations'] += 1
+        deltas[user['created_at'].date()]['attributed_registrations'] += int(user['id'] in attributed)
+
+    add_funnel_deltas(cur, deltas)
+    save_watermark(cur, 'funnel_registrations', users[-1]['created_at'], users[-1]['id'])
+    conn.commit()
+    cur.close()
+    return len(users)
+
+
+def process_first_earnings(conn) -> int:
+    """Новые строки courier_earnings: курьер попадает в funnel_first_earnings один раз, по первой загрузке"""
+    cur = conn.cursor()
+    mark = lock_watermark(cur, 'funnel_first_earnings')
+    cur.execute(f"""
+        SELECT id, courier_id, upload_date FROM {SCHEMA}.courier_earnings
+        WHERE (upload_date, id) > (%s, %s) AND courier_id IS NOT NULL
+        ORDER BY upload_date, id
+        LIMIT %s
+    """, (mark['watermark'], mark['last_id'], BATCH_SIZE))
+    earnings = cur.fetchall()
+    if not earnings:
+        conn.rollback()
+        cur.close()
+        return 0
+
+    first_by_courier = {}
+    for earning in earnings:
+        first_by_courier.setdefault(earning['courier_id'], earning['upload_date'])
+    inserted = execute_values(cur, f"""
+        INSERT INTO {SCHEMA}.funnel_first_earnings (courier_id, first_earning_at)
+        VALUES %s
+        ON CONFLICT (courier_id) DO NOTHING
+        RETURNING first_earning_at
+    """, list(first_by_courier.items()), fetch=True)
+
+    deltas = defaultdict(lambda: defaultdict(int))
+    for row in inserted:
+        deltas[row['first_earning_at'].date()]['first_earnings'] += 1
+
+    add_funnel_deltas(cur, deltas)
+    save_watermark(cur, 'funnel_first_earnings', earnings[-1]['upload_date'], earnings[-1]['id'])
+    conn.commit()
+    cur.close()
+    return len(earnings)
+
+
+def run_pipeline(conn) -> Dict[str, Any]:
+    """Пачки по очереди, пока есть новые строки и не исчерпан бюджет времени"""
+    deadline = time.monotonic() + TIME_BUDGET_SECONDS
+    processed = {'visits': 0, 'registrations': 0, 'earnings': 0}
+    for key, step in (('visits', process_visits), ('registrations', process_registrations), ('earnings', process_first_earnings)):
+        while time.monotonic() < deadline:
+            count = step(conn)
+            processed[key] += count
+            if count < BATCH_SIZE:
+                break
+    cur = conn.cursor()
+    cur.execute(f"SELECT name, watermark FROM {SCHEMA}.pipeline_watermarks WHERE name LIKE 'funnel_%'")
+    watermarks = {row['name']: row['watermark'] for row in cur.fetchall()}
+    cur.close()
+    return {'processed': processed, 'watermarks': watermarks}
+
+
+def get_funnel(conn, days: int) -> Dict[str, Any]:
+    cur = conn.cursor()
+    day_from = date.today() - timedelta(days=days - 1)
+    cur.execute(f"""
+        SELECT day, {', '.join(FUNNEL_COUNTERS)}
+        FROM {SCHEMA}.funnel_daily
+        WHERE day >= %s
+        ORDER BY day DESC
+    """, (day_from,))
+    daily = cur.fetchall()
+    totals = {name: sum(row[name] for row in daily) for name in FUNNEL_COUNTERS}
+
+    cur.execute(f"""
+        SELECT COALESCE(NULLIF(referrer, ''), '') AS referrer, COUNT(*) AS registrations
+        FROM {SCHEMA}.visit_sessions
+        WHERE registered_user_id IS NOT NULL AND started_at >= %s
+        GROUP BY 1
+    """, (day_from,))
+    sources = defaultdict(int)
+    for row in cur.fetchall():
+        sources[urlparse(row['referrer']).netloc or 'direct'] += row['registrations']
+    cur.close()
+
+    def rate(numerator: str, denominator: str) -> float:
+        return round(totals[numerator] / totals[denominator] * 100, 2) if totals[denominator] else 0.0
+
+    return {
+        'days': days,
+        'totals': totals,
+        'conversion': {
+            'real_visit_rate': rate('real_visits', 'visits'),
+            'registration_rate': rate('registrations', 'real_visits'),
+            'first_earning_rate': rate('first_earnings', 'registrations')
+        },
+        'sources': sorted(({'source': k, 'registrations': v} for k, v in sources.items()), key=lambda s: -s['registrations'])[:10],
+        'daily': daily
+    }
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    action=run (по умолчанию, cron) — обработка новых визитов, регистраций и начислений
+    action=funnel&days=30 (JWT админа) — воронка за окно
+    """
+    method = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {'statusCode': 200, 'headers': CORS_HEADERS, 'body': '', 'isBase64Encoded': False}
+
+    query_params = event.get('queryStringParameters') or {}
+    action = query_params.get('action', 'run')
+
+    if action == 'funnel' and not verify_admin(event):
+        return response(401, {'error': 'Требуется авторизация'})
+
+    conn = get_db_connection()
+
+    try:
+        if action == 'run':
+            return response(200, {'success': True, **run_pipeline(conn)})
+
+        if action == 'funnel':
+            days = min(max(int(query_params.get('days') or 30), 1), 365)
+            return response(200, {'success': True, **get_funnel(conn, days)})
+
+        return response(400, {'error': f'Неизвестное действие: {action}'})
+
+    except Exception as e:
+        print(f'Error in visit-funnel: {e}')
+        conn.rollback()
+        return response(500, {'error': str(e)})
+    finally:
+        conn.close()
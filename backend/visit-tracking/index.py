@@ -4,10 +4,17 @@ Args: event with httpMethod, body, queryStringParameters; context with request_i
 Returns: HTTP response with visit data or analytics
 '''
 
+import hashlib
 import json
+import math
 import os
+import random
+import re
+import time
+import zlib
 import psycopg2
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
+from functools import lru_cache
 from typing import Dict, Any, List, Optional
 
 def get_db_connection():
@@ -16,20 +23,411 @@ def get_db_connection():
         raise ValueError('DATABASE_URL not set')
     return psycopg2.connect(dsn)
 
-def detect_bot_indicators(user_agent: str, metrics: Dict) -> tuple[bool, Dict]:
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+SKETCH_WINDOWS = (7, 30, 90)
+SKETCH_REBUILD_GRACE = timedelta(hours=1)
+# Сколько секунд один запуск обслуживания строит скетчи (остальные дни — следующим запуском)
+SKETCH_BUILD_TIME_BUDGET = 20.0
+
+class HyperLogLog:
+    """
+    HyperLogLog на 2^10 однобайтовых регистров: стандартная ошибка 1.04/sqrt(1024) ≈ 3.3%.
+    В БД хранится zlib-сжатый массив регистров (до 1 КБ, у малых дней — десятки байт)
+    """
+
+    def __init__(self, registers: Optional[bytes] = None):
+        self.registers = bytearray(registers) if registers else bytearray(HLL_REGISTERS)
+
+    def add(self, value: str):
+        hashed = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - HLL_PRECISION)
+        rest = hashed & ((1 << (64 - HLL_PRECISION)) - 1)
+        rank = (64 - HLL_PRECISION) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        estimate = HLL_ALPHA * HLL_REGISTERS * HLL_REGISTERS / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * HLL_REGISTERS and zeros:
+            estimate = HLL_REGISTERS * math.log(HLL_REGISTERS / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HyperLogLog':
+        return cls(zlib.decompress(data))
+
+DDSKETCH_RELATIVE_ACCURACY = 0.01
+DDSKETCH_GAMMA = (1 + DDSKETCH_RELATIVE_ACCURACY) / (1 - DDSKETCH_RELATIVE_ACCURACY)
+DDSKETCH_LOG_GAMMA = math.log(DDSKETCH_GAMMA)
+QUANTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+
+class DDSketch:
+    """
+    DDSketch: логарифмические корзины с шагом gamma = 1.01/0.99. Любая квантиль возвращается с относительной
+    ошибкой не больше 1% от точного значения (нули считаются отдельно и точно), слияние — сложение счётчиков
+    """
+
+    def __init__(self, bins: Optional[Dict[int, int]] = None, zero_count: int = 0):
+        self.bins = bins or {}
+        self.zero_count = zero_count
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + sum(self.bins.values())
+
+    def add(self, value: float):
+        if value is None:
+            return
+        if value <= 0:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / DDSKETCH_LOG_GAMMA)
+        self.bins[key] = self.bins.get(key, 0) + 1
+
+    def merge(self, other: 'DDSketch'):
+        self.zero_count += other.zero_count
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+
+    def quantile(self, q: float) -> Optional[float]:
+        total = self.count
+        if not total:
+            return None
+        rank = q * (total - 1)
+        cumulative = self.zero_count
+        if rank < cumulative:
+            return 0.0
+        for key in sorted(self.bins):
+            cumulative += self.bins[key]
+            if cumulative > rank:
+                return 2 * DDSKETCH_GAMMA ** key / (DDSKETCH_GAMMA + 1)
+        return 2 * DDSKETCH_GAMMA ** max(self.bins) / (DDSKETCH_GAMMA + 1)
+
+    def to_bytes(self) -> bytes:
+        return zlib.compress(json.dumps({'z': self.zero_count, 'b': self.bins}).encode('utf-8'))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'DDSketch':
+        payload = json.loads(zlib.decompress(data))
+        return cls({int(key): count for key, count in payload['b'].items()}, payload['z'])
+
+# Метрики visit_daily_sketches и тип скетча для каждой
+SKETCH_TYPES = {
+    'uniques': HyperLogLog,
+    'uniques_real': HyperLogLog,
+    'session_duration': DDSketch,
+    'max_scroll_depth': DDSketch,
+    'visit_score': DDSketch
+}
+# Распределения вовлечённости считаются по визитам без признаков бота
+ENGAGEMENT_METRICS = ('session_duration', 'max_scroll_depth', 'visit_score')
+
+def visitor_key(ip_address: Optional[str], user_agent: Optional[str]) -> str:
+    """Посетитель = IP + User-Agent (visit_id новый на каждую загрузку страницы)"""
+    return f'{ip_address or ""}|{user_agent or ""}'
+
+def build_day_sketches(conn, day: date) -> Dict[str, Any]:
+    """Один проход по партиции дня page_visits серверным курсором"""
+    sketches = {metric: sketch_type() for metric, sketch_type in SKETCH_TYPES.items()}
+    cur = conn.cursor(name='visit_day_sketch_scan')
+    cur.itersize = 5000
+    cur.execute('''
+        SELECT ip_address, user_agent, is_real_visit, is_suspected_bot,
+               session_duration, max_scroll_depth, visit_score
+        FROM t_p25272970_courier_button_site.page_visits
+        WHERE visit_date = %s
+    ''', (day,))
+    for ip_address, user_agent, is_real_visit, is_suspected_bot, *engagement in cur:
+        visitor = visitor_key(ip_address, user_agent)
+        sketches['uniques'].add(visitor)
+        if is_suspected_bot:
+            continue
+        if is_real_visit:
+            sketches['uniques_real'].add(visitor)
+        for metric, value in zip(ENGAGEMENT_METRICS, engagement):
+            sketches[metric].add(value)
+    cur.close()
+    return sketches
+
+def refresh_daily_sketches(conn, day_from: date, time_budget: Optional[float] = SKETCH_BUILD_TIME_BUDGET) -> Dict[str, int]:
+    """
+    Обслуживание (POST ?action=sketches, вызывает cleanup-visits): пересобирает скетч сегодняшнего дня и строит
+    скетчи закрытых дней с day_from, у которых их нет или они собраны до конца дня — от новых к старым.
+    Каждый день коммитится сразу; дни сверх time_budget секунд достраивает следующий запуск
+    """
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT d::date
+        FROM generate_series(%s::date, CURRENT_DATE - 1, INTERVAL '1 day') d
+        WHERE (
+            SELECT COUNT(*) FROM t_p25272970_courier_button_site.visit_daily_sketches s
+            WHERE s.day = d::date AND s.built_at >= d::date + INTERVAL '1 day' + %s
+        ) < %s
+        ORDER BY d DESC
+    ''', (day_from, SKETCH_REBUILD_GRACE, len(SKETCH_TYPES)))
+    days = [date.today()] + [row[0] for row in cur.fetchall()]
+
+    started = time.monotonic()
+    built = 0
+    for day in days:
+        if time_budget is not None and built and time.monotonic() - started >= time_budget:
+            break
+        for metric, sketch in build_day_sketches(conn, day).items():
+            cur.execute('''
+                INSERT INTO t_p25272970_courier_button_site.visit_daily_sketches (day, metric, sketch, built_at)
+                VALUES (%s, %s, %s, NOW())
+                ON CONFLICT (day, metric) DO UPDATE SET sketch = EXCLUDED.sketch, built_at = NOW()
+            ''', (day, metric, psycopg2.Binary(sketch.to_bytes())))
+        conn.commit()
+        built += 1
+    cur.close()
+    return {'built_days': built, 'remaining_days': len(days) - built}
+
+def load_daily_sketches(conn, day_from: date) -> Dict[date, Dict[str, Any]]:
+    """Скетчи по дням с day_from (включая сегодня) из visit_daily_sketches — только чтение, без сканирования page_visits"""
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT day, metric, sketch FROM t_p25272970_courier_button_site.visit_daily_sketches
+        WHERE day >= %s AND day <= CURRENT_DATE
+    ''', (day_from,))
+    daily = {}
+    for day, metric, sketch in cur.fetchall():
+        if metric in SKETCH_TYPES:
+            daily.setdefault(day, {})[metric] = SKETCH_TYPES[metric].from_bytes(bytes(sketch))
+    cur.close()
+    return daily
+
+def merge_window(daily: Dict[date, Dict[str, Any]], metric: str, days: int) -> Any:
+    """Слияние суточных скетчей метрики за последние days дней (включая сегодня)"""
+    merged = SKETCH_TYPES[metric]()
+    first_day = date.today() - timedelta(days=days - 1)
+    for day, sketches in daily.items():
+        if day >= first_day and metric in sketches:
+            merged.merge(sketches[metric])
+    return merged
+
+def evaluate_hll(days: int = 90, daily_visitors: int = 3000, pool_size: int = 100000, seed: int = 42) -> Dict[str, Any]:
+    """
+    Проверка точности на синтетике: посетители дня выбираются из общего пула (есть повторные),
+    уникальные за 7/30/90 дней из слитых суточных HLL сравниваются с точным подсчётом множеств
+    """
+    rng = random.Random(seed)
+    daily_sets = []
+    daily_sketches = []
+    for _ in range(days):
+        visitors = set()
+        for _ in range(daily_visitors):
+            n = rng.randrange(pool_size)
+            visitors.add(visitor_key(f'10.{n // 65536}.{n % 65536}', 'Mozilla/5.0'))
+        sketch = HyperLogLog()
+        for visitor in visitors:
+            sketch.add(visitor)
+        daily_sets.append(visitors)
+        daily_sketches.append(sketch)
+
+    result = {
+        'avg_sketch_bytes': round(sum(len(s.to_bytes()) for s in daily_sketches) / days),
+        'windows': {}
+    }
+    for window in SKETCH_WINDOWS:
+        exact = len(set().union(*daily_sets[-window:]))
+        merged = HyperLogLog()
+        started = time.perf_counter()
+        for sketch in daily_sketches[-window:]:
+            merged.merge(sketch)
+        estimate = merged.count()
+        result['windows'][f'{window}d'] = {
+            'exact': exact,
+            'estimate': estimate,
+            'relative_error': round(abs(estimate - exact) / exact, 4),
+            'merge_ms': round((time.perf_counter() - started) * 1000, 2)
+        }
+    return result
+
+def evaluate_ddsketch(days: int = 30, daily_visits: int = 5000, seed: int = 42) -> Dict[str, Any]:
+    """
+    Проверка гарантии DDSketch на синтетике с тяжёлым хвостом (логнормальная длительность сессии, 10% нулей):
+    p50/p90/p99 из слитых суточных скетчей против точных квантилей отсортированной выборки
+    """
+    rng = random.Random(seed)
+    values = []
+    merged = DDSketch()
+    for _ in range(days):
+        sketch = DDSketch()
+        for _ in range(daily_visits):
+            value = 0 if rng.random() < 0.1 else round(rng.lognormvariate(3.5, 1.2))
+            values.append(value)
+            sketch.add(value)
+        merged.merge(DDSketch.from_bytes(sketch.to_bytes()))
+
+    values.sort()
+    result = {'values': len(values), 'error_bound': DDSKETCH_RELATIVE_ACCURACY, 'quantiles': {}}
+    for name, q in QUANTILES.items():
+        exact = values[int(q * (len(values) - 1))]
+        estimate = merged.quantile(q)
+        result['quantiles'][name] = {
+            'exact': exact,
+            'estimate': round(estimate, 2),
+            'relative_error': round(abs(estimate - exact) / exact, 4) if exact else 0.0
+        }
+    return result
+
+def benchmark_quantiles(days: int = 30) -> Dict[str, Any]:
+    """Замер на живой БД: percentile_cont по сырым page_visits за окно против слияния суточных DDSketch"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    day_from = date.today() - timedelta(days=days - 1)
+    result = {'days': days, 'exact': {}, 'sketch': {}}
+
+    started = time.perf_counter()
+    for metric in ENGAGEMENT_METRICS:
+        cur.execute(f'''
+            SELECT percentile_cont(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (ORDER BY {metric})
+            FROM t_p25272970_courier_button_site.page_visits
+            WHERE visit_date >= %s AND is_suspected_bot = false AND {metric} IS NOT NULL
+        ''', (day_from,))
+        exact = cur.fetchone()[0] or [None] * len(QUANTILES)
+        result['exact'][metric] = dict(zip(QUANTILES, exact))
+    result['exact_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    cur.close()
+
+    refresh_daily_sketches(conn, day_from, time_budget=None)
+    daily = load_daily_sketches(conn, day_from)
+    started = time.perf_counter()
+    for metric in ENGAGEMENT_METRICS:
+        merged = merge_window(daily, metric, days)
+        result['sketch'][metric] = {name: merged.quantile(q) for name, q in QUANTILES.items()}
+    result['sketch_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    conn.close()
+    return result
+
+# Запасной набор правил, если таблица bot_ua_rules недоступна (совпадает с начальным наполнением V0096)
+DEFAULT_BOT_RULES = [
+    (r'bot\b|bot/', 'bot'),
+    (r'crawler', 'crawler'),
+    (r'spider', 'spider'),
+    (r'scraper', 'scraper'),
+    (r'^curl/', 'curl'),
+    (r'^wget/', 'wget'),
+    (r'python-requests|python-urllib|aiohttp|httpx', 'python-requests'),
+    (r'go-http-client|okhttp|java/|libwww-perl|axios/|node-fetch', 'http-library'),
+    (r'headlesschrome|phantomjs|puppeteer|playwright|selenium', 'headless'),
+    (r'yandex(bot|images|metrika|direct|accessibilitybot)', 'yandex'),
+    (r'facebookexternalhit|telegrambot|whatsapp|vkshare|twitterbot', 'link-preview'),
+    (r'lighthouse|pagespeed|gtmetrix|pingdom|uptimerobot', 'monitoring')
+]
+BOT_RULES_TTL_SECONDS = 300
+UA_CACHE_SIZE = 2048
+MIN_USER_AGENT_LENGTH = 20
+
+# Все шаблоны применяются к UA в нижнем регистре (без IGNORECASE re заметно быстрее).
+# Разбор UA: порядок важен (Edge/Opera/Яндекс содержат "Chrome", Chrome содержит "Safari", iOS содержит "Mac OS X")
+UA_BROWSER_PATTERNS = [(re.compile(pattern), name) for pattern, name in [
+    (r'edg(e|a|ios)?/', 'Edge'),
+    (r'opr/|opera', 'Opera'),
+    (r'yabrowser', 'Yandex'),
+    (r'samsungbrowser', 'Samsung'),
+    (r'firefox|fxios', 'Firefox'),
+    (r'chrome|crios|chromium', 'Chrome'),
+    (r'safari', 'Safari')
+]]
+UA_OS_PATTERNS = [(re.compile(pattern), name) for pattern, name in [
+    (r'iphone|ipad|ipod', 'iOS'),
+    (r'android', 'Android'),
+    (r'windows', 'Windows'),
+    (r'mac os x|macintosh', 'MacOS'),
+    (r'cros', 'ChromeOS'),
+    (r'linux', 'Linux')
+]]
+UA_TABLET_PATTERN = re.compile(r'ipad|tablet|android(?!.*mobile)')
+UA_MOBILE_PATTERN = re.compile(r'mobi|iphone|ipod|android')
+
+class UserAgentClassifier:
+    """
+    Классификатор UA: правила ботов компилируются один раз при загрузке набора,
+    вердикты (бот/метка, устройство, браузер, ОС) кешируются LRU по строке UA.
+    Одно выражение-альтернация в re оказалось в ~10 раз медленнее отдельных шаблонов, поэтому набор — список
+    """
+
+    def __init__(self, rules: List[tuple]):
+        self.rules = []
+        for pattern, label in rules:
+            try:
+                self.rules.append((re.compile(pattern), label))
+            except re.error as e:
+                print(f'Skipping invalid bot rule {pattern!r}: {e}')
+        self.classify = lru_cache(maxsize=UA_CACHE_SIZE)(self.classify_uncached)
+
+    def classify_uncached(self, user_agent: str) -> Dict[str, Any]:
+        user_agent = user_agent.lower()
+        bot_label = None
+        if len(user_agent) < MIN_USER_AGENT_LENGTH:
+            bot_label = 'short_user_agent'
+        else:
+            bot_label = next((label for pattern, label in self.rules if pattern.search(user_agent)), None)
+
+        if UA_TABLET_PATTERN.search(user_agent):
+            device_type = 'tablet'
+        elif UA_MOBILE_PATTERN.search(user_agent):
+            device_type = 'mobile'
+        else:
+            device_type = 'desktop'
+
+        browser = next((name for pattern, name in UA_BROWSER_PATTERNS if pattern.search(user_agent)), 'Unknown')
+        os_name = next((name for pattern, name in UA_OS_PATTERNS if pattern.search(user_agent)), 'Unknown')
+        return {'bot_label': bot_label, 'device_type': device_type, 'browser': browser, 'os': os_name}
+
+    def cache_stats(self) -> Dict[str, Any]:
+        info = self.classify.cache_info()
+        total = info.hits + info.misses
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'hit_rate': info.hits / total if total else 0.0}
+
+_ua_classifier = None
+_ua_classifier_loaded_at = 0.0
+
+def load_bot_rules(cur) -> List[tuple]:
+    cur.execute('''
+        SELECT pattern, label FROM t_p25272970_courier_button_site.bot_ua_rules
+        WHERE is_active = true
+        ORDER BY id
+    ''')
+    return [(row[0], row[1]) for row in cur.fetchall()]
+
+def get_ua_classifier(cur) -> UserAgentClassifier:
+    """Классификатор живёт в тёплом инстансе и перечитывает bot_ua_rules раз в BOT_RULES_TTL_SECONDS"""
+    global _ua_classifier, _ua_classifier_loaded_at
+    if _ua_classifier and time.monotonic() - _ua_classifier_loaded_at < BOT_RULES_TTL_SECONDS:
+        return _ua_classifier
+    try:
+        rules = load_bot_rules(cur)
+    except psycopg2.Error as e:
+        print(f'Failed to load bot_ua_rules, using defaults: {e}')
+        cur.connection.rollback()
+        return _ua_classifier or UserAgentClassifier(DEFAULT_BOT_RULES)
+    _ua_classifier = UserAgentClassifier(rules or DEFAULT_BOT_RULES)
+    _ua_classifier_loaded_at = time.monotonic()
+    return _ua_classifier
+
+def detect_bot_indicators(user_agent: str, metrics: Dict, ua_info: Dict[str, Any]) -> tuple[bool, Dict]:
     indicators = {}
     is_bot = False
     
-    if not user_agent or len(user_agent) < 20:
+    if ua_info['bot_label'] == 'short_user_agent':
         indicators['short_user_agent'] = True
         is_bot = True
-    
-    bot_keywords = ['bot', 'crawler', 'spider', 'scraper', 'curl', 'wget', 'python-requests']
-    for keyword in bot_keywords:
-        if keyword.lower() in user_agent.lower():
-            indicators['bot_keyword'] = keyword
-            is_bot = True
-            break
+    elif ua_info['bot_label']:
+        indicators['bot_keyword'] = ua_info['bot_label']
+        is_bot = True
     
     if metrics.get('session_duration', 0) < 2:
         indicators['too_fast'] = True
@@ -45,6 +443,123 @@ def detect_bot_indicators(user_agent: str, metrics: Dict) -> tuple[bool, Dict]:
     
     return is_bot, indicators
 
+def benchmark_ua_classifier(visits: int = 100000, distinct_user_agents: int = 500, seed: int = 42) -> Dict[str, Any]:
+    """
+    Микробенчмарк на синтетическом трафике с распределением Ципфа по UA (несколько сотен UA дают основную массу):
+    стоимость классификации на визит с кешем и без, доля попаданий в кеш
+    """
+    rng = random.Random(seed)
+    templates = [
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{v}.0.0.0 Safari/537.36',
+        'Mozilla/5.0 (iPhone; CPU iPhone OS 17_{v} like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1',
+        'Mozilla/5.0 (Linux; Android 14; SM-A{v}) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Mobile Safari/537.36',
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 YaBrowser/{v}.0 Safari/537.36',
+        'Mozilla/5.0 (compatible; YandexBot/3.{v}; +http://yandex.com/bots)'
+    ]
+    user_agents = [templates[i % len(templates)].format(v=i) for i in range(distinct_user_agents)]
+    weights = [1 / (rank + 1) for rank in range(distinct_user_agents)]
+    stream = rng.choices(user_agents, weights=weights, k=visits)
+
+    classifier = UserAgentClassifier(DEFAULT_BOT_RULES)
+    started = time.perf_counter()
+    bots = sum(1 for user_agent in stream if classifier.classify(user_agent)['bot_label'])
+    cached_us = (time.perf_counter() - started) * 1e6 / visits
+
+    started = time.perf_counter()
+    for user_agent in stream[:10000]:
+        classifier.classify_uncached(user_agent)
+    uncached_us = (time.perf_counter() - started) * 1e6 / min(visits, 10000)
+
+    return {
+        'visits': visits,
+        'distinct_user_agents': distinct_user_agents,
+        'bots': bots,
+        'cached_us_per_visit': round(cached_us, 2),
+        'uncached_us_per_visit': round(uncached_us, 2),
+        'cache': classifier.cache_stats()
+    }
+
+BENCHMARK_UPSERT = {
+    'plain': '''
+        INSERT INTO bench_visits_plain (visit_id, visit_score, session_duration)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (visit_id) DO UPDATE SET
+            visit_score = EXCLUDED.visit_score,
+            session_duration = EXCLUDED.session_duration
+    ''',
+    'partitioned': '''
+        INSERT INTO bench_visits_part (visit_id, visit_date, visit_score, session_duration)
+        VALUES (%s, COALESCE((
+            SELECT visit_date FROM bench_visits_part
+            WHERE visit_id = %s AND visit_date >= CURRENT_DATE - 1
+            LIMIT 1
+        ), CURRENT_DATE), %s, %s)
+        ON CONFLICT (visit_id, visit_date) DO UPDATE SET
+            visit_score = EXCLUDED.visit_score,
+            session_duration = EXCLUDED.session_duration
+    '''
+}
+
+def benchmark_page_visits(rows: int = 100000, upserts: int = 2000, days: int = 90) -> Dict[str, Any]:
+    '''
+    Сравнение обычной и посуточно партиционированной page_visits на временных таблицах:
+    средняя задержка upsert визита и аналитического запроса за 7 дней. Транзакция откатывается
+    '''
+    conn = get_db_connection()
+    cur = conn.cursor()
+    columns = '''
+        id SERIAL, visit_id VARCHAR(64) NOT NULL, visit_date DATE NOT NULL DEFAULT CURRENT_DATE,
+        is_real_visit BOOLEAN DEFAULT FALSE, is_suspected_bot BOOLEAN DEFAULT FALSE,
+        visit_score INTEGER DEFAULT 0, session_duration INTEGER DEFAULT 0, created_at TIMESTAMP DEFAULT NOW()
+    '''
+    cur.execute(f'CREATE TEMP TABLE bench_visits_plain ({columns}, PRIMARY KEY (id), UNIQUE (visit_id))')
+    cur.execute(f'''
+        CREATE TEMP TABLE bench_visits_part ({columns}, PRIMARY KEY (id, visit_date), UNIQUE (visit_id, visit_date))
+        PARTITION BY RANGE (visit_date)
+    ''')
+    for offset in range(-days, 2):
+        day = (datetime.now() + timedelta(days=offset)).date()
+        cur.execute(f'''
+            CREATE TEMP TABLE bench_visits_part_{offset + days} PARTITION OF bench_visits_part
+            FOR VALUES FROM (%s) TO (%s)
+        ''', (day, day + timedelta(days=1)))
+
+    result = {'rows': rows, 'upserts': upserts, 'days': days}
+    for variant, table in (('plain', 'bench_visits_plain'), ('partitioned', 'bench_visits_part')):
+        cur.execute(f'''
+            INSERT INTO {table} (visit_id, visit_date, is_real_visit, is_suspected_bot, visit_score, session_duration, created_at)
+            SELECT 'bench_' || n, ts::date, random() < 0.6, random() < 0.2, (random() * 100)::int, (random() * 300)::int, ts
+            FROM (
+                SELECT n, NOW() - random() * %s * INTERVAL '1 day' AS ts
+                FROM generate_series(1, %s) n
+            ) s
+        ''', (days, rows))
+        cur.execute(f'ANALYZE {table}')
+
+        started = datetime.now()
+        for i in range(upserts):
+            visit_id = f'bench_live_{i // 2}'
+            params = (visit_id, i, i) if variant == 'plain' else (visit_id, visit_id, i, i)
+            cur.execute(BENCHMARK_UPSERT[variant], params)
+        upsert_ms = (datetime.now() - started).total_seconds() * 1000 / upserts
+
+        date_from = datetime.now() - timedelta(days=7)
+        started = datetime.now()
+        cur.execute(f'''
+            SELECT COUNT(*), COUNT(*) FILTER (WHERE is_real_visit = true), AVG(visit_score), AVG(session_duration)
+            FROM {table}
+            WHERE visit_date >= %s AND created_at >= %s
+        ''', (date_from.date(), date_from))
+        cur.fetchone()
+        analytics_ms = (datetime.now() - started).total_seconds() * 1000
+
+        result[variant] = {'avg_upsert_ms': round(upsert_ms, 3), 'analytics_7d_ms': round(analytics_ms, 1)}
+
+    conn.rollback()
+    cur.close()
+    conn.close()
+    return result
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
@@ -64,6 +579,37 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         conn = get_db_connection()
         cur = conn.cursor()
         
+        params = event.get('queryStringParameters', {}) or {}
+        
+        if method == 'POST' and params.get('action') == 'sketches':
+            # Обслуживание скетчей аналитики: вызывается cleanup-visits с токеном администратора
+            headers = event.get('headers', {})
+            auth_token = headers.get('X-Auth-Token', '') or headers.get('x-auth-token', '')
+            cur.execute('''
+                SELECT username FROM t_p25272970_courier_button_site.admins
+                WHERE token = %s
+            ''', (auth_token,))
+            if not auth_token or not cur.fetchone():
+                return {
+                    'statusCode': 401,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({'error': 'Unauthorized'})
+                }
+            
+            refreshed = refresh_daily_sketches(conn, date.today() - timedelta(days=max(SKETCH_WINDOWS) - 1))
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({'success': True, **refreshed})
+            }
+        
         if method == 'POST':
             body = json.loads(event.get('body', '{}'))
             
@@ -80,16 +626,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'is_first_visit': body.get('is_first_visit', True)
             }
             
-            is_bot, bot_indicators = detect_bot_indicators(user_agent, metrics)
+            ua_info = get_ua_classifier(cur).classify(user_agent or '')
+            is_bot, bot_indicators = detect_bot_indicators(user_agent, metrics, ua_info)
             
+            # Таблица партиционирована по visit_date: для уже записанного визита берём его день
+            # (визит мог начаться вчера), чтобы ON CONFLICT попал в ту же строку
             cur.execute('''
                 INSERT INTO t_p25272970_courier_button_site.page_visits 
-                (visit_id, ip_address, user_agent, page_url, referrer,
+                (visit_id, visit_date, ip_address, user_agent, page_url, referrer,
                  is_real_visit, visit_score, session_duration, max_scroll_depth,
                  mouse_movements, is_first_visit, is_suspected_bot, bot_indicators,
                  device_type, browser, os)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (visit_id) 
+                VALUES (%s, COALESCE((
+                    SELECT visit_date FROM t_p25272970_courier_button_site.page_visits
+                    WHERE visit_id = %s AND visit_date >= CURRENT_DATE - 1
+                    LIMIT 1
+                ), CURRENT_DATE), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (visit_id, visit_date) 
                 DO UPDATE SET
                     is_real_visit = EXCLUDED.is_real_visit,
                     visit_score = EXCLUDED.visit_score,
@@ -102,6 +655,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     updated_at = NOW()
                 RETURNING id
             ''', (
+                visit_id,
                 visit_id,
                 ip_address,
                 user_agent,
@@ -115,9 +669,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 metrics['is_first_visit'],
                 is_bot,
                 json.dumps(bot_indicators),
-                body.get('device_type', ''),
-                body.get('browser', ''),
-                body.get('os', '')
+                ua_info['device_type'],
+                ua_info['browser'] if ua_info['browser'] != 'Unknown' else body.get('browser', ''),
+                ua_info['os'] if ua_info['os'] != 'Unknown' else body.get('os', '')
             ))
             
             visit_db_id = cur.fetchone()[0]
@@ -138,7 +692,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         elif method == 'GET':
-            params = event.get('queryStringParameters', {}) or {}
             headers = event.get('headers', {})
             auth_token = headers.get('X-Auth-Token', '') or headers.get('x-auth-token', '')
             
@@ -154,6 +707,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             days = int(params.get('days', 7))
             date_from = datetime.now() - timedelta(days=days)
+            # visit_date = день created_at; фильтр по нему отсекает лишние партиции
+            day_from = date_from.date()
             
             cur.execute('''
                 SELECT
@@ -167,22 +722,22 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     AVG(max_scroll_depth) as avg_scroll,
                     AVG(mouse_movements) as avg_mouse_movements
                 FROM t_p25272970_courier_button_site.page_visits
-                WHERE created_at >= %s
-            ''', (date_from,))
+                WHERE visit_date >= %s AND created_at >= %s
+            ''', (day_from, date_from))
             
             stats = cur.fetchone()
             
             cur.execute('''
                 SELECT 
-                    DATE(created_at) as date,
+                    visit_date as date,
                     COUNT(*) as total,
                     COUNT(*) FILTER (WHERE is_real_visit = true) as real,
                     COUNT(*) FILTER (WHERE is_suspected_bot = true) as bots
                 FROM t_p25272970_courier_button_site.page_visits
-                WHERE created_at >= %s
-                GROUP BY DATE(created_at)
+                WHERE visit_date >= %s AND created_at >= %s
+                GROUP BY visit_date
                 ORDER BY date DESC
-            ''', (date_from,))
+            ''', (day_from, date_from))
             
             daily_stats = [
                 {
@@ -201,12 +756,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     MAX(created_at) as last_visit,
                     AVG(visit_score) as avg_score
                 FROM t_p25272970_courier_button_site.page_visits
-                WHERE created_at >= %s
+                WHERE visit_date >= %s AND created_at >= %s
                 GROUP BY ip_address
                 HAVING COUNT(*) > 1
                 ORDER BY visit_count DESC
                 LIMIT 20
-            ''', (date_from,))
+            ''', (day_from, date_from))
             
             repeat_visitors = [
                 {
@@ -223,11 +778,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     bot_indicators,
                     COUNT(*) as count
                 FROM t_p25272970_courier_button_site.page_visits
-                WHERE is_suspected_bot = true AND created_at >= %s
+                WHERE is_suspected_bot = true AND visit_date >= %s AND created_at >= %s
                 GROUP BY bot_indicators
                 ORDER BY count DESC
                 LIMIT 10
-            ''', (date_from,))
+            ''', (day_from, date_from))
             
             bot_patterns = [
                 {
@@ -237,7 +792,33 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 for row in cur.fetchall()
             ]
             
+            # Уникальные посетители из суточных HLL-скетчей вместо COUNT(DISTINCT) по сырым визитам.
+            # Скетчи только читаются: строит их обслуживание (cleanup-visits → POST ?action=sketches)
+            windows = sorted(set(SKETCH_WINDOWS) | ({days} if 0 < days <= max(SKETCH_WINDOWS) else set()))
+            daily_sketches = load_daily_sketches(conn, date.today() - timedelta(days=max(windows) - 1))
+            uniques = {
+                f'{window}d': {
+                    'visitors': merge_window(daily_sketches, 'uniques', window).count(),
+                    'real_visitors': merge_window(daily_sketches, 'uniques_real', window).count()
+                }
+                for window in windows
+            }
+            
+            # p50/p90/p99 вовлечённости из суточных DDSketch (ошибка <= 1% от значения)
+            quantile_window = min(days, max(SKETCH_WINDOWS)) if days > 0 else max(SKETCH_WINDOWS)
+            engagement_quantiles = {}
+            for metric in ENGAGEMENT_METRICS:
+                merged = merge_window(daily_sketches, metric, quantile_window)
+                engagement_quantiles[metric] = {}
+                for name, q in QUANTILES.items():
+                    value = merged.quantile(q)
+                    engagement_quantiles[metric][name] = round(value, 1) if value is not None else None
+            
             response_data = {
+                'uniques': uniques,
+                'engagement_quantiles': engagement_quantiles,
+                # Дней окна со скетчами: меньше window — обслуживание ещё не достроило пропущенные дни
+                'sketch_days': {'stored': len(daily_sketches), 'window': max(windows)},
                 'summary': {
                     'total_visits': stats[0] or 0,
                     'real_visits': stats[1] or 0,
@@ -0,0 +1,47 @@
+-- Курируемая база вопросов и ответов для локального FAQ-поиска Telegram-бота (BM25)
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.bot_faq_entries (
+    id SERIAL PRIMARY KEY,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    is_active BOOLEAN DEFAULT true,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_bot_faq_entries_active
+ON t_p25272970_courier_button_site.bot_faq_entries(is_active);
+
+INSERT INTO t_p25272970_courier_button_site.bot_faq_entries (question, answer) VALUES
+('Сколько платят за реферала? Бонус за приглашённого друга',
+'🎁 <b>Реферальная программа:</b>
+
+• 12,000₽ за каждого приглашённого друга
+• Бонус приходит после 150 заказов друга
+• БЕЗ ограничений по количеству рефералов
+
+Реферальная ссылка есть в личном кабинете на stuey-go.ru 👇'),
+('Что такое самобонус? Бонус за свои 150 заказов',
+'🎯 <b>Самобонус 5,000₽</b>
+
+Выполни свои первые 150 заказов — и получи 5,000₽ на баланс!
+Прогресс видно в личном кабинете и в разделе «📊 Статистика».'),
+('Как вывести деньги с баланса? Заявка на вывод средств',
+'💸 <b>Вывод средств:</b>
+
+1️⃣ Зайди в личный кабинет на stuey-go.ru
+2️⃣ Открой раздел «Выплаты»
+3️⃣ Подай заявку на вывод — мы обработаем её в ближайшее время!'),
+('Какой график работы? Можно совмещать с учёбой',
+'🕒 <b>График работы — гибкий!</b>
+
+Работаешь когда хочешь: утром, вечером или только в выходные.
+Можно совмещать с учёбой или основной работой.'),
+('Нужно ли платить за регистрацию? Это бесплатно?',
+'✅ <b>Нет, всё бесплатно!</b>
+
+Регистрация на stuey-go.ru и в Яндекс.Еде не стоит ни рубля.'),
+('Где взять термокороб? Нужна ли сумка курьера',
+'🎒 <b>Термокороб</b>
+
+Термокороб выдают после регистрации в Яндекс.Еде — менеджер подскажет ближайший пункт выдачи.')
+;
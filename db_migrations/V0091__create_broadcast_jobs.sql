@@ -0,0 +1,32 @@
+-- Задания массовой рассылки в Telegram: снимок аудитории + прогресс, чтобы прерванная по таймауту рассылка продолжалась с места остановки
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.broadcast_jobs (
+    id SERIAL PRIMARY KEY,
+    message_text TEXT NOT NULL,
+    parse_mode VARCHAR(20) DEFAULT 'HTML',
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'running', 'completed', 'cancelled')),
+    total_recipients INTEGER DEFAULT 0,
+    sent_count INTEGER DEFAULT 0,
+    failed_count INTEGER DEFAULT 0,
+    blocked_count INTEGER DEFAULT 0,
+    created_by VARCHAR(100),
+    locked_until TIMESTAMP,
+    created_at TIMESTAMP DEFAULT NOW(),
+    started_at TIMESTAMP,
+    last_progress_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.broadcast_recipients (
+    job_id INTEGER NOT NULL REFERENCES t_p25272970_courier_button_site.broadcast_jobs(id),
+    seq INTEGER NOT NULL,
+    telegram_id VARCHAR(100) NOT NULL,
+    courier_id INTEGER,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'failed', 'blocked')),
+    error TEXT,
+    sent_at TIMESTAMP,
+    PRIMARY KEY (job_id, seq)
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON t_p25272970_courier_button_site.broadcast_jobs(status, created_at);
+CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending
+ON t_p25272970_courier_button_site.broadcast_recipients(job_id, seq) WHERE status = 'pending';
@@ -0,0 +1,21 @@
+-- Transactional outbox для уведомлений: пишется в одной транзакции с бизнес-изменением,
+-- отправляется отдельной функцией notification-outbox пачками с ретраями
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.notification_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    channel VARCHAR(20) NOT NULL DEFAULT 'telegram',
+    recipient VARCHAR(100) NOT NULL,
+    message_text TEXT NOT NULL,
+    event_type VARCHAR(50),
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_pending
+ON t_p25272970_courier_button_site.notification_outbox(next_attempt_at) WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_created
+ON t_p25272970_courier_button_site.notification_outbox(created_at);
@@ -0,0 +1,61 @@
+-- Помесячное партиционирование activity_log по created_at
+-- Старая таблица переименовывается, данные переносятся в партиции, id продолжают ту же последовательность
+ALTER TABLE t_p25272970_courier_button_site.activity_log RENAME TO activity_log_legacy;
+ALTER TABLE t_p25272970_courier_button_site.activity_log_legacy RENAME CONSTRAINT activity_log_pkey TO activity_log_legacy_pkey;
+ALTER INDEX t_p25272970_courier_button_site.idx_activity_log_created_at RENAME TO idx_activity_log_legacy_created_at;
+ALTER INDEX t_p25272970_courier_button_site.idx_activity_log_event_type RENAME TO idx_activity_log_legacy_event_type;
+ALTER SEQUENCE t_p25272970_courier_button_site.activity_log_id_seq OWNED BY NONE;
+
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.activity_log (
+    id INTEGER NOT NULL DEFAULT nextval('t_p25272970_courier_button_site.activity_log_id_seq'),
+    event_type VARCHAR(50) NOT NULL,
+    message TEXT NOT NULL,
+    data JSONB,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE t_p25272970_courier_button_site.activity_log_id_seq OWNED BY t_p25272970_courier_button_site.activity_log.id;
+
+-- Страховочная партиция: сюда попадают строки за месяцы, для которых партиция ещё не создана.
+-- Обслуживание в cleanup-visits переносит их в месячную партицию при её создании
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.activity_log_default
+PARTITION OF t_p25272970_courier_button_site.activity_log DEFAULT;
+
+-- Месячные партиции activity_log_pYYYY_MM: от самого старого события до текущего месяца + 2 вперёд
+DO $$
+DECLARE
+    month_start DATE;
+    last_month DATE := (date_trunc('month', NOW()) + INTERVAL '2 months')::date;
+BEGIN
+    SELECT COALESCE(date_trunc('month', MIN(created_at)), date_trunc('month', NOW()))::date
+    INTO month_start
+    FROM t_p25272970_courier_button_site.activity_log_legacy;
+
+    WHILE month_start <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.%I PARTITION OF t_p25272970_courier_button_site.activity_log FOR VALUES FROM (%L) TO (%L)',
+            'activity_log_p' || to_char(month_start, 'YYYY_MM'),
+            month_start,
+            (month_start + INTERVAL '1 month')::date
+        );
+        month_start := (month_start + INTERVAL '1 month')::date;
+    END LOOP;
+END $$;
+
+INSERT INTO t_p25272970_courier_button_site.activity_log (id, event_type, message, data, created_at)
+SELECT id, event_type, message, data, COALESCE(created_at, NOW())
+FROM t_p25272970_courier_button_site.activity_log_legacy;
+
+DROP TABLE t_p25272970_courier_button_site.activity_log_legacy;
+
+-- Индексы ленты (keyset-пагинация по (created_at, id)) с фильтрами по типу события и курьеру
+CREATE INDEX IF NOT EXISTS idx_activity_log_feed
+ON t_p25272970_courier_button_site.activity_log(created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_activity_log_event_type_feed
+ON t_p25272970_courier_button_site.activity_log(event_type, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_activity_log_courier_feed
+ON t_p25272970_courier_button_site.activity_log((data->>'courier_id'), created_at DESC, id DESC)
+WHERE data ? 'courier_id';
@@ -0,0 +1,100 @@
+-- Посуточное партиционирование page_visits
+-- Ключ партиционирования visit_date — день первой записи визита; уникальность визита теперь (visit_id, visit_date),
+-- visit-tracking подставляет дату уже существующей строки визита, так что upsert по-прежнему попадает в одну строку
+ALTER TABLE t_p25272970_courier_button_site.page_visits RENAME TO page_visits_legacy;
+ALTER TABLE t_p25272970_courier_button_site.page_visits_legacy RENAME CONSTRAINT page_visits_pkey TO page_visits_legacy_pkey;
+ALTER TABLE t_p25272970_courier_button_site.page_visits_legacy RENAME CONSTRAINT page_visits_visit_id_key TO page_visits_legacy_visit_id_key;
+DROP INDEX IF EXISTS t_p25272970_courier_button_site.idx_page_visits_ip;
+DROP INDEX IF EXISTS t_p25272970_courier_button_site.idx_page_visits_created;
+DROP INDEX IF EXISTS t_p25272970_courier_button_site.idx_page_visits_created_at;
+DROP INDEX IF EXISTS t_p25272970_courier_button_site.idx_page_visits_is_real;
+DROP INDEX IF EXISTS t_p25272970_courier_button_site.idx_page_visits_is_bot;
+DROP INDEX IF EXISTS t_p25272970_courier_button_site.idx_page_visits_suspected_bots;
+ALTER SEQUENCE t_p25272970_courier_button_site.page_visits_id_seq OWNED BY NONE;
+
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.page_visits (
+    id INTEGER NOT NULL DEFAULT nextval('t_p25272970_courier_button_site.page_visits_id_seq'),
+    visit_id VARCHAR(64) NOT NULL,
+    visit_date DATE NOT NULL DEFAULT CURRENT_DATE,
+    ip_address VARCHAR(45),
+    user_agent TEXT,
+    page_url VARCHAR(500),
+    referrer VARCHAR(500),
+    is_real_visit BOOLEAN DEFAULT FALSE,
+    visit_score INTEGER DEFAULT 0,
+    session_duration INTEGER DEFAULT 0,
+    max_scroll_depth INTEGER DEFAULT 0,
+    mouse_movements INTEGER DEFAULT 0,
+    is_first_visit BOOLEAN DEFAULT TRUE,
+    is_suspected_bot BOOLEAN DEFAULT FALSE,
+    bot_indicators JSONB DEFAULT '{}',
+    device_type VARCHAR(50),
+    browser VARCHAR(100),
+    os VARCHAR(100),
+    screen_resolution VARCHAR(20),
+    visit_started_at TIMESTAMP DEFAULT NOW(),
+    visit_ended_at TIMESTAMP,
+    last_activity_at TIMESTAMP DEFAULT NOW(),
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (id, visit_date),
+    UNIQUE (visit_id, visit_date)
+) PARTITION BY RANGE (visit_date);
+
+ALTER SEQUENCE t_p25272970_courier_button_site.page_visits_id_seq OWNED BY t_p25272970_courier_button_site.page_visits.id;
+
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.page_visits_default
+PARTITION OF t_p25272970_courier_button_site.page_visits DEFAULT;
+
+-- Суточные партиции page_visits_pYYYY_MM_DD: последние 90 дней (срок хранения cleanup-visits) и 7 дней вперёд
+DO $$
+DECLARE
+    day_start DATE := CURRENT_DATE - 90;
+BEGIN
+    WHILE day_start <= CURRENT_DATE + 7 LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.%I PARTITION OF t_p25272970_courier_button_site.page_visits FOR VALUES FROM (%L) TO (%L)',
+            'page_visits_p' || to_char(day_start, 'YYYY_MM_DD'),
+            day_start,
+            day_start + 1
+        );
+        day_start := day_start + 1;
+    END LOOP;
+END $$;
+
+-- Визиты старше 90 дней не переносятся: cleanup-visits всё равно удалил бы их при следующем запуске
+INSERT INTO t_p25272970_courier_button_site.page_visits
+(id, visit_id, visit_date, ip_address, user_agent, page_url, referrer,
+ is_real_visit, visit_score, session_duration, max_scroll_depth, mouse_movements, is_first_visit,
+ is_suspected_bot, bot_indicators, device_type, browser, os, screen_resolution,
+ visit_started_at, visit_ended_at, last_activity_at, created_at, updated_at)
+SELECT id, visit_id, COALESCE(created_at, NOW())::date, ip_address, user_agent, page_url, referrer,
+       is_real_visit, visit_score, session_duration, max_scroll_depth, mouse_movements, is_first_visit,
+       is_suspected_bot, bot_indicators, device_type, browser, os, screen_resolution,
+       visit_started_at, visit_ended_at, last_activity_at, created_at, updated_at
+FROM t_p25272970_courier_button_site.page_visits_legacy
+WHERE created_at IS NULL OR created_at >= CURRENT_DATE - 90;
+
+DROP TABLE t_p25272970_courier_button_site.page_visits_legacy;
+
+CREATE INDEX IF NOT EXISTS idx_page_visits_visit_id
+ON t_p25272970_courier_button_site.page_visits(visit_id);
+
+CREATE INDEX IF NOT EXISTS idx_page_visits_ip
+ON t_p25272970_courier_button_site.page_visits(ip_address);
+
+CREATE INDEX IF NOT EXISTS idx_page_visits_created_at
+ON t_p25272970_courier_button_site.page_visits(created_at);
+
+CREATE INDEX IF NOT EXISTS idx_page_visits_is_real
+ON t_p25272970_courier_button_site.page_visits(is_real_visit)
+WHERE is_real_visit = true;
+
+CREATE INDEX IF NOT EXISTS idx_page_visits_suspected_bots
+ON t_p25272970_courier_button_site.page_visits(is_suspected_bot)
+WHERE is_suspected_bot = true;
+
+COMMENT ON TABLE t_p25272970_courier_button_site.page_visits IS 'Tracking page visits with bot protection, partitioned by visit_date (day)';
+COMMENT ON COLUMN t_p25272970_courier_button_site.page_visits.visit_date IS 'День первой записи визита, ключ партиционирования';
+COMMENT ON COLUMN t_p25272970_courier_button_site.page_visits.visit_score IS 'Score 0-100, >=50 is real visit';
+COMMENT ON COLUMN t_p25272970_courier_button_site.page_visits.bot_indicators IS 'JSON with bot detection signals';
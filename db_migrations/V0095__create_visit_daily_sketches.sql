@@ -0,0 +1,11 @@
+-- Суточные скетчи аналитики визитов (HyperLogLog уникальных посетителей и т.п.), сливаются при запросе за любое окно
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.visit_daily_sketches (
+    day DATE NOT NULL,
+    metric VARCHAR(50) NOT NULL,
+    sketch BYTEA NOT NULL,
+    built_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (day, metric)
+);
+
+COMMENT ON TABLE t_p25272970_courier_button_site.visit_daily_sketches IS 'Сжатые суточные скетчи по page_visits, строятся visit-tracking для закрытых дней';
+COMMENT ON COLUMN t_p25272970_courier_button_site.visit_daily_sketches.built_at IS 'Скетч дня, построенный раньше чем через час после его окончания, пересобирается';
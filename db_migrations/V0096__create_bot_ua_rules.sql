@@ -0,0 +1,29 @@
+-- Правила распознавания ботов по User-Agent для visit-tracking: регулярные выражения в нижнем регистре,
+-- применяются к User-Agent, приведённому к нижнему регистру
+-- Изменения подхватываются тёплыми инстансами функции в течение 5 минут, без деплоя
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.bot_ua_rules (
+    id SERIAL PRIMARY KEY,
+    pattern TEXT NOT NULL,
+    label VARCHAR(50) NOT NULL,
+    is_active BOOLEAN DEFAULT true,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_bot_ua_rules_active
+ON t_p25272970_courier_button_site.bot_ua_rules(is_active);
+
+INSERT INTO t_p25272970_courier_button_site.bot_ua_rules (pattern, label) VALUES
+('bot\b|bot/', 'bot'),
+('crawler', 'crawler'),
+('spider', 'spider'),
+('scraper', 'scraper'),
+('^curl/', 'curl'),
+('^wget/', 'wget'),
+('python-requests|python-urllib|aiohttp|httpx', 'python-requests'),
+('go-http-client|okhttp|java/|libwww-perl|axios/|node-fetch', 'http-library'),
+('headlesschrome|phantomjs|puppeteer|playwright|selenium', 'headless'),
+('yandex(bot|images|metrika|direct|accessibilitybot)', 'yandex'),
+('facebookexternalhit|telegrambot|whatsapp|vkshare|twitterbot', 'link-preview'),
+('lighthouse|pagespeed|gtmetrix|pingdom|uptimerobot', 'monitoring')
+;
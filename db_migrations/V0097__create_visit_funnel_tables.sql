@@ -0,0 +1,62 @@
+-- Инкрементальная сессионизация визитов и суточная воронка визиты → реальные визиты → регистрации → первые начисления
+-- Сессия — визиты одного посетителя (IP + User-Agent) с перерывами не больше 30 минут
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.visit_sessions (
+    id SERIAL PRIMARY KEY,
+    visitor_hash VARCHAR(32) NOT NULL,
+    ip_address VARCHAR(45),
+    user_agent TEXT,
+    started_at TIMESTAMP NOT NULL,
+    ended_at TIMESTAMP NOT NULL,
+    visits INTEGER DEFAULT 0,
+    real_visits INTEGER DEFAULT 0,
+    is_bot BOOLEAN DEFAULT FALSE,
+    landing_page VARCHAR(500),
+    referrer VARCHAR(500),
+    visited_auth BOOLEAN DEFAULT FALSE,
+    registered_user_id INTEGER,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_visit_sessions_visitor
+ON t_p25272970_courier_button_site.visit_sessions(visitor_hash, ended_at DESC);
+
+-- Кандидаты для атрибуции регистраций: человеческие сессии, ещё не связанные с пользователем
+CREATE INDEX IF NOT EXISTS idx_visit_sessions_unattributed
+ON t_p25272970_courier_button_site.visit_sessions(ended_at)
+WHERE registered_user_id IS NULL AND is_bot = FALSE;
+
+CREATE INDEX IF NOT EXISTS idx_visit_sessions_registered
+ON t_p25272970_courier_button_site.visit_sessions(registered_user_id)
+WHERE registered_user_id IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.funnel_daily (
+    day DATE PRIMARY KEY,
+    visits INTEGER DEFAULT 0,
+    real_visits INTEGER DEFAULT 0,
+    sessions INTEGER DEFAULT 0,
+    registrations INTEGER DEFAULT 0,
+    attributed_registrations INTEGER DEFAULT 0,
+    first_earnings INTEGER DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Первое начисление по CSV для каждого курьера (courier_earnings обновляется на месте при повторных загрузках)
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.funnel_first_earnings (
+    courier_id INTEGER PRIMARY KEY,
+    first_earning_at TIMESTAMP NOT NULL
+);
+
+-- Водяные знаки инкрементальных конвейеров: (watermark, last_id) последней обработанной строки источника
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.pipeline_watermarks (
+    name VARCHAR(50) PRIMARY KEY,
+    watermark TIMESTAMP NOT NULL,
+    last_id INTEGER DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+INSERT INTO t_p25272970_courier_button_site.pipeline_watermarks (name, watermark) VALUES
+('funnel_visits', '1970-01-01'),
+('funnel_registrations', '1970-01-01'),
+('funnel_first_earnings', '1970-01-01')
+ON CONFLICT (name) DO NOTHING;
@@ -0,0 +1,24 @@
+-- Строки CSV партнёрки, для которых не нашёлся курьер: ждут ручной привязки
+-- После привязки курьера (link-courier / update-external-id) строка проводится сразу, без повторной загрузки всего CSV
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.csv_unmatched_rows (
+    id SERIAL PRIMARY KEY,
+    external_id VARCHAR(255) NOT NULL UNIQUE,
+    row_data JSONB NOT NULL,
+    suggested_couriers JSONB DEFAULT '[]'::jsonb,
+    csv_filename VARCHAR(255),
+    csv_period_start DATE,
+    csv_period_end DATE,
+    status VARCHAR(20) DEFAULT 'pending',
+    courier_id INTEGER,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    resolved_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_csv_unmatched_rows_pending
+ON t_p25272970_courier_button_site.csv_unmatched_rows(updated_at DESC)
+WHERE status = 'pending';
+
+COMMENT ON COLUMN t_p25272970_courier_button_site.csv_unmatched_rows.row_data IS 'Исходная строка CSV; при повторной загрузке заменяется последней (суммы в CSV накопительные)';
+COMMENT ON COLUMN t_p25272970_courier_button_site.csv_unmatched_rows.status IS 'pending — ждёт привязки, applied — проведена, dismissed — отклонена админом';
@@ -0,0 +1,40 @@
+-- Загрузки CSV партнёрки: одна запись на файл, ключ — хэш нормализованного содержимого
+-- Повторная загрузка того же файла (в любом порядке строк) распознаётся без обработки строк
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.upload_batches (
+    id SERIAL PRIMARY KEY,
+    content_hash CHAR(64) NOT NULL UNIQUE,
+    filename VARCHAR(255),
+    csv_period_start DATE,
+    csv_period_end DATE,
+    rows_total INTEGER DEFAULT 0,
+    rows_new INTEGER DEFAULT 0,
+    processed INTEGER DEFAULT 0,
+    skipped INTEGER DEFAULT 0,
+    duplicates INTEGER DEFAULT 0,
+    total_amount DECIMAL(12,2) DEFAULT 0,
+    courier_self_total DECIMAL(12,2) DEFAULT 0,
+    referrer_total DECIMAL(12,2) DEFAULT 0,
+    admin_total DECIMAL(12,2) DEFAULT 0,
+    uploaded_by VARCHAR(255),
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Хэш последней проведённой версии строки по external_id: неизменённые строки пропускаются без запросов по строке
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.csv_row_hashes (
+    external_id VARCHAR(255) PRIMARY KEY,
+    row_hash CHAR(64) NOT NULL,
+    batch_id INTEGER,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+ALTER TABLE t_p25272970_courier_button_site.courier_earnings
+ADD COLUMN IF NOT EXISTS batch_id INTEGER;
+
+ALTER TABLE t_p25272970_courier_button_site.payment_distributions
+ADD COLUMN IF NOT EXISTS batch_id INTEGER;
+
+CREATE INDEX IF NOT EXISTS idx_courier_earnings_batch
+ON t_p25272970_courier_button_site.courier_earnings(batch_id);
+
+CREATE INDEX IF NOT EXISTS idx_payment_distributions_batch
+ON t_p25272970_courier_button_site.payment_distributions(batch_id);
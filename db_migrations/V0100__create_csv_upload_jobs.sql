@@ -0,0 +1,29 @@
+-- Потоковые загрузки CSV партнёрки: сырой файл (gzip) обрабатывается пачками с commit после каждой,
+-- rows_done — курсор возобновления, если вызов функции упёрся в таймаут
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.csv_upload_jobs (
+    id SERIAL PRIMARY KEY,
+    batch_id INTEGER NOT NULL,
+    filename VARCHAR(255),
+    csv_period_start DATE,
+    csv_period_end DATE,
+    payload BYTEA NOT NULL,
+    status VARCHAR(20) DEFAULT 'running',
+    rows_total INTEGER DEFAULT 0,
+    rows_done INTEGER DEFAULT 0,
+    processed INTEGER DEFAULT 0,
+    matched INTEGER DEFAULT 0,
+    unmatched INTEGER DEFAULT 0,
+    skipped INTEGER DEFAULT 0,
+    duplicates INTEGER DEFAULT 0,
+    errors JSONB DEFAULT '[]'::jsonb,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_csv_upload_jobs_running
+ON t_p25272970_courier_button_site.csv_upload_jobs(updated_at)
+WHERE status = 'running';
+
+COMMENT ON COLUMN t_p25272970_courier_button_site.csv_upload_jobs.payload IS 'Файл в gzip; очищается после завершения загрузки';
+COMMENT ON COLUMN t_p25272970_courier_button_site.csv_upload_jobs.errors IS 'Первые 100 ошибок по строкам';
@@ -0,0 +1,33 @@
+-- Нормализованный телефон курьера: E.164 (+7XXXXXXXXXX) и последние 4 цифры — вычисляемые колонки,
+-- поэтому заполняются при любой записи users (OAuth, регистрация через бота, профиль, админка)
+-- и для уже существующих строк при добавлении колонки. Поиск по телефону идёт по B-tree индексам
+-- вместо phone LIKE '%1234' с полным просмотром таблицы
+-- 8XXXXXXXXXX и 10 цифр без кода страны считаются российскими номерами
+ALTER TABLE t_p25272970_courier_button_site.users
+ADD COLUMN IF NOT EXISTS phone_e164 VARCHAR(16) GENERATED ALWAYS AS (
+    CASE
+        WHEN length(regexp_replace(phone, '\D', '', 'g')) = 11 AND left(regexp_replace(phone, '\D', '', 'g'), 1) = '8'
+            THEN '+7' || substr(regexp_replace(phone, '\D', '', 'g'), 2)
+        WHEN length(regexp_replace(phone, '\D', '', 'g')) = 10
+            THEN '+7' || regexp_replace(phone, '\D', '', 'g')
+        WHEN length(regexp_replace(phone, '\D', '', 'g')) BETWEEN 11 AND 15
+            THEN '+' || regexp_replace(phone, '\D', '', 'g')
+    END
+) STORED;
+
+ALTER TABLE t_p25272970_courier_button_site.users
+ADD COLUMN IF NOT EXISTS phone_last4 CHAR(4) GENERATED ALWAYS AS (
+    CASE
+        WHEN length(regexp_replace(phone, '\D', '', 'g')) >= 4
+            THEN right(regexp_replace(phone, '\D', '', 'g'), 4)
+    END
+) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_users_phone_e164
+ON t_p25272970_courier_button_site.users(phone_e164);
+
+CREATE INDEX IF NOT EXISTS idx_users_phone_last4
+ON t_p25272970_courier_button_site.users(phone_last4);
+
+COMMENT ON COLUMN t_p25272970_courier_button_site.users.phone_e164 IS 'Телефон в E.164, вычисляется из phone (в Python — normalize_phone)';
+COMMENT ON COLUMN t_p25272970_courier_button_site.users.phone_last4 IS 'Последние 4 цифры телефона для сопоставления строк CSV партнёрки';
@@ -0,0 +1,36 @@
+-- Поиск дубликатов курьеров (разные OAuth-провайдеры, регистрация через Telegram): вместо ручных
+-- миграций вроде V0023 — очередь пар на проверку админом с предложением, какой аккаунт оставить
+-- name_key — ключ блокировки «похожее звучание ФИО», считается в api (dedup_name_key) при регистрации
+-- и пересчитывается заданием поиска дубликатов
+ALTER TABLE t_p25272970_courier_button_site.users
+ADD COLUMN IF NOT EXISTS name_key VARCHAR(100);
+
+CREATE INDEX IF NOT EXISTS idx_users_name_key
+ON t_p25272970_courier_button_site.users(name_key);
+
+CREATE INDEX IF NOT EXISTS idx_users_email_lower
+ON t_p25272970_courier_button_site.users(LOWER(email));
+
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.user_duplicate_candidates (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    duplicate_user_id INTEGER NOT NULL,
+    keep_user_id INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    reasons JSONB DEFAULT '[]'::jsonb,
+    source VARCHAR(20) DEFAULT 'scan',
+    status VARCHAR(20) DEFAULT 'pending',
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    resolved_at TIMESTAMP,
+    UNIQUE (user_id, duplicate_user_id),
+    CHECK (user_id < duplicate_user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_duplicate_candidates_pending
+ON t_p25272970_courier_button_site.user_duplicate_candidates(score DESC)
+WHERE status = 'pending';
+
+COMMENT ON COLUMN t_p25272970_courier_button_site.user_duplicate_candidates.keep_user_id IS 'Предложение: какой аккаунт оставить (самый старый, как в V0023)';
+COMMENT ON COLUMN t_p25272970_courier_button_site.user_duplicate_candidates.source IS 'scan — задание поиска дубликатов, registration — отмечено при регистрации';
+COMMENT ON COLUMN t_p25272970_courier_button_site.user_duplicate_candidates.status IS 'pending — ждёт проверки, dismissed — не дубликат, merged — объединены вручную';
@@ -0,0 +1,41 @@
+-- Журнал движений баланса курьеров: каждое начисление и списание — отдельная запись со ссылкой на источник
+-- (payment_distributions, courier_self_bonus_tracking, withdrawal_requests). Записи только добавляются,
+-- исправления — компенсирующими записями. users.balance остаётся кэшем, обновляется тем же запросом,
+-- что и журнал, и сверяется с ним заданием сверки
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.balance_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    amount DECIMAL(12,2) NOT NULL,
+    entry_type VARCHAR(30) NOT NULL,
+    source_table VARCHAR(50),
+    source_id INTEGER,
+    description TEXT,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_balance_ledger_user
+ON t_p25272970_courier_button_site.balance_ledger(user_id, id);
+
+-- Одна запись на источник и тип: повторное проведение того же источника ничего не меняет
+CREATE UNIQUE INDEX IF NOT EXISTS idx_balance_ledger_source
+ON t_p25272970_courier_button_site.balance_ledger(source_table, source_id, entry_type)
+WHERE source_id IS NOT NULL;
+
+-- Контрольная точка по курьеру: баланс по записям журнала до ledger_id включительно.
+-- Баланс = balance + сумма записей с id > ledger_id
+CREATE TABLE IF NOT EXISTS t_p25272970_courier_button_site.balance_checkpoints (
+    user_id INTEGER PRIMARY KEY,
+    ledger_id BIGINT NOT NULL,
+    balance DECIMAL(12,2) NOT NULL,
+    entries INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Начальные остатки: журнал стартует с текущих балансов
+INSERT INTO t_p25272970_courier_button_site.balance_ledger (user_id, amount, entry_type, source_table, source_id, description)
+SELECT id, balance, 'opening', 'users', id, 'Остаток на момент ввода журнала'
+FROM t_p25272970_courier_button_site.users
+WHERE COALESCE(balance, 0) <> 0
+ON CONFLICT DO NOTHING;
+
+COMMENT ON COLUMN t_p25272970_courier_button_site.balance_ledger.entry_type IS 'opening, csv_distribution, self_bonus, withdrawal, withdrawal_refund';
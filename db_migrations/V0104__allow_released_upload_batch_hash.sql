@@ -0,0 +1,7 @@
+-- Хэш содержимого закрепляется за загрузкой, только если все строки проведены. Загрузка с ошибками
+-- или пропущенными строками освобождает хэш (content_hash = NULL): повторная загрузка того же файла
+-- снова обрабатывается, уже проведённые строки отсекаются по csv_row_hashes. UNIQUE допускает несколько NULL
+ALTER TABLE t_p25272970_courier_button_site.upload_batches
+ALTER COLUMN content_hash DROP NOT NULL;
+
+COMMENT ON COLUMN t_p25272970_courier_button_site.upload_batches.content_hash IS 'Хэш нормализованного содержимого; NULL — загрузка с ошибками, хэш освобождён для повторной загрузки';
@@ -0,0 +1,296 @@
+"""
+Бюджет запросов к БД для облачных функций backend/: ловит N+1 до деплоя
+
+Каждый сценарий (события из tests.json функции и сценарии из query_budgets.json) прогоняется
+против локального Postgres дважды — на малом и большом объёме данных. Если число запросов растёт
+с объёмом данных сильнее заявленного бюджета, сценарий проваливается, а в отчёт попадают
+отпечатки SQL, число выполнений которых выросло.
+
+База — одноразовая копия схемы проекта (pg_dump --schema-only --schema=t_p25272970_courier_button_site):
+таблицы из reset очищаются перед каждым прогоном. Часть базовых таблиц (users и др.) создана вне
+db_migrations, поэтому схему берём из дампа, а не из миграций.
+
+    python scripts/query_budget.py --dsn postgresql://postgres@localhost/courier_budget
+    python scripts/query_budget.py --function cleanup-visits --sizes 5,50 --verbose
+
+Бюджет сценария: per_item — сколько запросов допустимо добавить на каждую единицу данных
+(по умолчанию 0, т.е. число запросов не должно зависеть от объёма), slack — постоянный допуск,
+max_queries — потолок на малом объёме.
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Any, List, Tuple
+from urllib.parse import urlsplit, parse_qsl
+
+import psycopg2
+import psycopg2.extensions
+
+ROOT = Path(__file__).resolve().parent.parent
+BACKEND_DIR = ROOT / 'backend'
+BUDGETS_FILE = Path(__file__).resolve().parent / 'query_budgets.json'
+SCHEMA = 't_p25272970_courier_button_site'
+
+JWT_SECRET = 'query-budget-local-secret-not-for-deploy'
+ADMIN_TOKEN = 'query-budget-admin-token'
+
+# Ответ любого внешнего HTTP-вызова во время прогона (Telegram, Yandex OAuth и т.п.)
+OFFLINE_RESPONSE = {'ok': True, 'result': {}}
+
+def query_fingerprint(query) -> str:
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return ' '.join(str(query).split())[:300]
+
+class QueryLog:
+    """Счётчик выполненных запросов по отпечаткам за время одного прогона"""
+
+    def __init__(self):
+        self.counts = {}
+
+    def record(self, query):
+        fingerprint = query_fingerprint(query)
+        self.counts[fingerprint] = self.counts.get(fingerprint, 0) + 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+current_log = QueryLog()
+original_connect = psycopg2.connect
+
+class CountingCursorMixin:
+    def execute(self, query, vars=None):
+        current_log.record(query)
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        for _ in vars_list:
+            current_log.record(query)
+        return super().executemany(query, vars_list)
+
+_counting_classes = {}
+
+def counting_class(mixin, base):
+    key = (mixin, base)
+    if key not in _counting_classes:
+        _counting_classes[key] = type(f'Counting{base.__name__}', (mixin, base), {})
+    return _counting_classes[key]
+
+class CountingConnectionMixin:
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = counting_class(CountingCursorMixin, factory)
+        return super().cursor(*args, **kwargs)
+
+def counting_connect(*args, **kwargs):
+    """psycopg2.connect для функций: соединение той же фабрики, но курсоры считают запросы"""
+    factory = kwargs.get('connection_factory') or psycopg2.extensions.connection
+    kwargs['connection_factory'] = counting_class(CountingConnectionMixin, factory)
+    return original_connect(*args, **kwargs)
+
+class OfflineResponse:
+    status_code = 200
+    status = 200
+    ok = True
+    text = json.dumps(OFFLINE_RESPONSE)
+    content = text.encode('utf-8')
+
+    def json(self):
+        return dict(OFFLINE_RESPONSE)
+
+    def read(self):
+        return self.content
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+def go_offline():
+    """Внешние HTTP-вызовы функций не уходят в сеть и всегда успешны — иначе код после них не выполняется"""
+    import urllib.request
+    urllib.request.urlopen = lambda *args, **kwargs: OfflineResponse()
+    try:
+        import requests
+        requests.Session.request = lambda self, *args, **kwargs: OfflineResponse()
+    except ImportError:
+        pass
+
+def load_function(name: str):
+    path = BACKEND_DIR / name / 'index.py'
+    spec = importlib.util.spec_from_file_location(f'budget_{name.replace("-", "_")}', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, str(path.parent))
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(path.parent))
+    return module
+
+def admin_jwt() -> str:
+    import jwt
+    return jwt.encode(
+        {'user_id': 1, 'username': 'budget_admin', 'exp': datetime.utcnow() + timedelta(hours=1)},
+        JWT_SECRET,
+        algorithm='HS256'
+    )
+
+def substitute(value, variables: Dict[str, Any]):
+    if isinstance(value, str):
+        for key, replacement in variables.items():
+            value = value.replace('{' + key + '}', str(replacement))
+        return value
+    if isinstance(value, dict):
+        return {k: substitute(v, variables) for k, v in value.items()}
+    if isinstance(value, list):
+        return [substitute(v, variables) for v in value]
+    return value
+
+def build_event(spec: Dict[str, Any], variables: Dict[str, Any], body_override=None) -> Dict[str, Any]:
+    """Событие облачной функции из записи tests.json / query_budgets.json"""
+    url = urlsplit(substitute(spec.get('path', '/'), variables))
+    body = body_override if body_override is not None else substitute(spec.get('body'), variables)
+    return {
+        'httpMethod': spec.get('method', 'GET'),
+        'path': url.path or '/',
+        'queryStringParameters': dict(parse_qsl(url.query)),
+        'headers': substitute(spec.get('headers', {}), variables),
+        'body': body if isinstance(body, str) or body is None else json.dumps(body, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+def prepare_data(dsn: str, config: Dict[str, Any], size: int, variables: Dict[str, Any]):
+    """Очищает таблицы reset и заливает seed-SQL с подставленным объёмом {n}; возвращает тело из body_sql"""
+    conn = original_connect(dsn)
+    cur = conn.cursor()
+    cur.execute(f'SET search_path TO {SCHEMA}, public')
+    if config.get('reset'):
+        cur.execute('TRUNCATE ' + ', '.join(f'{SCHEMA}.{t}' for t in config['reset']) + ' RESTART IDENTITY CASCADE')
+    for statement in config.get('seed', []):
+        cur.execute(substitute(statement, {**variables, 'n': size}))
+    body = None
+    if config.get('body_sql'):
+        cur.execute(substitute(config['body_sql'], {**variables, 'n': size}))
+        body = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    conn.close()
+    return body
+
+def run_once(module, dsn: str, config: Dict[str, Any], spec: Dict[str, Any], size: int, variables) -> Tuple[QueryLog, int]:
+    global current_log
+    body = prepare_data(dsn, config, size, variables)
+    current_log = QueryLog()
+    result = module.handler(build_event(spec, variables, body), None)
+    status = result.get('statusCode') if isinstance(result, dict) else None
+    log, current_log = current_log, QueryLog()
+    return log, status
+
+def check_scenario(module, dsn: str, config: Dict[str, Any], spec: Dict[str, Any], sizes: Tuple[int, int], variables) -> Dict[str, Any]:
+    small_size, large_size = sizes
+    budget = {'per_item': 0, 'slack': 0, **config.get('budget', {}), **spec.get('budget', {})}
+    small, small_status = run_once(module, dsn, config, spec, small_size, variables)
+    large, large_status = run_once(module, dsn, config, spec, large_size, variables)
+
+    allowed_growth = budget['per_item'] * (large_size - small_size) + budget['slack']
+    growth = large.total - small.total
+    grown = sorted(
+        (
+            {'fingerprint': fp, 'small': small.counts.get(fp, 0), 'large': count}
+            for fp, count in large.counts.items()
+            if count > small.counts.get(fp, 0)
+        ),
+        key=lambda item: item['large'] - item['small'],
+        reverse=True
+    )
+
+    failures = []
+    if growth > allowed_growth:
+        failures.append(f'запросов {small.total} → {large.total} при объёме {small_size} → {large_size}, допустимый рост {allowed_growth}')
+    if budget.get('max_queries') is not None and small.total > budget['max_queries']:
+        failures.append(f'{small.total} запросов при бюджете {budget["max_queries"]}')
+
+    return {
+        'name': spec.get('name', '?'),
+        'status': [small_status, large_status],
+        'queries': [small.total, large.total],
+        'failures': failures,
+        'grown': grown
+    }
+
+def scenarios_for(name: str, config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """События из tests.json функции (с общим seed функции) плюс её собственные сценарии"""
+    tests_file = BACKEND_DIR / name / 'tests.json'
+    scenarios = []
+    if tests_file.exists() and config.get('include_tests', True):
+        for test in json.loads(tests_file.read_text(encoding='utf-8')).get('tests', []):
+            if test.get('method') != 'OPTIONS':
+                scenarios.append((config, test))
+    for scenario in config.get('scenarios', []):
+        scenarios.append(({**config, **scenario}, scenario))
+    return scenarios
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Проверка бюджета запросов функций backend/ на двух объёмах данных')
+    parser.add_argument('--dsn', default=os.environ.get('QUERY_BUDGET_DATABASE_URL'), help='одноразовая локальная база')
+    parser.add_argument('--sizes', default='5,50', help='малый и большой объём данных, через запятую')
+    parser.add_argument('--function', action='append', help='проверить только эти функции')
+    parser.add_argument('--verbose', action='store_true', help='показывать выросшие отпечатки и для прошедших сценариев')
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error('нужен --dsn или QUERY_BUDGET_DATABASE_URL')
+    sizes = tuple(int(size) for size in args.sizes.split(','))
+    if len(sizes) != 2 or sizes[0] >= sizes[1]:
+        parser.error('--sizes: два числа, малое и большое')
+
+    os.environ.update({'DATABASE_URL': args.dsn, 'JWT_SECRET': JWT_SECRET})
+    psycopg2.connect = counting_connect
+    go_offline()
+
+    budgets = json.loads(BUDGETS_FILE.read_text(encoding='utf-8'))
+    variables = {'admin_jwt': admin_jwt(), 'admin_token': ADMIN_TOKEN, 'hour': datetime.now().hour}
+    functions = args.function or sorted(budgets['functions'])
+
+    failed = 0
+    started = time.perf_counter()
+    for name in functions:
+        config = budgets['functions'].get(name, {})
+        module = load_function(name)
+        for scenario_config, spec in scenarios_for(name, config):
+            stdout, sys.stdout = sys.stdout, io.StringIO()
+            try:
+                result = check_scenario(module, args.dsn, scenario_config, spec, sizes, variables)
+            except Exception as e:
+                result = {'name': spec.get('name', '?'), 'status': [None, None], 'queries': [0, 0],
+                          'failures': [f'{type(e).__name__}: {e}'], 'grown': []}
+            finally:
+                sys.stdout = stdout
+
+            mark = 'FAIL' if result['failures'] else 'ok'
+            print(f"{mark:4} {name} / {result['name']}: {result['queries'][0]} → {result['queries'][1]} запросов, статус {result['status']}")
+            for failure in result['failures']:
+                print(f'       {failure}')
+            if result['failures'] or args.verbose:
+                for item in result['grown'][:10]:
+                    print(f"       {item['small']} → {item['large']}  {item['fingerprint']}")
+            failed += bool(result['failures'])
+
+    print(f'\nСценариев с превышением бюджета: {failed}, {time.perf_counter() - started:.1f} с')
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
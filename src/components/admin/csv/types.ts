@@ -24,6 +24,9 @@ export interface CsvRow {
 
 export interface UploadResult {
   success: boolean;
+  batch_id?: number | null;
+  already_uploaded?: boolean;
+  unchanged_rows?: number;
   processed: number;
   skipped: number;
   duplicates: number;